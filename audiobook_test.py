@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Test audiobook mode: chapter parsing of Markdown and EPUB, then one book synthesized end to end
+
+    python audiobook_test.py
+
+Runs the backend in-process against a local mongod (MONGO_URL, throwaway database)
+and synthesizes with TEST_VOICE, so the voice model must be downloadable.
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+import wave
+import zipfile
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = f"audiobook_test_{uuid.uuid4().hex[:8]}"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import audiobook  # noqa: E402
+import usage  # noqa: E402
+
+VOICE = os.environ.get("TEST_VOICE", "ru_RU-irina-medium")
+INSTANCE_ID = "audiobook-test"
+
+MARKDOWN = """# Маленькая книга
+
+Вступление перед первой главой.
+
+## Глава первая
+
+Первая глава начинается здесь. В ней **два** предложения.
+
+## Глава вторая
+
+Вторая глава короче. Её [ссылка](https://example.com) читается как текст.
+"""
+
+EPUB_FILES = {
+    "mimetype": "application/epub+zip",
+    "META-INF/container.xml": (
+        '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+        '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>'
+    ),
+    "OEBPS/content.opf": (
+        '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0">'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Книга EPUB</dc:title></metadata>'
+        '<manifest><item id="nav" href="nav.xhtml" properties="nav" media-type="application/xhtml+xml"/>'
+        '<item id="c1" href="one.xhtml" media-type="application/xhtml+xml"/>'
+        '<item id="c2" href="two.xhtml" media-type="application/xhtml+xml"/></manifest>'
+        '<spine><itemref idref="nav"/><itemref idref="c1"/><itemref idref="c2"/></spine></package>'
+    ),
+    "OEBPS/nav.xhtml": '<html><body><nav><ol><li>Оглавление</li></ol></nav></body></html>',
+    "OEBPS/one.xhtml": '<html><body><h1>Пролог</h1><p>Текст пролога.</p></body></html>',
+    "OEBPS/two.xhtml": '<html><body><h1>Эпилог</h1><p>Текст эпилога.</p><script>var x;</script></body></html>'
+}
+
+results = []
+
+def check(name, condition, details=""):
+    results.append((name, condition))
+    print(f"{'✅' if condition else '❌'} {name}" + (f" - {details}" if details else ""))
+
+def test_parsing():
+    print("\n[ТЕСТ] Разбор документа на главы")
+    print("-" * 60)
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        source = directory / "book.md"
+        source.write_text(MARKDOWN, encoding="utf-8")
+        title, chapters = audiobook.split_into_chapters(source, "markdown", directory)
+        titles = [chapter["title"] for chapter in chapters]
+        check("Markdown: главы по заголовкам", titles == ["Маленькая книга", "Глава первая", "Глава вторая"], str(titles))
+        first = (directory / "chapter_001.txt").read_text(encoding="utf-8")
+        check("Markdown: заголовок читается в начале главы", first.startswith("Маленькая книга."))
+        last = (directory / "chapter_003.txt").read_text(encoding="utf-8")
+        check("Markdown: разметка не читается вслух", "**" not in last and "https://" not in last and "ссылка" in last)
+        check("Markdown: объём главы посчитан", all(chapter["words"] > 0 and chapter["chars"] > 0 for chapter in chapters))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        source = directory / "book.epub"
+        with zipfile.ZipFile(source, "w") as archive:
+            for name, content in EPUB_FILES.items():
+                archive.writestr(name, content)
+        title, chapters = audiobook.split_into_chapters(source, "epub", directory)
+        check("EPUB: название из OPF", title == "Книга EPUB", str(title))
+        check("EPUB: главы по документам spine без оглавления",
+              [chapter["title"] for chapter in chapters] == ["Пролог", "Эпилог"], str([c["title"] for c in chapters]))
+        second = (directory / "chapter_002.txt").read_text(encoding="utf-8")
+        check("EPUB: скрипты не читаются вслух", "var x" not in second and "Текст эпилога." in second)
+
+        broken = directory / "broken.epub"
+        broken.write_bytes(b"not a zip")
+        try:
+            audiobook.split_into_chapters(broken, "epub", directory)
+            error = None
+        except audiobook.BookFormatError as e:
+            error = str(e)
+        check("EPUB: повреждённый файл отклоняется", error is not None, str(error))
+
+async def upload(data: bytes):
+    for start in range(0, len(data), 1024):
+        yield data[start:start + 1024]
+
+async def test_book():
+    print("\n[ТЕСТ] Озвучка книги целиком")
+    print("-" * 60)
+    await audiobook.ensure_indexes()
+    book = await audiobook.create_book(
+        "audiobook-test-user", "book.md", upload(MARKDOWN.encode("utf-8")), VOICE, 1.0, "ru-RU", False, INSTANCE_ID
+    )
+    check("Книга создана", book["status"] == "queued" and len(book["chapters"]) >= 2, f"{len(book['chapters'])} глав")
+
+    audiobook.start(book, INSTANCE_ID, 4, 1.0)
+    start = time.time()
+    doc = await audiobook.get_book(book["id"])
+    while doc["status"] not in audiobook.TERMINAL_STATUSES and time.time() - start < 600:
+        await asyncio.sleep(0.5)
+        doc = await audiobook.get_book(book["id"])
+
+    check("Книга озвучена", doc["status"] == "completed", f"{doc['status']} {doc.get('error') or ''} {time.time() - start:.1f}с")
+    check("Все главы завершены", all(chapter["status"] == "completed" for chapter in doc["chapters"]),
+          str([chapter["status"] for chapter in doc["chapters"]]))
+    if doc["status"] != "completed":
+        return
+
+    directory = audiobook.book_dir(book["id"])
+    with wave.open(str(directory / "book.wav"), "rb") as wav:
+        book_seconds = wav.getnframes() / wav.getframerate()
+    check("book.wav собран из глав", abs(book_seconds - doc["duration"]) < 0.5, f"{book_seconds:.1f}с")
+    index = json.loads((directory / "chapters.json").read_text(encoding="utf-8"))
+    check("Оглавление с таймкодами", [c["start"] for c in index["chapters"]] == sorted(c["start"] for c in index["chapters"]) and
+          len(index["chapters"]) == len(doc["chapters"]))
+    check("Временные файлы глав удалены", not any(directory.glob("temp_*")) and not any(directory.glob("chapter_*.txt")))
+    ledger = await usage.db.usage_ledger.count_documents({"user_id": "audiobook-test-user"})
+    check("Учёт вычислений по каждой главе", ledger == len(doc["chapters"]), f"{ledger} записей")
+
+    await audiobook.delete_book_files(book["id"])
+
+async def main():
+    print("=" * 60)
+    print("ТЕСТ АУДИОКНИГ")
+    print("=" * 60)
+    print(f"MongoDB: {os.environ['MONGO_URL']}, база: {os.environ['DB_NAME']}")
+
+    try:
+        test_parsing()
+        await test_book()
+    finally:
+        await audiobook.client.drop_database(os.environ["DB_NAME"])
+
+    passed = sum(1 for _, ok in results if ok)
+    print("\n" + "=" * 60)
+    print(f"Итого: {passed}/{len(results)} проверок пройдено")
+    print("=" * 60)
+    return passed == len(results)
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)
@@ -0,0 +1,615 @@
+"""Audiobook mode: chaptered multi-hour synthesis from uploaded TXT, Markdown or EPUB
+
+    upload  - the request body is streamed to <audio_dir>/book_<id>/source.<ext>
+    parse   - the document is read as a stream of headings and paragraphs and
+              written out as chapter_NNN.txt files, never held in memory whole:
+                TXT      - lines like "Глава 1", "Chapter IV", "Пролог" start a chapter
+                Markdown - "#" and "##" headings start a chapter
+                EPUB     - every spine document is a chapter, headings inside split it further
+              chapters longer than AUDIOBOOK_MAX_CHAPTER_CHARS are cut at a paragraph
+    chapters - each chapter is a SynthesisJob run through the staged pipeline,
+              AUDIOBOOK_PARALLEL_CHAPTERS at a time, into chapter_NNN.wav
+    combine - chapter files are copied block by block into book.wav; the chapter
+              index (title, start, duration) is stored with the book and in chapters.json
+
+State lives in db.audiobooks with per-chapter status and progress, so a drained
+server hands unfinished books to the next start, which resumes them from the
+chapter (and segment) where they stopped. The instance running a book renews
+its claim every AUDIOBOOK_HEARTBEAT_SECONDS; a claim older than
+AUDIOBOOK_CLAIM_STALE_SECONDS belongs to a dead instance and is taken over. Memory per book is bounded by one
+chapter's text plus the pipeline's queues, whatever the size of the book.
+"""
+import asyncio
+import io
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import time
+import uuid
+import zipfile
+from datetime import datetime, timezone, timedelta
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from xml.etree import ElementTree
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import pools
+import speech_rate
+import usage as usage_ledger
+from engine import concat_wavs, get_audio_dir, metered_usage, release_voice, split_text_into_segments
+from jobs import SynthesisJob, JobCancelled, register_job, unregister_job, spawn_task
+from pipeline import run_synthesis
+from scheduler import sla_deadline
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+# MongoDB connection
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(mongo_url)
+db = client[os.environ['DB_NAME']]
+
+AUDIOBOOK_MAX_UPLOAD_MB = float(os.environ.get('AUDIOBOOK_MAX_UPLOAD_MB', 50))
+AUDIOBOOK_MAX_CHAPTER_CHARS = int(os.environ.get('AUDIOBOOK_MAX_CHAPTER_CHARS', 100000))
+AUDIOBOOK_PARALLEL_CHAPTERS = int(os.environ.get('AUDIOBOOK_PARALLEL_CHAPTERS', 2))
+AUDIOBOOK_HEARTBEAT_SECONDS = float(os.environ.get('AUDIOBOOK_HEARTBEAT_SECONDS', 60))
+AUDIOBOOK_CLAIM_STALE_SECONDS = float(os.environ.get('AUDIOBOOK_CLAIM_STALE_SECONDS', 600))
+
+FORMATS = {".txt": "txt", ".md": "markdown", ".markdown": "markdown", ".epub": "epub"}
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+UPLOAD_CHUNK_BYTES = 1 << 20
+READ_CHUNK_CHARS = 1 << 16
+
+TXT_HEADING = re.compile(
+    r'^\s*((глава|часть|chapter|part)\s+[\wIVXLC]+\b.*|(пролог|эпилог|prologue|epilogue|предисловие|послесловие)\b.*)$',
+    re.IGNORECASE
+)
+MD_HEADING = re.compile(r'^\s{0,3}(#{1,2})\s+(.+?)\s*#*\s*$')
+# Inline Markdown that should not be read aloud
+MD_INLINE = re.compile(r'!\[[^\]]*\]\([^)]*\)|\[([^\]]*)\]\([^)]*\)|[*_`]{1,3}')
+
+class UploadTooLarge(Exception):
+    pass
+
+class BookFormatError(Exception):
+    pass
+
+def book_format(filename: str) -> str:
+    fmt = FORMATS.get(Path(filename or "").suffix.lower())
+    if fmt is None:
+        raise BookFormatError("Поддерживаются файлы .txt, .md и .epub")
+    return fmt
+
+def expected_segments(size_bytes: int) -> int:
+    """Rough segment count of an upload, for admission before it is parsed (~600 chars per segment)"""
+    return max(1, size_bytes // 600)
+
+def book_dir(book_id: str) -> Path:
+    return get_audio_dir() / f"book_{book_id}"
+
+async def save_upload(chunks, path: Path) -> int:
+    """Write an async iterator of body chunks to path, enforcing AUDIOBOOK_MAX_UPLOAD_MB; returns bytes written"""
+    limit = AUDIOBOOK_MAX_UPLOAD_MB * 1024 * 1024
+    written = 0
+    pending = bytearray()
+    with open(path, "wb") as out:
+        async for chunk in chunks:
+            written += len(chunk)
+            if written > limit:
+                raise UploadTooLarge(f"Файл больше {AUDIOBOOK_MAX_UPLOAD_MB:.0f} МБ")
+            pending += chunk
+            if len(pending) >= UPLOAD_CHUNK_BYTES:
+                await pools.file_io.run(out.write, bytes(pending))
+                pending.clear()
+        if pending:
+            await pools.file_io.run(out.write, bytes(pending))
+    return written
+
+# ----------------------------------------------------------------------------
+# Streaming parsers: each yields ("heading", title), ("text", paragraph) and,
+# between EPUB documents, ("break", None)
+# ----------------------------------------------------------------------------
+
+def iter_text_blocks(path: Path, markdown: bool) -> Iterator[Tuple[str, Optional[str]]]:
+    paragraph: List[str] = []
+    in_code = False
+    with open(path, encoding="utf-8-sig", errors="replace") as source:
+        for line in source:
+            if markdown and line.lstrip().startswith("```"):
+                in_code = not in_code
+                continue
+            if in_code:
+                continue
+            stripped = line.strip()
+            heading = None
+            if markdown:
+                match = MD_HEADING.match(line)
+                if match:
+                    heading = MD_INLINE.sub(r'\1', match.group(2))
+            elif len(stripped) <= 80 and TXT_HEADING.match(stripped):
+                heading = stripped
+            if heading is not None or not stripped:
+                if paragraph:
+                    yield "text", " ".join(paragraph)
+                    paragraph = []
+                if heading is not None:
+                    yield "heading", heading
+                continue
+            if markdown:
+                stripped = MD_INLINE.sub(r'\1', stripped.lstrip("#>-*+ ").strip())
+            paragraph.append(stripped)
+    if paragraph:
+        yield "text", " ".join(paragraph)
+
+class XhtmlBlocks(HTMLParser):
+    """Collects headings and paragraphs of an XHTML document fed in chunks"""
+
+    BLOCK_TAGS = {"p", "div", "li", "blockquote", "section", "tr", "br", "dd", "dt"}
+    HEADING_TAGS = {"h1", "h2", "h3"}
+    SKIP_TAGS = {"script", "style", "head", "title"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks: List[Tuple[str, str]] = []
+        self.buffer: List[str] = []
+        self.skip_depth = 0
+        self.in_heading = False
+
+    def flush(self, kind: str):
+        text = re.sub(r'\s+', ' ', "".join(self.buffer)).strip()
+        self.buffer = []
+        if text:
+            self.blocks.append((kind, text))
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.HEADING_TAGS:
+            self.flush("text")
+            self.in_heading = True
+        elif tag in self.BLOCK_TAGS:
+            self.flush("heading" if self.in_heading else "text")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in self.HEADING_TAGS:
+            self.flush("heading")
+            self.in_heading = False
+        elif tag in self.BLOCK_TAGS:
+            self.flush("heading" if self.in_heading else "text")
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.buffer.append(data)
+
+    def drain(self) -> List[Tuple[str, str]]:
+        blocks, self.blocks = self.blocks, []
+        return blocks
+
+def epub_spine(archive: zipfile.ZipFile) -> Tuple[Optional[str], List[str]]:
+    """Title and reading-order document paths of an EPUB"""
+    try:
+        container = ElementTree.fromstring(archive.read("META-INF/container.xml"))
+    except (KeyError, ElementTree.ParseError):
+        raise BookFormatError("Повреждённый EPUB: нет META-INF/container.xml")
+    rootfile = next((el.get("full-path") for el in container.iter() if el.tag.endswith("rootfile")), None)
+    if not rootfile:
+        raise BookFormatError("Повреждённый EPUB: не найден OPF")
+    opf = ElementTree.fromstring(archive.read(rootfile))
+    base = posixpath.dirname(rootfile)
+
+    title = next((el.text for el in opf.iter() if el.tag.endswith("}title") and el.text), None)
+    # The EPUB 3 navigation document is a table of contents, not something to read aloud
+    manifest = {
+        el.get("id"): posixpath.normpath(posixpath.join(base, el.get("href", "")))
+        for el in opf.iter()
+        if el.tag.endswith("}item") and "nav" not in (el.get("properties") or "").split()
+    }
+    spine = [
+        manifest[el.get("idref")] for el in opf.iter()
+        if el.tag.endswith("}itemref") and el.get("idref") in manifest and el.get("linear") != "no"
+    ]
+    return title, spine
+
+def iter_epub_blocks(archive: zipfile.ZipFile, spine: List[str]) -> Iterator[Tuple[str, Optional[str]]]:
+    for name in spine:
+        yield "break", None
+        parser = XhtmlBlocks()
+        try:
+            with io.TextIOWrapper(archive.open(name), encoding="utf-8", errors="replace") as document:
+                while True:
+                    chunk = document.read(READ_CHUNK_CHARS)
+                    if not chunk:
+                        break
+                    parser.feed(chunk)
+                    yield from parser.drain()
+        except KeyError:
+            logger.warning(f"EPUB spine item {name} is missing")
+            continue
+        parser.close()
+        parser.flush("text")
+        yield from parser.drain()
+
+class ChapterWriter:
+    """Writes blocks into chapter_NNN.txt files, one open file at a time"""
+
+    def __init__(self, directory: Path, default_title: str):
+        self.directory = directory
+        self.default_title = default_title
+        self.chapters: List[dict] = []
+        self.title: Optional[str] = None
+        self.part = 1
+        self.file = None
+        self.chars = 0
+        self.words = 0
+
+    def block(self, kind: str, text: Optional[str]):
+        if kind == "break" or kind == "heading":
+            if self.chars:
+                self.close()
+                self.title = None
+                self.part = 1
+            if kind == "heading":
+                # Consecutive headings ("Часть 1" then "Глава 1") make one title
+                self.title = f"{self.title}. {text}" if self.title else text
+            return
+
+        if self.chars and self.chars + len(text) > AUDIOBOOK_MAX_CHAPTER_CHARS:
+            self.close()
+            self.part += 1
+        if self.file is None:
+            index = len(self.chapters)
+            self.file = open(self.directory / f"chapter_{index + 1:03d}.txt", "w", encoding="utf-8")
+            # A heading is read aloud at the start of its chapter
+            if self.title and self.part == 1:
+                heading = self.title.rstrip(".") + "."
+                self.file.write(heading + "\n\n")
+                self.chars += len(heading) + 2
+                self.words += len(heading.split())
+        self.file.write(text + "\n\n")
+        self.chars += len(text) + 2
+        self.words += len(text.split())
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        index = len(self.chapters)
+        if self.title:
+            title = self.title if self.part == 1 else f"{self.title} (часть {self.part})"
+        else:
+            title = f"{self.default_title} {index + 1}"
+        self.chapters.append({
+            "index": index,
+            "title": title,
+            "chars": self.chars,
+            "words": self.words,
+            "status": "queued",
+            "progress": 0,
+            "duration": None,
+            "error": None
+        })
+        self.file = None
+        self.chars = 0
+        self.words = 0
+
+def split_into_chapters(source: Path, fmt: str, directory: Path) -> Tuple[Optional[str], List[dict]]:
+    """Parse a document into chapter text files in directory (runs on the file_io pool)"""
+    writer = ChapterWriter(directory, "Глава")
+    title = None
+    try:
+        if fmt == "epub":
+            try:
+                archive = zipfile.ZipFile(source)
+            except zipfile.BadZipFile:
+                raise BookFormatError("Файл не является EPUB-архивом")
+            with archive:
+                title, spine = epub_spine(archive)
+                for kind, text in iter_epub_blocks(archive, spine):
+                    writer.block(kind, text)
+        else:
+            for kind, text in iter_text_blocks(source, markdown=fmt == "markdown"):
+                writer.block(kind, text)
+    finally:
+        writer.close()
+    return title, writer.chapters
+
+# ----------------------------------------------------------------------------
+# Running books
+# ----------------------------------------------------------------------------
+
+class AudiobookRun:
+    """Chapter jobs of one book running on this instance"""
+
+    def __init__(self, book: dict, instance_id: str, batch_size: int, segment_seconds: float):
+        self.book = book
+        self.book_id = book["id"]
+        self.instance_id = instance_id
+        self.batch_size = batch_size
+        self.segment_seconds = segment_seconds
+        self.jobs: Dict[int, SynthesisJob] = {}
+        self.cancel_reason: Optional[str] = None
+        # Stopped by a drain: chapters go back to "queued" and keep their segments
+        self.draining = False
+        self.task: Optional[asyncio.Task] = None
+
+    def cancel(self, reason: str, draining: bool = False):
+        self.cancel_reason = reason
+        self.draining = draining
+        for job in list(self.jobs.values()):
+            job.cancel(reason)
+
+    @property
+    def claim(self) -> dict:
+        """Filter for writes to the book: they only land while this instance holds it"""
+        return {"id": self.book_id, "claimed_by": self.instance_id}
+
+# Books running on this instance by id
+runs: Dict[str, AudiobookRun] = {}
+
+async def ensure_indexes():
+    await db.audiobooks.create_index([("user_id", 1), ("created_at", -1)])
+    await db.audiobooks.create_index("status")
+
+async def create_book(user_id: str, filename: str, chunks, voice: str, rate: float, language: str,
+                      is_pro: bool, instance_id: str) -> dict:
+    """Store the upload, split it into chapters and insert the book; raises UploadTooLarge / BookFormatError"""
+    fmt = book_format(filename)
+    book_id = str(uuid.uuid4())
+    directory = book_dir(book_id)
+    directory.mkdir(parents=True, exist_ok=True)
+    source = directory / f"source{Path(filename).suffix.lower()}"
+    try:
+        size = await save_upload(chunks, source)
+        title, chapters = await pools.file_io.run(split_into_chapters, source, fmt, directory)
+        if not chapters:
+            raise BookFormatError("В документе не найден текст")
+    except Exception:
+        await pools.file_io.run(shutil.rmtree, directory, True)
+        raise
+    finally:
+        source.unlink(missing_ok=True)
+
+    book = {
+        "id": book_id,
+        "user_id": user_id,
+        "title": title or Path(filename).stem,
+        "filename": filename,
+        "format": fmt,
+        "size_bytes": size,
+        "voice": voice,
+        "rate": rate,
+        "language": language,
+        "is_pro": is_pro,
+        "status": "queued",
+        "chapters": chapters,
+        "chars": sum(chapter["chars"] for chapter in chapters),
+        # Measured speaking rate of the voice, as engine.estimate_duration
+        "estimated_duration": round(sum(chapter["words"] for chapter in chapters) / speech_rate.words_per_minute(language, voice, rate) * 60, 1),
+        "duration": None,
+        "chapter_index": None,
+        "claimed_by": instance_id,
+        "claimed_at": datetime.now(timezone.utc),
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    await db.audiobooks.insert_one(dict(book))
+    logger.info(f"Audiobook {book_id}: {len(chapters)} chapters, {book['chars']} chars from {fmt} ({size} bytes)")
+    return book
+
+async def get_book(book_id: str) -> Optional[dict]:
+    return await db.audiobooks.find_one({"id": book_id}, {"_id": 0, "claimed_by": 0, "claimed_at": 0})
+
+def start(book: dict, instance_id: str, batch_size: int, segment_seconds: float) -> AudiobookRun:
+    """Run a book's unfinished chapters in the background on this instance (which has claimed it)"""
+    run = AudiobookRun(book, instance_id, batch_size, segment_seconds)
+    runs[run.book_id] = run
+    run.task = spawn_task(run_book(run))
+    return run
+
+async def update_chapter(run: AudiobookRun, index: int, **fields):
+    await db.audiobooks.update_one(
+        run.claim,
+        {"$set": {f"chapters.{index}.{key}": value for key, value in fields.items()}}
+    )
+
+async def heartbeat(run: AudiobookRun):
+    """Renew the claim while the book runs; stop if it was cancelled elsewhere or taken over"""
+    while True:
+        await asyncio.sleep(AUDIOBOOK_HEARTBEAT_SECONDS)
+        book = await db.audiobooks.find_one_and_update(
+            run.claim,
+            {"$set": {"claimed_at": datetime.now(timezone.utc)}},
+            projection={"status": 1, "error": 1}
+        )
+        if book is None:
+            # Another instance resumes it from the same files, so they are kept
+            logger.warning(f"Audiobook {run.book_id} was claimed by another instance, stopping")
+            run.cancel("Claim lost", draining=True)
+            return
+        if book["status"] == "cancelled":
+            run.cancel(book.get("error") or "Cancelled by user")
+            return
+
+async def run_book(run: AudiobookRun):
+    book = run.book
+    directory = book_dir(run.book_id)
+    semaphore = asyncio.Semaphore(AUDIOBOOK_PARALLEL_CHAPTERS)
+    started = time.time()
+    await db.audiobooks.update_one({**run.claim, "status": {"$in": ["queued", "running"]}}, {"$set": {"status": "running"}})
+    heartbeat_task = asyncio.get_running_loop().create_task(heartbeat(run))
+
+    async def chapter_task(chapter: dict):
+        async with semaphore:
+            if run.cancel_reason:
+                return
+            await run_chapter(run, chapter, directory)
+
+    try:
+        pending = [chapter for chapter in book["chapters"] if chapter["status"] != "completed"]
+        await asyncio.gather(*(chapter_task(chapter) for chapter in pending))
+
+        if run.cancel_reason:
+            return
+        doc = await db.audiobooks.find_one({"id": run.book_id}, {"chapters": 1})
+        failed = [chapter["index"] + 1 for chapter in doc["chapters"] if chapter["status"] != "completed"]
+        if failed:
+            await db.audiobooks.update_one(run.claim, {"$set": {
+                "status": "failed",
+                "error": f"Не удалось озвучить главы: {', '.join(map(str, failed))}"
+            }})
+            return
+
+        # All chapters are on disk: build the combined file and the chapter index
+        parts = [directory / f"chapter_{chapter['index'] + 1:03d}.wav" for chapter in doc["chapters"]]
+        combined = directory / "book.wav"
+        await pools.encoding.run(concat_wavs, parts, combined, False)
+        index, position = [], 0.0
+        for chapter in doc["chapters"]:
+            index.append({
+                "index": chapter["index"],
+                "title": chapter["title"],
+                "start": round(position, 2),
+                "duration": chapter["duration"]
+            })
+            position += chapter["duration"]
+        await pools.file_io.run(
+            (directory / "chapters.json").write_text,
+            json.dumps({"title": book["title"], "chapters": index}, ensure_ascii=False, indent=2),
+            "utf-8"
+        )
+        # Chapter texts are only kept for resuming
+        for chapter in doc["chapters"]:
+            (directory / f"chapter_{chapter['index'] + 1:03d}.txt").unlink(missing_ok=True)
+        await db.audiobooks.update_one({**run.claim, "status": "running"}, {"$set": {
+            "status": "completed",
+            "duration": round(position, 2),
+            "audio_path": str(combined),
+            "chapter_index": index,
+            "generation_time": round(time.time() - started, 1),
+            "completed_at": datetime.now(timezone.utc).isoformat()
+        }})
+        logger.info(f"Audiobook {run.book_id} completed: {len(index)} chapters, {position / 3600:.2f} h")
+    except Exception as e:
+        logger.error(f"Audiobook {run.book_id} failed: {str(e)}", exc_info=True)
+        await db.audiobooks.update_one(run.claim, {"$set": {"status": "failed", "error": str(e)}})
+    finally:
+        heartbeat_task.cancel()
+        runs.pop(run.book_id, None)
+
+async def run_chapter(run: AudiobookRun, chapter: dict, directory: Path):
+    """Synthesize one chapter as its own job; resumes from segment files left by a drained run"""
+    book = run.book
+    index = chapter["index"]
+    name = f"chapter_{index + 1:03d}"
+    job = register_job(SynthesisJob(f"{run.book_id}-{index + 1:03d}", book["user_id"]))
+    run.jobs[index] = job
+    job.temp_dir = directory / f"temp_{name}"
+    job.temp_dir.mkdir(exist_ok=True)
+    reported = 0
+    try:
+        text = await pools.file_io.run((directory / f"{name}.txt").read_text, "utf-8")
+        segments = split_text_into_segments(text)
+        job.deadline = sla_deadline(book["is_pro"], len(segments) * run.segment_seconds, time.time())
+        job.status = "running"
+        await update_chapter(run, index, status="running", progress=0, job_id=job.job_id)
+
+        audio_duration = None
+        async for event in run_synthesis(
+            job, segments, book["voice"], book["rate"], run.batch_size,
+            directory, name, chapter["words"] / speech_rate.words_per_minute(book["language"], book["voice"], book["rate"]),
+            resume=True
+        ):
+            if event['type'] == 'result':
+                audio_duration = event['duration']
+            elif event.get('progress', 0) >= reported + 5:
+                reported = event['progress']
+                await update_chapter(run, index, progress=reported)
+
+        job.status = "completed"
+        usage = metered_usage(job, audio_duration)
+        await update_chapter(
+            run, index, status="completed", progress=100, duration=round(audio_duration, 2),
+            cpu_seconds=usage["cpu_seconds"], segment_failures=job.segment_failures
+        )
+        await usage_ledger.record_usage(book["user_id"], job.job_id, usage["cpu_seconds"], audio_duration, len(segments))
+    except JobCancelled as e:
+        await update_chapter(run, index, status="queued" if run.draining else "cancelled", error=str(e))
+    except Exception as e:
+        logger.error(f"Audiobook {run.book_id} chapter {index + 1} failed: {str(e)}", exc_info=True)
+        job.status = "failed"
+        await update_chapter(run, index, status="failed", error=str(e))
+    finally:
+        run.jobs.pop(index, None)
+        if not await job.wait_idle():
+            logger.warning(f"Chapter job {job.job_id} still has {job.segments_in_flight} segments running")
+        if job.voice_key:
+            release_voice(job.voice_key)
+        # A drained chapter keeps its segments for the next start to resume from
+        if not run.draining:
+            await pools.file_io.run(shutil.rmtree, job.temp_dir, True)
+        unregister_job(job.job_id)
+
+async def cancel_book(book_id: str, reason: str = "Cancelled by user") -> bool:
+    """Stop a book's chapters; returns False if it has already finished
+    A book running on another instance is stopped by that instance's heartbeat."""
+    run = runs.get(book_id)
+    if run is not None:
+        run.cancel(reason)
+    # Also covers a book waiting for the next start after a drain
+    result = await db.audiobooks.update_one(
+        {**(run.claim if run is not None else {"id": book_id}), "status": {"$in": ["queued", "running"]}},
+        {"$set": {"status": "cancelled", "error": reason}}
+    )
+    return run is not None or result.modified_count > 0
+
+async def drain(reason: str):
+    """Stop chapters running on this instance and release their books to the next start"""
+    local = list(runs.values())
+    for run in local:
+        run.cancel(reason, draining=True)
+    for run in local:
+        if run.task is not None:
+            await asyncio.gather(run.task, return_exceptions=True)
+        # Not one that was cancelled meanwhile, or taken over by another instance
+        await db.audiobooks.update_one(
+            {**run.claim, "status": {"$in": ["queued", "running"]}},
+            {"$set": {"status": "queued", "claimed_by": None}}
+        )
+    if local:
+        logger.info(f"Released {len(local)} audiobooks for the next start")
+
+async def restore(instance_id: str, batch_size: int, segment_seconds: float):
+    """Claim unfinished books released by a drained server (or stuck on a dead one) and resume them"""
+    stale = datetime.now(timezone.utc) - timedelta(seconds=AUDIOBOOK_CLAIM_STALE_SECONDS)
+    restored = 0
+    while True:
+        book = await db.audiobooks.find_one_and_update(
+            {
+                "status": {"$in": ["queued", "running"]},
+                "$or": [{"claimed_by": None}, {"claimed_at": {"$lt": stale}}]
+            },
+            {"$set": {"claimed_by": instance_id, "claimed_at": datetime.now(timezone.utc)}},
+            projection={"_id": 0}
+        )
+        if book is None:
+            break
+        start(book, instance_id, batch_size, segment_seconds)
+        restored += 1
+    if restored:
+        logger.info(f"Resumed {restored} audiobooks")
+
+def chapter_audio_path(book_id: str, index: int) -> Path:
+    return book_dir(book_id) / f"chapter_{index + 1:03d}.wav"
+
+async def delete_book_files(book_id: str):
+    await pools.file_io.run(shutil.rmtree, book_dir(book_id), True)
@@ -0,0 +1,580 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.request
+import wave
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional
+
+import numpy as np
+from piper import PiperVoice
+from piper.config import SynthesisConfig
+from piper.voice import AudioChunk
+
+import metrics
+import pools
+import speech_rate
+from jobs import SynthesisJob, JobCancelled
+from scheduler import SegmentDispatcher, SLA_TIERS
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).parent
+
+# Piper configuration
+PIPER_MODELS_DIR = ROOT_DIR / "piper_models"
+PIPER_MODELS_DIR.mkdir(exist_ok=True)
+VOICES_CACHE_FILE = PIPER_MODELS_DIR / "voices_cache.json"
+
+# Cache for loaded Piper voices
+loaded_voices: Dict[str, PiperVoice] = {}
+# Number of jobs currently using each loaded voice
+voice_refcounts: Dict[str, int] = {}
+# Model size of each loaded voice, bytes (ONNX weights dominate its memory)
+voice_sizes: Dict[str, int] = {}
+# One load at a time per voice
+voice_load_locks: Dict[str, asyncio.Lock] = {}
+
+# Recent throughput for /api/admin/engine
+segment_throughput = metrics.RateWindow()
+audio_throughput = metrics.RateWindow()  # seconds of audio
+
+# Segment synthesis runs on the inference pool; disk work and encoding have their own pools
+max_workers = pools.inference.workers
+
+# Segments wait here for an inference slot, earliest job deadline first
+dispatcher = SegmentDispatcher(max_workers)
+
+# A failing segment is retried, then re-split into smaller pieces; a piece that
+# still fails fails the job, or is replaced with silence if the fallback is on
+SEGMENT_RETRIES = int(os.environ.get('SEGMENT_RETRIES', 2))
+SEGMENT_RETRY_BACKOFF_SECONDS = float(os.environ.get('SEGMENT_RETRY_BACKOFF_SECONDS', 0.5))
+SEGMENT_SILENCE_FALLBACK = os.environ.get('SEGMENT_SILENCE_FALLBACK', '0') == '1'
+# Frames per block when copying WAV data between files (~1.5 s at 22050 Hz)
+WAV_COPY_FRAMES = 32768
+
+# Helper function to estimate speaking duration
+def estimate_duration(text: str, rate: float = 1.0, voice: Optional[str] = None, language: Optional[str] = None) -> float:
+    """Estimate audio duration in seconds from the measured speaking rate of the voice / language
+    (characters per second once measured, else words per minute; see speech_rate)"""
+    chars_per_second = speech_rate.chars_per_second(language, voice, rate)
+    if chars_per_second:
+        return len(text) / chars_per_second
+    
+    words = len(text.split())
+    return words / speech_rate.words_per_minute(language, voice, rate) * 60  # Convert to seconds
+
+# Helper function to get audio duration from WAV file
+def get_audio_duration(wav_path: Path) -> float:
+    """Get duration of WAV audio file in seconds"""
+    try:
+        with wave.open(str(wav_path), 'rb') as wav_file:
+            frames = wav_file.getnframes()
+            rate = wav_file.getframerate()
+            duration = frames / float(rate)
+            return duration
+    except Exception as e:
+        logger.error(f"Error getting audio duration: {str(e)}")
+        return 0.0
+
+# Piper helper functions
+def load_voices_index() -> Dict:
+    """Read the voices index from the cache file or HuggingFace (blocking, runs on the file I/O pool)"""
+    if VOICES_CACHE_FILE.exists():
+        metrics.incr("voices_index_lookups", result="hit")
+        with open(VOICES_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    
+    metrics.incr("voices_index_lookups", result="miss")
+    url = "https://huggingface.co/rhasspy/piper-voices/raw/main/voices.json"
+    with urllib.request.urlopen(url, timeout=10) as response:
+        voices_data = json.loads(response.read())
+    
+    # Cache the data
+    with open(VOICES_CACHE_FILE, 'w') as f:
+        json.dump(voices_data, f)
+    
+    return voices_data
+
+async def fetch_available_voices() -> Dict:
+    """Fetch available Piper voices from HuggingFace"""
+    try:
+        return await pools.file_io.run(load_voices_index)
+    except Exception as e:
+        logger.error(f"Error fetching voices: {e}")
+        return {}
+
+async def download_voice_model(voice_key: str, voices_data: Dict) -> tuple[Path, Path]:
+    """Download a Piper voice model and config if not already present"""
+    try:
+        voice_info = voices_data.get(voice_key)
+        if not voice_info:
+            raise ValueError(f"Voice {voice_key} not found")
+        
+        # Find .onnx and .onnx.json files in the files dict
+        model_file_path = None
+        config_file_path = None
+        
+        for file_path in voice_info['files'].keys():
+            if file_path.endswith('.onnx.json'):
+                config_file_path = file_path
+            elif file_path.endswith('.onnx'):
+                model_file_path = file_path
+        
+        if not model_file_path or not config_file_path:
+            raise ValueError(f"Model or config file not found for {voice_key}")
+        
+        # Construct URLs
+        model_url = f"https://huggingface.co/rhasspy/piper-voices/resolve/main/{model_file_path}"
+        config_url = f"https://huggingface.co/rhasspy/piper-voices/resolve/main/{config_file_path}"
+        
+        model_path = PIPER_MODELS_DIR / f"{voice_key}.onnx"
+        config_path = PIPER_MODELS_DIR / f"{voice_key}.onnx.json"
+        
+        # Download if not exists
+        if not model_path.exists():
+            logger.info(f"Downloading model for {voice_key}...")
+            await pools.file_io.run(urllib.request.urlretrieve, model_url, model_path)
+            logger.info(f"Model downloaded: {model_path}")
+        
+        if not config_path.exists():
+            logger.info(f"Downloading config for {voice_key}...")
+            await pools.file_io.run(urllib.request.urlretrieve, config_url, config_path)
+            logger.info(f"Config downloaded: {config_path}")
+        
+        return model_path, config_path
+    except Exception as e:
+        logger.error(f"Error downloading voice model: {e}")
+        raise
+
+async def get_or_load_voice(voice_key: str, model_path: Path, config_path: Path) -> PiperVoice:
+    """Get a cached voice or load it on the file I/O pool
+    Concurrent requests for the same cold voice share one load."""
+    if voice_key in loaded_voices:
+        metrics.incr("voice_cache_lookups", result="hit")
+        return loaded_voices[voice_key]
+    
+    lock = voice_load_locks.setdefault(voice_key, asyncio.Lock())
+    async with lock:
+        if voice_key not in loaded_voices:
+            metrics.incr("voice_cache_lookups", result="miss")
+            logger.info(f"Loading voice: {voice_key}")
+            loaded_voices[voice_key] = await pools.file_io.run(PiperVoice.load, str(model_path), str(config_path))
+            voice_sizes[voice_key] = model_path.stat().st_size
+        else:
+            metrics.incr("voice_cache_lookups", result="hit")
+    return loaded_voices[voice_key]
+
+async def acquire_voice(voice_key: str, model_path: Path, config_path: Path) -> PiperVoice:
+    """Get or load a voice and count the job using it"""
+    voice = await get_or_load_voice(voice_key, model_path, config_path)
+    voice_refcounts[voice_key] = voice_refcounts.get(voice_key, 0) + 1
+    return voice
+
+def release_voice(voice_key: str):
+    """Release a voice reference taken with acquire_voice"""
+    count = voice_refcounts.get(voice_key, 0) - 1
+    if count > 0:
+        voice_refcounts[voice_key] = count
+    else:
+        voice_refcounts.pop(voice_key, None)
+
+# Helper function to split text into segments
+def split_text_into_segments(text: str, max_segment_length: int = 600) -> list:
+    """
+    Split text into segments by sentences while trying to keep segment lengths reasonable
+    Optimized at 600 chars for maximum parallelization on 8 vCPU
+    Smaller segments = more parallel tasks = faster generation
+    Also adds pauses at punctuation marks for more natural speech
+    """
+    # Add pauses at punctuation for natural speech rhythm
+    # Add longer pause after sentence-ending punctuation (.!?)
+    text = re.sub(r'([.!?])\s+', r'\1 ... ', text)  # Add pause after sentences
+    # Add shorter pause after commas, semicolons, colons
+    text = re.sub(r'([,;:])\s+', r'\1 .. ', text)  # Add pause after internal punctuation
+    
+    # Split by sentences (periods, exclamation marks, question marks)
+    sentences = re.split(r'(?<=[.!?])\s+', text)
+    
+    segments = []
+    current_segment = ""
+    
+    for sentence in sentences:
+        # If adding this sentence would exceed max length, start a new segment
+        if current_segment and len(current_segment) + len(sentence) > max_segment_length:
+            segments.append(current_segment.strip())
+            current_segment = sentence
+        else:
+            current_segment += " " + sentence if current_segment else sentence
+    
+    # Add remaining segment
+    if current_segment:
+        segments.append(current_segment.strip())
+    
+    return segments
+
+def synthesize_phoneme_ids(voice: PiperVoice, sentence_ids: list, syn_config: SynthesisConfig) -> Iterator[AudioChunk]:
+    """Same as PiperVoice.synthesize, starting from already phonemized sentences"""
+    for phoneme_ids in sentence_ids:
+        audio = voice.phoneme_ids_to_audio(phoneme_ids, syn_config)
+        if syn_config.normalize_audio:
+            max_val = np.max(np.abs(audio))
+            audio = np.zeros_like(audio) if max_val < 1e-8 else audio / max_val
+        if syn_config.volume != 1.0:
+            audio = audio * syn_config.volume
+        yield AudioChunk(
+            sample_rate=voice.config.sample_rate,
+            sample_width=2,
+            sample_channels=1,
+            audio_float_array=np.clip(audio, -1.0, 1.0).astype(np.float32)
+        )
+
+async def run_in_slot(job_key: str, fn: Callable, job: Optional[SynthesisJob] = None):
+    """Run fn on the inference pool under the dispatcher slot job_key already holds
+    The slot is released once fn has stopped, not when the awaiting task gives up on it:
+    a cancelled segment keeps its thread busy until the next sentence boundary."""
+    loop = asyncio.get_running_loop()
+    lock = threading.Lock()
+    state = {"started": False, "abandoned": False}
+
+    def call():
+        with lock:
+            if state["abandoned"]:
+                return None
+            state["started"] = True
+        try:
+            return fn()
+        finally:
+            loop.call_soon_threadsafe(dispatcher.release, job_key)
+
+    future = pools.inference.submit(call)
+    if job is not None:
+        job.track(future)
+    try:
+        return await future
+    except BaseException:
+        # Either the thread releases the slot when fn ends, or fn never runs and it is released here
+        with lock:
+            never_started = not state["started"]
+            state["abandoned"] = True
+        if never_started:
+            dispatcher.release(job_key)
+        raise
+
+# Helper function to synthesize a single audio segment (optimized - no voice loading)
+async def synthesize_audio_segment_fast(
+    text: str,
+    voice: PiperVoice,
+    rate: float,
+    segment_idx: int,
+    temp_dir: Path,
+    job: Optional[SynthesisJob] = None,
+    phoneme_ids: Optional[list] = None
+) -> Path:
+    """Synthesize audio for a single text segment using pre-loaded voice
+    If a job is given, the segment stops between sentences once the job is cancelled.
+    phoneme_ids (per sentence, from the pipeline's phonemize stage) skip phonemization here."""
+    try:
+        # Generate audio file path
+        segment_file = temp_dir / f"segment_{segment_idx:04d}.wav"
+
+        # Synthesize using optimized thread pool
+        def synthesize():
+            if job is not None:
+                job.check_cancelled()
+                job.segment_started()
+            cpu_token = metrics.cpu_meter.start()
+            try:
+                syn_config = SynthesisConfig(
+                    length_scale=1.0 / rate,
+                    noise_scale=0.667,
+                    noise_w_scale=0.8
+                )
+
+                # Same as voice.synthesize_wav, but checks for cancellation per sentence
+                wav_out = None
+                try:
+                    if phoneme_ids is None:
+                        audio_chunks = voice.synthesize(text, syn_config=syn_config)
+                    else:
+                        audio_chunks = synthesize_phoneme_ids(voice, phoneme_ids, syn_config)
+                    for audio_chunk in audio_chunks:
+                        if job is not None:
+                            job.check_cancelled()
+                        if wav_out is None:
+                            wav_out = wave.open(str(segment_file), 'wb')
+                            wav_out.setframerate(audio_chunk.sample_rate)
+                            wav_out.setsampwidth(audio_chunk.sample_width)
+                            wav_out.setnchannels(audio_chunk.sample_channels)
+                        wav_out.writeframes(audio_chunk.audio_int16_bytes)
+                except Exception:
+                    # A half-written segment must not pass for a finished one on retry or resume
+                    if wav_out is not None:
+                        wav_out.close()
+                        wav_out = None
+                        segment_file.unlink(missing_ok=True)
+                    raise
+                finally:
+                    if wav_out is not None:
+                        wav_out.close()
+            finally:
+                cpu_seconds = metrics.cpu_meter.stop(cpu_token)
+                metrics.incr("synthesis_cpu_seconds", cpu_seconds)
+                if job is not None:
+                    job.add_segment_cpu(cpu_seconds)
+                    job.segment_finished()
+
+        # Wait for an inference slot in deadline order
+        if job is None:
+            job_key, deadline = "anonymous", time.time() + SLA_TIERS["free"]["base_seconds"]
+        else:
+            job_key, deadline = job.job_id, job.deadline or job.created_at + SLA_TIERS["free"]["base_seconds"]
+        slot = dispatcher.acquire(job_key, deadline)
+        if job is not None:
+            job.track(slot)
+        try:
+            await slot
+        except asyncio.CancelledError:
+            if slot.done() and not slot.cancelled():
+                dispatcher.release(job_key)
+            if job is not None and job.cancelled:
+                raise JobCancelled(job.cancel_reason or "Job cancelled")
+            raise
+
+        try:
+            await run_in_slot(job_key, synthesize, job)
+        except asyncio.CancelledError:
+            # Future was dropped by job.cancel() rather than by our own task being cancelled
+            if job is not None and job.cancelled:
+                raise JobCancelled(job.cancel_reason or "Job cancelled")
+            raise
+
+        segment_throughput.add()
+        return segment_file
+
+    except JobCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"Error synthesizing segment {segment_idx}: {str(e)}")
+        raise
+
+async def synthesize_pcm(text: str, voice: PiperVoice, rate: float, job_key: str, deadline: float) -> tuple:
+    """Synthesize a short text to 16-bit PCM in memory under an inference slot (WebSocket streaming)
+    Returns (pcm_bytes, metered_cpu_seconds)."""
+    def synthesize():
+        cpu_token = metrics.cpu_meter.start()
+        try:
+            syn_config = SynthesisConfig(
+                length_scale=1.0 / rate,
+                noise_scale=0.667,
+                noise_w_scale=0.8
+            )
+            pcm = b"".join(chunk.audio_int16_bytes for chunk in voice.synthesize(text, syn_config=syn_config))
+        finally:
+            cpu_seconds = metrics.cpu_meter.stop(cpu_token)
+            metrics.incr("synthesis_cpu_seconds", cpu_seconds)
+        return pcm, cpu_seconds
+
+    slot = dispatcher.acquire(job_key, deadline)
+    try:
+        await slot
+    except asyncio.CancelledError:
+        if slot.done() and not slot.cancelled():
+            dispatcher.release(job_key)
+        raise
+    return await run_in_slot(job_key, synthesize)
+
+class SegmentFailed(Exception):
+    """A segment could not be synthesized even after retries and re-splitting"""
+
+def resplit_text(text: str) -> list:
+    """Split a failed segment into smaller pieces: by sentence and clause, else into two halves by words"""
+    pieces = [piece for piece in re.split(r'(?<=[.!?,;:])\s+', text) if piece.strip()]
+    if len(pieces) > 1:
+        return pieces
+    words = text.split()
+    if len(words) > 1:
+        middle = len(words) // 2
+        return [" ".join(words[:middle]), " ".join(words[middle:])]
+    return []
+
+def write_silence(wav_path: Path, seconds: float, sample_rate: int):
+    with wave.open(str(wav_path), 'wb') as wav_out:
+        wav_out.setframerate(sample_rate)
+        wav_out.setsampwidth(2)
+        wav_out.setnchannels(1)
+        wav_out.writeframes(b"\x00\x00" * int(seconds * sample_rate))
+
+def concat_wavs(parts: list, wav_path: Path, delete_parts: bool = True):
+    """Join WAV files with identical format into wav_path, copying in blocks so memory stays flat"""
+    with wave.open(str(wav_path), 'wb') as wav_out:
+        for idx, part in enumerate(parts):
+            with wave.open(str(part), 'rb') as wav_in:
+                if idx == 0:
+                    wav_out.setparams(wav_in.getparams())
+                while True:
+                    frames = wav_in.readframes(WAV_COPY_FRAMES)
+                    if not frames:
+                        break
+                    wav_out.writeframes(frames)
+    if delete_parts:
+        for part in parts:
+            part.unlink(missing_ok=True)
+
+async def synthesize_with_retry(text: str, voice: PiperVoice, rate: float, segment_idx: int, temp_dir: Path,
+                                job: Optional[SynthesisJob], attempts: int, errors: list, phoneme_ids: Optional[list] = None) -> Path:
+    """synthesize_audio_segment_fast with exponential backoff between attempts; errors collects what failed"""
+    for attempt in range(attempts):
+        try:
+            return await synthesize_audio_segment_fast(text, voice, rate, segment_idx, temp_dir, job, phoneme_ids)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            errors.append(str(e) or type(e).__name__)
+            if attempt == attempts - 1:
+                raise
+            metrics.incr("segment_retries")
+            logger.warning(f"Segment {segment_idx} attempt {attempt + 1} failed, retrying: {str(e)}")
+            await asyncio.sleep(SEGMENT_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+            if job is not None:
+                job.check_cancelled()
+
+async def synthesize_segment_resilient(
+    text: str,
+    voice: PiperVoice,
+    rate: float,
+    segment_idx: int,
+    temp_dir: Path,
+    job: Optional[SynthesisJob] = None,
+    phoneme_ids: Optional[list] = None
+) -> Path:
+    """Synthesize one segment so that its failure does not fail the whole job
+    Retries with backoff, then synthesizes the segment as smaller pieces; pieces
+    that still fail become silence (SEGMENT_SILENCE_FALLBACK=1) or raise SegmentFailed.
+    What happened is recorded in job.segment_failures."""
+    errors = []
+    failure = {"segment": segment_idx, "text": text[:80], "action": "retried", "silenced_pieces": 0}
+    try:
+        segment_file = await synthesize_with_retry(text, voice, rate, segment_idx, temp_dir, job, SEGMENT_RETRIES + 1, errors, phoneme_ids)
+        if errors and job is not None:
+            job.segment_failures.append({**failure, "attempts": len(errors) + 1, "error": errors[-1]})
+        return segment_file
+    except JobCancelled:
+        raise
+    except Exception:
+        first_error = errors[-1]
+
+    metrics.incr("segment_resplits")
+    failure.update(attempts=len(errors), error=first_error, action="resplit")
+    pieces = resplit_text(text)
+    logger.warning(f"Segment {segment_idx} failed after {len(errors)} attempts, re-splitting into {len(pieces)} pieces: {first_error}")
+
+    part_dir = temp_dir / f"parts_{segment_idx:04d}"
+    part_dir.mkdir(exist_ok=True)
+    parts = []
+    for piece_idx, piece in enumerate(pieces or [text]):
+        try:
+            if not pieces:
+                raise SegmentFailed("Segment cannot be split further")
+            part = await synthesize_with_retry(piece, voice, rate, piece_idx, part_dir, job, 1, [])
+        except JobCancelled:
+            raise
+        except Exception as e:
+            if not SEGMENT_SILENCE_FALLBACK:
+                metrics.incr("segment_failures")
+                failure.update(action="failed", error=f"{first_error}; piece {piece_idx}: {str(e)}")
+                if job is not None:
+                    job.segment_failures.append(failure)
+                raise SegmentFailed(f"Segment {segment_idx} failed: {failure['error']}") from e
+            # Keep the timing of the text we could not say
+            part = part_dir / f"segment_{piece_idx:04d}.wav"
+            await pools.file_io.run(write_silence, part, estimate_duration(piece, rate), voice.config.sample_rate)
+            failure["silenced_pieces"] += 1
+            failure["action"] = "silence"
+            metrics.incr("segment_silenced")
+        parts.append(part)
+
+    segment_file = temp_dir / f"segment_{segment_idx:04d}.wav"
+    await pools.file_io.run(concat_wavs, parts, segment_file)
+    await pools.file_io.run(part_dir.rmdir)
+    if job is not None:
+        job.segment_failures.append(failure)
+    return segment_file
+
+def snapshot() -> dict:
+    """Executor, voice cache and throughput state, read from incrementally kept counters"""
+    return {
+        "executor": {
+            "workers": max_workers,
+            "segments_running": dispatcher.in_flight,
+            "segments_waiting": len(dispatcher.waiters),
+            "saturation": round(dispatcher.in_flight / max_workers, 3),
+            "segments_by_job": dict(dispatcher.job_in_flight)
+        },
+        "pools": pools.snapshot(),
+        "voices": [
+            {"voice": voice_key, "model_bytes": voice_sizes.get(voice_key), "jobs": voice_refcounts.get(voice_key, 0)}
+            for voice_key in list(loaded_voices)
+        ],
+        "cache": {
+            "voice_hit_rate": metrics.hit_rate("voice_cache_lookups"),
+            "voices_index_hit_rate": metrics.hit_rate("voices_index_lookups")
+        },
+        "throughput": {
+            "window_seconds": segment_throughput.window_seconds,
+            "segments_per_second": round(segment_throughput.rate(), 2),
+            "audio_seconds_per_second": round(audio_throughput.rate(), 2)
+        }
+    }
+
+def get_audio_dir() -> Path:
+    """Directory for generated audio files (must be shared by API and worker nodes)"""
+    audio_dir = Path(os.getenv("AUDIO_OUTPUT_DIR", ROOT_DIR / "audio_files"))
+    audio_dir.mkdir(parents=True, exist_ok=True)
+    return audio_dir
+
+def metered_usage(job: SynthesisJob, audio_duration: float) -> dict:
+    """Metered compute of a finished job, as stored in audio_generations and the usage ledger"""
+    return {
+        "cpu_seconds": round(job.cpu_seconds, 3),
+        "segment_cpu_seconds": [round(seconds, 3) for seconds in job.segment_cpu_seconds],
+        "audio_minutes": round(audio_duration / 60, 3)
+    }
+
+def completion_event(audio_id: str, audio_duration: float, generation_time: float, usage: Optional[dict] = None,
+                     segment_failures: Optional[list] = None) -> dict:
+    """SSE 'complete' event for a finished synthesis"""
+    speed = (audio_duration / 60) / generation_time if generation_time > 0 else 0
+    event = {
+        'type': 'complete',
+        'progress': 100,
+        'audio_id': audio_id,
+        'audio_url': f'/audio/download/{audio_id}',
+        'duration': audio_duration,
+        'generation_time': round(generation_time, 1),
+        'speed': round(speed, 2),
+        'message': f'Готово! ({round(audio_duration/60, 1)} мин за {round(generation_time, 1)}с, скорость {round(speed, 1)}x)'
+    }
+    if usage is not None:
+        event['cpu_seconds'] = usage['cpu_seconds']
+        event['audio_minutes'] = usage['audio_minutes']
+    if segment_failures:
+        event['segment_failures'] = segment_failures
+        silenced = sum(1 for failure in segment_failures if failure['action'] == 'silence')
+        if silenced:
+            event['message'] += f'. Фрагментов заменено тишиной: {silenced}'
+    return event
+
+def sla_warning_event(deadline: float, predicted_finish: float) -> dict:
+    """SSE event sent when a job is predicted to finish after its SLA deadline"""
+    overrun = predicted_finish - deadline
+    return {
+        'type': 'sla_warning',
+        'deadline_in': round(deadline - time.time(), 1),
+        'predicted_overrun': round(overrun, 1),
+        'message': f'Генерация может занять больше обычного (примерно на {int(overrun)}с)'
+    }
@@ -0,0 +1,388 @@
+import os
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from dotenv import load_dotenv
+from pathlib import Path
+
+from scheduler import SLA_TIERS, tier_for
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+# MongoDB connection
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(mongo_url)
+db = client[os.environ['DB_NAME']]
+
+# Durable synthesis job queue
+# A job document moves queued -> leased -> completed | failed | cancelled.
+# Workers lease jobs atomically and keep the lease alive with heartbeats;
+# a job whose lease expires (worker crashed) goes back to other workers.
+LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 30))
+HEARTBEAT_SECONDS = float(os.environ.get('JOB_HEARTBEAT_SECONDS', 2))
+MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+
+# Voice affinity: workers report which voices they hold in memory and lease
+# jobs for those voices first. A worker only cold-loads a voice when no live
+# worker that already holds it has a free slot, or the job has waited too long.
+WORKER_STALE_SECONDS = float(os.environ.get('WORKER_STALE_SECONDS', 15))
+AFFINITY_MAX_WAIT_SECONDS = float(os.environ.get('AFFINITY_MAX_WAIT_SECONDS', 10))
+
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+async def ensure_indexes():
+    """Create indexes used by leasing and polling"""
+    await db.synthesis_jobs.create_index([("status", 1), ("deadline", 1), ("priority", -1), ("created_at", 1)])
+    await db.synthesis_jobs.create_index([("status", 1), ("lease_expires_at", 1)])
+    await db.synthesis_jobs.create_index("user_id")
+    await db.synth_workers.create_index("heartbeat_at")
+    # Workers record a finished job's audio once, looked up by job_id
+    await db.audio_generations.create_index("job_id", sparse=True)
+
+async def enqueue_job(
+    job_id: str,
+    user_id: str,
+    is_pro: bool,
+    text: str,
+    voice: str,
+    rate: float,
+    language: str,
+    segments_count: int,
+    estimated_audio_minutes: float,
+    deadline: Optional[float] = None
+) -> dict:
+    """Persist a new synthesis job in queued state
+    deadline is the SLA target completion time (epoch seconds); workers lease earliest deadline first"""
+    now = datetime.now(timezone.utc)
+    if deadline is None:
+        deadline = now.timestamp() + SLA_TIERS[tier_for(is_pro)]["base_seconds"]
+    job_doc = {
+        "_id": job_id,
+        "id": job_id,
+        "user_id": user_id,
+        "is_pro": is_pro,
+        "tier": tier_for(is_pro),
+        "priority": 2 if is_pro else 1,
+        "deadline": datetime.fromtimestamp(deadline, timezone.utc),
+        "text": text,
+        "voice": voice,
+        "rate": rate,
+        "language": language,
+        "segments_count": segments_count,
+        "estimated_audio_minutes": estimated_audio_minutes,
+        "status": "queued",
+        "attempts": 0,
+        "lease_owner": None,
+        "lease_expires_at": None,
+        "cancel_requested": False,
+        "events": [],
+        "result": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now
+    }
+    await db.synthesis_jobs.insert_one(job_doc)
+    return job_doc
+
+async def lease_next_job(worker_id: str, job_filter: Optional[dict] = None, affinity: Optional[str] = None) -> Optional[dict]:
+    """Atomically lease the earliest-deadline queued (or abandoned) job
+    job_filter narrows the candidates (e.g. by voice); affinity is recorded on the job"""
+    now = datetime.now(timezone.utc)
+    query = {
+        "$or": [
+            {"status": "queued"},
+            {"status": "leased", "lease_expires_at": {"$lt": now}}
+        ],
+        "attempts": {"$lt": MAX_ATTEMPTS},
+        "cancel_requested": False
+    }
+    if job_filter:
+        query = {"$and": [query, job_filter]}
+    
+    return await db.synthesis_jobs.find_one_and_update(
+        query,
+        {
+            "$set": {
+                "status": "leased",
+                "lease_owner": worker_id,
+                "lease_expires_at": now + timedelta(seconds=LEASE_SECONDS),
+                "leased_at": now,
+                "affinity": affinity,
+                "updated_at": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("deadline", 1), ("priority", -1), ("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def heartbeat(job_id: str, worker_id: str) -> Optional[dict]:
+    """Extend the lease. Returns None if this worker no longer owns the job"""
+    now = datetime.now(timezone.utc)
+    return await db.synthesis_jobs.find_one_and_update(
+        {"_id": job_id, "status": "leased", "lease_owner": worker_id},
+        {"$set": {"lease_expires_at": now + timedelta(seconds=LEASE_SECONDS), "updated_at": now}},
+        projection={"events": 0, "text": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def push_event(job_id: str, worker_id: str, event: dict) -> bool:
+    """Append a progress event for API nodes to stream"""
+    result = await db.synthesis_jobs.update_one(
+        {"_id": job_id, "status": "leased", "lease_owner": worker_id},
+        {"$push": {"events": event}, "$set": {"updated_at": datetime.now(timezone.utc)}}
+    )
+    return result.modified_count == 1
+
+async def complete_job(job_id: str, worker_id: str, result: dict, event: dict, deadline: Optional[datetime] = None) -> bool:
+    """Mark a leased job as completed with its result and final event"""
+    now = datetime.now(timezone.utc)
+    fields = {"status": "completed", "result": result, "completed_at": now, "updated_at": now}
+    if deadline is not None:
+        if deadline.tzinfo is None:
+            deadline = deadline.replace(tzinfo=timezone.utc)
+        fields["sla_slack_seconds"] = (deadline - now).total_seconds()
+        fields["sla_met"] = now <= deadline
+    update = await db.synthesis_jobs.update_one(
+        {"_id": job_id, "status": "leased", "lease_owner": worker_id},
+        {"$set": fields, "$push": {"events": event}}
+    )
+    return update.modified_count == 1
+
+async def fail_job(job_id: str, worker_id: str, error: str) -> Optional[str]:
+    """Record a failure; the job is re-queued while attempts remain. Returns new status"""
+    now = datetime.now(timezone.utc)
+    doc = await db.synthesis_jobs.find_one_and_update(
+        {"_id": job_id, "status": "leased", "lease_owner": worker_id, "attempts": {"$lt": MAX_ATTEMPTS}},
+        {"$set": {"status": "queued", "lease_owner": None, "lease_expires_at": None, "error": error, "updated_at": now}},
+        projection={"status": 1}
+    )
+    if doc:
+        return "queued"
+
+    update = await db.synthesis_jobs.update_one(
+        {"_id": job_id, "status": "leased", "lease_owner": worker_id},
+        {
+            "$set": {"status": "failed", "error": error, "completed_at": now, "updated_at": now},
+            "$push": {"events": {"type": "error", "message": error}}
+        }
+    )
+    return "failed" if update.modified_count == 1 else None
+
+async def release_lease(job_id: str, worker_id: str) -> bool:
+    """Hand a leased job back to the queue without counting it as an attempt"""
+    update = await db.synthesis_jobs.update_one(
+        {"_id": job_id, "status": "leased", "lease_owner": worker_id},
+        {
+            "$set": {"status": "queued", "lease_owner": None, "lease_expires_at": None, "updated_at": datetime.now(timezone.utc)},
+            "$inc": {"attempts": -1}
+        }
+    )
+    return update.modified_count == 1
+
+async def mark_cancelled(job_id: str, worker_id: str, time_to_free_cpu: Optional[float]) -> bool:
+    """Record that the worker stopped a job after a cancel request"""
+    now = datetime.now(timezone.utc)
+    update = await db.synthesis_jobs.update_one(
+        {"_id": job_id, "status": "leased", "lease_owner": worker_id},
+        {
+            "$set": {"status": "cancelled", "time_to_free_cpu": time_to_free_cpu, "completed_at": now, "updated_at": now},
+            "$push": {"events": {"type": "cancelled", "job_id": job_id, "message": "Генерация отменена"}}
+        }
+    )
+    return update.modified_count == 1
+
+async def request_cancel(job_id: str) -> Optional[dict]:
+    """Cancel a job: queued jobs are cancelled at once, leased ones are flagged for their worker"""
+    now = datetime.now(timezone.utc)
+    doc = await db.synthesis_jobs.find_one_and_update(
+        {"_id": job_id, "status": "queued"},
+        {
+            "$set": {"status": "cancelled", "cancel_requested": True, "cancel_requested_at": now,
+                     "time_to_free_cpu": 0.0, "completed_at": now, "updated_at": now},
+            "$push": {"events": {"type": "cancelled", "job_id": job_id, "message": "Генерация отменена"}}
+        },
+        projection={"events": 0, "text": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if doc:
+        return doc
+
+    return await db.synthesis_jobs.find_one_and_update(
+        {"_id": job_id, "status": "leased", "cancel_requested": False},
+        {"$set": {"cancel_requested": True, "cancel_requested_at": now, "updated_at": now}},
+        projection={"events": 0, "text": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def expire_stale_jobs() -> int:
+    """Settle jobs whose lease expired and that no worker may pick up again"""
+    now = datetime.now(timezone.utc)
+    expired = {"status": "leased", "lease_expires_at": {"$lt": now}}
+
+    error = "Job abandoned by workers too many times"
+    failed = await db.synthesis_jobs.update_many(
+        {**expired, "attempts": {"$gte": MAX_ATTEMPTS}, "cancel_requested": False},
+        {
+            "$set": {"status": "failed", "error": error, "completed_at": now, "updated_at": now},
+            "$push": {"events": {"type": "error", "message": error}}
+        }
+    )
+    cancelled = await db.synthesis_jobs.update_many(
+        {**expired, "cancel_requested": True},
+        {
+            "$set": {"status": "cancelled", "completed_at": now, "updated_at": now},
+            "$push": {"events": {"type": "cancelled", "message": "Генерация отменена"}}
+        }
+    )
+
+    settled = failed.modified_count + cancelled.modified_count
+    if settled:
+        logger.warning(f"Settled {settled} jobs with expired leases")
+    return settled
+
+async def lease_with_affinity(worker_id: str, resident_voices: List[str]) -> Optional[dict]:
+    """Lease a job for a voice this worker already holds, else a cold job nobody warm can take
+    Jobs that have waited longer than AFFINITY_MAX_WAIT_SECONDS go first regardless of voice"""
+    now = datetime.now(timezone.utc)
+    overdue = {"created_at": {"$lt": now - timedelta(seconds=AFFINITY_MAX_WAIT_SECONDS)}}
+    warm = {"voice": {"$in": resident_voices}}
+    cold = {"voice": {"$nin": resident_voices}}
+    
+    job_doc = await lease_next_job(worker_id, {**overdue, **warm}, affinity="warm")
+    if not job_doc:
+        job_doc = await lease_next_job(worker_id, {**overdue, **cold}, affinity="cold")
+    if not job_doc and resident_voices:
+        job_doc = await lease_next_job(worker_id, warm, affinity="warm")
+    if job_doc:
+        return job_doc
+    
+    # Leave voices to live workers that hold them and have a free slot
+    warm_elsewhere = await voices_with_warm_capacity(exclude_worker_id=worker_id)
+    return await lease_next_job(
+        worker_id,
+        {"voice": {"$nin": resident_voices + warm_elsewhere}},
+        affinity="cold"
+    )
+
+async def report_worker(worker_id: str, capacity: int, active_jobs: int, resident_voices: List[str], stats: dict):
+    """Publish a worker's capacity, resident voices and affinity counters"""
+    now = datetime.now(timezone.utc)
+    await db.synth_workers.update_one(
+        {"_id": worker_id},
+        {
+            "$set": {
+                "capacity": capacity,
+                "active_jobs": active_jobs,
+                "resident_voices": resident_voices,
+                "stats": stats,
+                "heartbeat_at": now
+            },
+            "$setOnInsert": {"started_at": now}
+        },
+        upsert=True
+    )
+
+async def remove_worker(worker_id: str):
+    await db.synth_workers.delete_one({"_id": worker_id})
+
+async def list_workers() -> List[dict]:
+    """Workers that reported recently"""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=WORKER_STALE_SECONDS)
+    return await db.synth_workers.find({"heartbeat_at": {"$gte": cutoff}}).to_list(1000)
+
+async def voices_with_warm_capacity(exclude_worker_id: Optional[str] = None) -> List[str]:
+    """Voices resident on a live worker that has a free job slot"""
+    voices = set()
+    for worker in await list_workers():
+        if worker["_id"] == exclude_worker_id:
+            continue
+        if worker.get("active_jobs", 0) < worker.get("capacity", 0):
+            voices.update(worker.get("resident_voices", []))
+    return sorted(voices)
+
+async def get_backlog() -> dict:
+    """Queued work and live worker capacity, for admission control"""
+    queued_jobs = queued_segments = 0
+    cursor = db.synthesis_jobs.aggregate([
+        {"$match": {"status": "queued"}},
+        {"$group": {"_id": None, "jobs": {"$sum": 1}, "segments": {"$sum": "$segments_count"}}}
+    ])
+    async for row in cursor:
+        queued_jobs, queued_segments = row["jobs"], row["segments"]
+    
+    workers = await list_workers()
+    return {
+        "queued_jobs": queued_jobs,
+        "queued_segments": queued_segments,
+        "capacity": sum(w.get("capacity", 0) for w in workers),
+        "free_slots": sum(max(0, w.get("capacity", 0) - w.get("active_jobs", 0)) for w in workers)
+    }
+
+async def get_affinity_stats() -> dict:
+    """Cluster-wide warm/cold lease counts from live workers"""
+    warm = cold = 0
+    for worker in await list_workers():
+        warm += worker.get("stats", {}).get("warm_leases", 0)
+        cold += worker.get("stats", {}).get("cold_leases", 0)
+    total = warm + cold
+    return {
+        "warm_leases": warm,
+        "cold_leases": cold,
+        "hit_rate": round(warm / total, 3) if total else None
+    }
+
+async def get_job(job_id: str, events_from: int = 0) -> Optional[dict]:
+    """Fetch a job without its text, with events starting at index events_from"""
+    return await db.synthesis_jobs.find_one(
+        {"_id": job_id},
+        {"text": 0, "events": {"$slice": [events_from, 1000]}}
+    )
+
+async def get_queue_position(job_doc: dict) -> int:
+    """1-based position of a queued job in lease order"""
+    ahead = await db.synthesis_jobs.count_documents({
+        "status": "queued",
+        "$or": [
+            {"deadline": {"$lt": job_doc["deadline"]}},
+            {"deadline": job_doc["deadline"], "priority": {"$gt": job_doc["priority"]}},
+            {"deadline": job_doc["deadline"], "priority": job_doc["priority"], "created_at": {"$lt": job_doc["created_at"]}}
+        ]
+    })
+    return ahead + 1
+
+async def get_sla_report() -> Dict[str, dict]:
+    """Per-tier SLA attainment over completed jobs"""
+    totals = {}
+    cursor = db.synthesis_jobs.aggregate([
+        {"$match": {"status": "completed", "sla_met": {"$exists": True}}},
+        {"$group": {
+            "_id": "$tier",
+            "completed": {"$sum": 1},
+            "met": {"$sum": {"$cond": ["$sla_met", 1, 0]}},
+            "slack_total": {"$sum": "$sla_slack_seconds"}
+        }}
+    ])
+    async for row in cursor:
+        totals[row["_id"]] = row
+    
+    report = {}
+    for tier in SLA_TIERS:
+        row = totals.get(tier, {})
+        completed = row.get("completed", 0)
+        met = row.get("met", 0)
+        report[tier] = {
+            "completed": completed,
+            "met": met,
+            "missed": completed - met,
+            "attainment": round(met / completed, 3) if completed else None,
+            "avg_slack_seconds": round(row.get("slack_total", 0.0) / completed, 1) if completed else None,
+            "sla": SLA_TIERS[tier]
+        }
+    return report
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# How long a cancel waits for already-running segments to stop before giving up
+CANCEL_DRAIN_TIMEOUT = 30.0
+
+# Recent cancel -> CPU-free latencies (seconds), newest last
+recent_cancel_latencies: deque = deque(maxlen=100)
+
+class JobCancelled(Exception):
+    """Raised inside synthesis code when its job has been cancelled"""
+
+class SynthesisJob:
+    """Control handle for a running synthesis job
+
+    Tracks the executor futures and in-flight segments of one job so that it
+    can be cancelled: queued segments are dropped from the executor, running
+    segments stop at the next sentence boundary.
+    """
+
+    def __init__(self, job_id: str, user_id: str):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.status = "queued"  # queued | running | completed | failed | cancelled
+        self.cancel_reason: Optional[str] = None
+        self.voice_key: Optional[str] = None
+        self.temp_dir: Optional[Path] = None
+        self.created_at = time.time()
+        self.deadline: Optional[float] = None  # SLA target completion, epoch seconds
+        # Request parameters (text, voice, rate, ...) so a drained job can be persisted
+        self.params: dict = {}
+        # Metered CPU time of each finished segment (see metrics.CpuMeter)
+        self.segment_cpu_seconds: List[float] = []
+        # Segments that needed a retry, re-split or silence (see engine.synthesize_segment_resilient)
+        self.segment_failures: List[dict] = []
+
+        # Set from any thread; synthesis workers poll it between sentences
+        self.cancel_event = threading.Event()
+        self.cancel_requested_at: Optional[float] = None
+        self.cpu_freed_at: Optional[float] = None
+
+        self._futures: Set[asyncio.Future] = set()
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self._loop = asyncio.get_event_loop()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    @property
+    def segments_in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def time_to_free_cpu(self) -> Optional[float]:
+        """Seconds between the cancel request and the last running segment stopping"""
+        if self.cancel_requested_at is None or self.cpu_freed_at is None:
+            return None
+        return self.cpu_freed_at - self.cancel_requested_at
+
+    def track(self, future: asyncio.Future):
+        """Register an executor future so cancel() can drop it if not started"""
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled(self.cancel_reason or "Job cancelled")
+
+    def segment_started(self):
+        """Called from the worker thread when a segment begins inference"""
+        with self._in_flight_lock:
+            self._in_flight += 1
+            if self._in_flight == 1:
+                self._loop.call_soon_threadsafe(self._idle.clear)
+
+    def segment_finished(self):
+        """Called from the worker thread when a segment stops, for any reason"""
+        with self._in_flight_lock:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                if self.cancel_event.is_set() and self.cpu_freed_at is None:
+                    self.cpu_freed_at = time.monotonic()
+                self._loop.call_soon_threadsafe(self._idle.set)
+
+    @property
+    def cpu_seconds(self) -> float:
+        return sum(self.segment_cpu_seconds)
+
+    def add_segment_cpu(self, seconds: float):
+        """Called from the worker thread with a segment's metered CPU time"""
+        with self._in_flight_lock:
+            self.segment_cpu_seconds.append(seconds)
+
+    def cancel(self, reason: str = "Cancelled by user") -> bool:
+        """Cancel the job. Returns False if it had already finished or was cancelled"""
+        if self.cancel_event.is_set() or self.status in ("completed", "failed"):
+            return False
+
+        self.cancel_reason = reason
+        self.cancel_requested_at = time.monotonic()
+        self.cancel_event.set()
+        self.status = "cancelled"
+
+        # Executor work items that have not started yet are removed from the
+        # pool's queue by cancelling the future that wraps them
+        cancelled = sum(1 for future in list(self._futures) if future.cancel())
+
+        with self._in_flight_lock:
+            running = self._in_flight
+            if running == 0:
+                self.cpu_freed_at = self.cancel_requested_at
+        dropped = max(0, cancelled - running)
+
+        logger.info(
+            f"Job {self.job_id} cancelled ({reason}): "
+            f"{dropped} queued segments dropped, {running} still running"
+        )
+        return True
+
+    async def wait_idle(self, timeout: float = CANCEL_DRAIN_TIMEOUT) -> bool:
+        """Wait until no segment of this job is running on the executor"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+# Registry of live jobs (queued or running) by job id
+jobs: Dict[str, SynthesisJob] = {}
+
+# Strong references to background tasks so they are not garbage collected mid-run
+_background_tasks: Set[asyncio.Task] = set()
+
+def register_job(job: SynthesisJob) -> SynthesisJob:
+    jobs[job.job_id] = job
+    return job
+
+def get_job(job_id: str) -> Optional[SynthesisJob]:
+    return jobs.get(job_id)
+
+def unregister_job(job_id: str):
+    jobs.pop(job_id, None)
+
+def spawn_task(coro) -> asyncio.Task:
+    """Run a coroutine detached from the (possibly cancelled) request
+
+    Streaming responses are cancelled when the client disconnects, so cleanup
+    that needs to await cannot run inline in the generator's finally block.
+    """
+    task = asyncio.get_event_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def spawn_release(job: SynthesisJob, release: Callable[[SynthesisJob], Awaitable[None]]) -> asyncio.Task:
+    """Run the job's release coroutine in the background and record its cancel latency"""
+    async def _run():
+        try:
+            await release(job)
+        except Exception as e:
+            logger.error(f"Error releasing job {job.job_id}: {str(e)}", exc_info=True)
+        finally:
+            if job.time_to_free_cpu is not None:
+                recent_cancel_latencies.append(job.time_to_free_cpu)
+                logger.info(f"Job {job.job_id} freed CPU {job.time_to_free_cpu:.3f}s after cancel")
+
+    return spawn_task(_run())
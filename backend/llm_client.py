@@ -0,0 +1,448 @@
+"""LLM access for text generation
+
+With LLM_BASE_URL set, requests go to that OpenAI-compatible endpoint
+(/chat/completions) over a shared, pooled httpx client and responses stream
+token by token. Without it, the Emergent integration (LlmChat) is used as
+before; it returns the whole response at once, so "streaming" yields a single
+delta.
+
+Every request has a deadline (LLM_REQUEST_DEADLINE_SECONDS) on top of the
+connect/read timeouts. Chunk and section prompts are self-contained, so a
+failed request is safe to send again: connection errors, timeouts, 429 and 5xx
+are retried with jittered exponential backoff (honouring Retry-After). A
+stream is only retried until its first delta, because those were already
+passed on; chat() retries the whole response.
+
+A circuit breaker stops calling a provider that keeps failing: after
+LLM_BREAKER_FAILURES failed attempts in a row requests fail at once with
+LLMUnavailable, and after LLM_BREAKER_RESET_SECONDS requests are let through
+again (half-open) until one succeeds or fails.
+
+Concurrency is limited adaptively across all requests, see llm_limiter.py.
+
+Hedging (LLM_HEDGE_ENABLED) cuts the tail: when a request's first delta is
+later than the observed LLM_HEDGE_PERCENTILE of time to first token, a
+duplicate goes out, to LLM_HEDGE_MODEL / LLM_HEDGE_BASE_URL if set, and the
+first one to answer is kept while the other is cancelled. Duplicates are
+limited to about LLM_HEDGE_BUDGET of requests and are not sent while requests
+queue for the limiter.
+
+For offline load tests, mock_llm.py is an OpenAI-compatible mock provider;
+llm_fixtures.py records real responses and replays them without the network.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from collections import deque
+from typing import AsyncIterator, Optional
+
+import httpx
+from emergentintegrations.llm.chat import LlmChat, UserMessage
+
+import llm_fixtures
+import metrics
+from llm_limiter import LimiterQueueTimeout, limiter
+
+logger = logging.getLogger(__name__)
+
+LLM_BASE_URL = os.environ.get('LLM_BASE_URL', '').rstrip('/')
+if llm_fixtures.LLM_FIXTURES_MODE == "replay" and not LLM_BASE_URL:
+    LLM_BASE_URL = llm_fixtures.REPLAY_BASE_URL
+LLM_API_KEY = os.environ.get('LLM_API_KEY') or os.environ.get('EMERGENT_LLM_KEY')
+LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'openai')
+LLM_MODEL = os.environ.get('LLM_MODEL', 'gpt-4o-mini')
+
+LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', 50))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('LLM_MAX_KEEPALIVE_CONNECTIONS', 20))
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('LLM_CONNECT_TIMEOUT_SECONDS', 10))
+# Longest gap between two pieces of a streamed response
+LLM_READ_TIMEOUT_SECONDS = float(os.environ.get('LLM_READ_TIMEOUT_SECONDS', 60))
+LLM_REQUEST_DEADLINE_SECONDS = float(os.environ.get('LLM_REQUEST_DEADLINE_SECONDS', 180))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 3))
+LLM_RETRY_BASE_SECONDS = float(os.environ.get('LLM_RETRY_BASE_SECONDS', 0.5))
+LLM_RETRY_MAX_SECONDS = float(os.environ.get('LLM_RETRY_MAX_SECONDS', 8))
+LLM_BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', 5))
+LLM_BREAKER_RESET_SECONDS = float(os.environ.get('LLM_BREAKER_RESET_SECONDS', 30))
+
+LLM_HEDGE_ENABLED = os.environ.get('LLM_HEDGE_ENABLED', 'false').lower() == 'true'
+LLM_HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', 0.9))
+# Extra requests allowed per request (0.1 = at most ~10% duplicates), saved up to LLM_HEDGE_BUDGET_BURST
+LLM_HEDGE_BUDGET = float(os.environ.get('LLM_HEDGE_BUDGET', 0.1))
+LLM_HEDGE_BUDGET_BURST = float(os.environ.get('LLM_HEDGE_BUDGET_BURST', 5))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', 20))
+LLM_HEDGE_BASE_URL = os.environ.get('LLM_HEDGE_BASE_URL', '').rstrip('/')
+LLM_HEDGE_API_KEY = os.environ.get('LLM_HEDGE_API_KEY')
+LLM_HEDGE_MODEL = os.environ.get('LLM_HEDGE_MODEL')
+
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# Failures that mean the provider is overloaded, for the adaptive limiter
+OVERLOAD_KINDS = {"429", "503", "timeout"}
+
+class LLMError(Exception):
+    """The provider failed in a way retries did not fix"""
+
+class LLMTimeout(LLMError):
+    """The request ran past LLM_REQUEST_DEADLINE_SECONDS"""
+
+class LLMUnavailable(LLMError):
+    """The circuit breaker is open; the provider is not called"""
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> half-open -> closed"""
+
+    def __init__(self, failures: int, reset_seconds: float):
+        self.threshold = failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        return self.state != "open"
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info("LLM circuit breaker closed")
+        self.failures = 0
+        self.opened_at = None
+        metrics.set_gauge("llm_breaker_open", 0)
+
+    def failure(self):
+        self.failures += 1
+        # A failed trial in half-open state opens it again right away
+        if self.failures >= self.threshold or self.state == "half_open":
+            if self.state != "open":
+                logger.warning(f"LLM circuit breaker open after {self.failures} failures in a row")
+                metrics.incr("llm_breaker_trips")
+            self.opened_at = time.monotonic()
+            metrics.set_gauge("llm_breaker_open", 1)
+
+class LatencyWindow:
+    """Recent time-to-first-token samples for the hedging threshold"""
+
+    def __init__(self, size: int = 200):
+        self.samples: deque = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class Provider:
+    """One endpoint and model: its own connection pool, breaker and latency window"""
+
+    def __init__(self, name: str, base_url: str, api_key: Optional[str], model: str):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS)
+        self.first_token = LatencyWindow()
+        self._http: Optional[httpx.AsyncClient] = None
+
+    def http_client(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Bearer {self.api_key}"} if self.api_key else {},
+                timeout=httpx.Timeout(LLM_READ_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+                transport=llm_fixtures.wrap(httpx.AsyncHTTPTransport(limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS
+                )))
+            )
+        return self._http
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def snapshot(self) -> dict:
+        return {
+            "endpoint": self.base_url or f"emergent:{LLM_PROVIDER}",
+            "model": self.model,
+            "breaker": self.breaker.state,
+            "consecutive_failures": self.breaker.failures
+        }
+
+primary = Provider("primary", LLM_BASE_URL, LLM_API_KEY, LLM_MODEL)
+if LLM_HEDGE_BASE_URL or LLM_HEDGE_MODEL:
+    hedge_provider = Provider(
+        "hedge", LLM_HEDGE_BASE_URL or LLM_BASE_URL, LLM_HEDGE_API_KEY or LLM_API_KEY, LLM_HEDGE_MODEL or LLM_MODEL
+    )
+else:
+    hedge_provider = primary
+
+class HedgeBudget:
+    """Token bucket: every hedgeable request earns LLM_HEDGE_BUDGET, a hedge costs 1"""
+
+    def __init__(self):
+        self.tokens = 1.0
+
+    def earn(self):
+        self.tokens = min(LLM_HEDGE_BUDGET_BURST, self.tokens + LLM_HEDGE_BUDGET)
+
+    def spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+hedge_budget = HedgeBudget()
+
+async def close():
+    await primary.close()
+    await hedge_provider.close()
+
+def retryable(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUSES
+    if isinstance(error, LLMUnavailable):
+        return False
+    # Transport errors and timeouts; LlmChat raises plain exceptions for provider errors
+    return not isinstance(error, (ValueError, TypeError, KeyError))
+
+def error_kind(error: Exception) -> str:
+    if isinstance(error, httpx.HTTPStatusError):
+        return str(error.response.status_code)
+    if isinstance(error, (LLMTimeout, httpx.TimeoutException, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(error, httpx.TransportError):
+        return "connection"
+    return type(error).__name__
+
+def backoff_delay(attempt: int, error: Exception) -> float:
+    """Full-jitter exponential backoff, at least the provider's Retry-After"""
+    delay = random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+    if isinstance(error, httpx.HTTPStatusError):
+        try:
+            delay = max(delay, float(error.response.headers.get("retry-after", 0)))
+        except ValueError:
+            pass
+    return delay
+
+async def attempt_stream(provider: Provider, system_message: str, user_prompt: str, deadline: float) -> AsyncIterator[str]:
+    """One request to the provider"""
+    if not provider.base_url:
+        chat = LlmChat(
+            api_key=provider.api_key,
+            session_id=str(uuid.uuid4()),
+            system_message=system_message
+        ).with_model(LLM_PROVIDER, provider.model)
+        try:
+            yield await asyncio.wait_for(chat.send_message(UserMessage(text=user_prompt)), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            raise LLMTimeout(f"No LLM response within {LLM_REQUEST_DEADLINE_SECONDS:.0f}s")
+        return
+
+    payload = {
+        "model": provider.model,
+        "stream": True,
+        "messages": [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_prompt}
+        ]
+    }
+    async with provider.http_client().stream("POST", "/chat/completions", json=payload) as response:
+        if response.status_code >= 400:
+            body = (await response.aread()).decode(errors="replace")
+            raise httpx.HTTPStatusError(
+                f"LLM provider returned {response.status_code}: {body[:200]}",
+                request=response.request, response=response
+            )
+        async for line in response.aiter_lines():
+            if time.monotonic() > deadline:
+                raise LLMTimeout(f"LLM response not finished within {LLM_REQUEST_DEADLINE_SECONDS:.0f}s")
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                choices = json.loads(data).get("choices") or []
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping malformed stream line from LLM: {data[:100]}")
+                continue
+            delta = (choices[0].get("delta") or {}).get("content") if choices else None
+            if delta:
+                yield delta
+
+async def provider_stream(provider: Provider, system_message: str, user_prompt: str,
+                          sent: Optional[asyncio.Event] = None) -> AsyncIterator[str]:
+    """Text deltas of one completion from provider as it produces them
+    Each attempt holds a slot of the adaptive limiter (llm_limiter); the deadline starts with
+    the first one, which also sets sent. Failed attempts are retried until the first delta;
+    after it an error ends the stream."""
+    breaker = provider.breaker
+    deadline = None
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            metrics.incr("llm_breaker_rejections")
+            raise LLMUnavailable("Сервис генерации текста временно недоступен. Попробуйте через минуту.")
+        try:
+            await limiter.acquire()
+        except LimiterQueueTimeout:
+            metrics.incr("llm_errors", kind="queue_timeout")
+            raise LLMUnavailable("Слишком много запросов к генерации текста. Попробуйте через несколько минут.")
+        if deadline is None:
+            deadline = time.monotonic() + LLM_REQUEST_DEADLINE_SECONDS
+            if sent is not None:
+                sent.set()
+        started = time.monotonic()
+        first_token = None
+        outcome = "cancelled"
+        try:
+            async for delta in attempt_stream(provider, system_message, user_prompt, deadline):
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                    provider.first_token.add(first_token)
+                yield delta
+            outcome = "ok"
+            breaker.success()
+            return
+        except Exception as e:
+            kind = error_kind(e)
+            outcome = "overload" if kind in OVERLOAD_KINDS else "error"
+            # 429 is the provider pacing us, not failing
+            if retryable(e) and kind != "429":
+                breaker.failure()
+            delay = backoff_delay(attempt, e)
+            if first_token is not None or not retryable(e) or attempt >= LLM_MAX_RETRIES or time.monotonic() + delay > deadline:
+                metrics.incr("llm_errors", kind=kind)
+                raise
+            attempt += 1
+            metrics.incr("llm_retries", kind=kind)
+            logger.warning(f"LLM request failed ({kind}: {str(e)[:200]}), retry {attempt}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+        finally:
+            if outcome == "cancelled" and first_token is None:
+                # Lost a hedge race: at least this slow, and leaving it out would pull the percentile down
+                provider.first_token.add(time.monotonic() - started)
+            limiter.release(outcome, first_token)
+        # Back off without holding a slot
+        await asyncio.sleep(delay)
+
+def hedge_delay() -> Optional[float]:
+    """Seconds to wait for a first delta before hedging; None when hedging is off or not calibrated yet"""
+    if not LLM_HEDGE_ENABLED:
+        return None
+    return primary.first_token.quantile(LLM_HEDGE_PERCENTILE)
+
+async def next_delta(stream: AsyncIterator[str]) -> Optional[str]:
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return None
+
+async def stream_chat(system_message: str, user_prompt: str) -> AsyncIterator[str]:
+    """Text deltas of one completion as they are produced, hedged when the first one is late"""
+    delay = hedge_delay()
+    if delay is None:
+        async for delta in provider_stream(primary, system_message, user_prompt):
+            yield delta
+        return
+
+    hedge_budget.earn()
+    metrics.incr("llm_hedge_eligible")
+    sent = asyncio.Event()
+    primary_stream = provider_stream(primary, system_message, user_prompt, sent)
+    racers = {asyncio.ensure_future(next_delta(primary_stream)): ("primary", primary_stream)}
+    hedged = False
+    winner = None
+    try:
+        # The hedge timer starts once the request has left the limiter queue
+        sent_wait = asyncio.ensure_future(sent.wait())
+        await asyncio.wait([*racers, sent_wait], return_when=asyncio.FIRST_COMPLETED)
+        sent_wait.cancel()
+        done, _ = await asyncio.wait(racers, timeout=delay)
+        if not done:
+            # Duplicates would only add to an overload
+            if limiter.waiting:
+                metrics.incr("llm_hedges_skipped", reason="queue")
+            elif not hedge_budget.spend():
+                metrics.incr("llm_hedges_skipped", reason="budget")
+            else:
+                hedged = True
+                metrics.incr("llm_hedges")
+                logger.info(f"No LLM response after {delay:.1f}s, hedging to {hedge_provider.name} ({hedge_provider.model})")
+                hedge_stream = provider_stream(hedge_provider, system_message, user_prompt)
+                racers[asyncio.ensure_future(next_delta(hedge_stream))] = ("hedge", hedge_stream)
+
+        # The first racer with a delta wins; one that fails leaves the race to the other
+        error = None
+        while racers and winner is None:
+            done, _ = await asyncio.wait(racers, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name, stream = racers.pop(task)
+                if task.exception() is None and winner is None:
+                    winner = (name, stream, task.result())
+                elif task.exception() is not None:
+                    error = task.exception()
+        if winner is None:
+            raise error
+    finally:
+        for task, (_, stream) in racers.items():
+            task.cancel()
+        await asyncio.gather(*racers, return_exceptions=True)
+        for _, stream in racers.values():
+            await stream.aclose()
+
+    name, stream, first = winner
+    if hedged:
+        metrics.incr("llm_hedge_wins", winner=name)
+    if first is None:
+        return
+    yield first
+    async for delta in stream:
+        yield delta
+
+async def chat(system_message: str, user_prompt: str) -> str:
+    """Whole response text of one completion; a stream that breaks off is requested again"""
+    attempt = 0
+    while True:
+        parts = []
+        try:
+            async for delta in stream_chat(system_message, user_prompt):
+                parts.append(delta)
+            return "".join(parts)
+        except Exception as e:
+            # Without any text, stream_chat has already retried
+            if not parts or not retryable(e) or attempt >= LLM_MAX_RETRIES:
+                raise
+            attempt += 1
+            metrics.incr("llm_retries", kind="broken_stream")
+            logger.warning(f"LLM stream broke off after {len(parts)} deltas, requesting it again ({attempt}/{LLM_MAX_RETRIES})")
+            await asyncio.sleep(backoff_delay(attempt, e))
+
+def snapshot() -> dict:
+    counters = metrics.snapshot()["counters"]
+    eligible = counters.get("llm_hedge_eligible", 0)
+    hedges = counters.get("llm_hedges", 0)
+    return {
+        **primary.snapshot(),
+        "concurrency": limiter.snapshot(),
+        "hedging": {
+            "enabled": LLM_HEDGE_ENABLED,
+            "target": hedge_provider.snapshot() if hedge_provider is not primary else "primary",
+            "delay_seconds": round(hedge_delay(), 3) if hedge_delay() is not None else None,
+            "hedge_rate": round(hedges / eligible, 3) if eligible else None,
+            "win_rate": round(counters.get("llm_hedge_wins{winner=hedge}", 0) / hedges, 3) if hedges else None,
+            "budget_tokens": round(hedge_budget.tokens, 2)
+        }
+    }
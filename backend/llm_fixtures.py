@@ -0,0 +1,174 @@
+"""Record / replay of LLM requests, for offline and deterministic runs of the text path
+
+    LLM_FIXTURES_MODE=record LLM_FIXTURES_PATH=fixtures/llm.jsonl   (with a real LLM_BASE_URL)
+    LLM_FIXTURES_MODE=replay LLM_FIXTURES_PATH=fixtures/llm.jsonl   (no network, no key)
+
+Record passes every /chat/completions request through to the provider and
+appends the exchange to the JSON lines file once its response is complete: the
+messages, the status and every line of the response stream with its time since
+the request went out. Replay answers from the file instead of the network, line
+by line at the recorded times multiplied by LLM_FIXTURES_TIME_SCALE (1 - as
+recorded, 0.1 - ten times faster, 0 - at once).
+
+Requests are matched by their messages. Several recordings of one request
+(including 429 / 5xx answers, so retries replay too) are served in turn. A
+request that was never recorded gets a 404, which is not retried: a prompt
+that changed shows up as an error instead of passing silently.
+
+Both are httpx transports under llm_client's provider clients. Recording needs
+an OpenAI-compatible LLM_BASE_URL; the Emergent integration does not use httpx.
+text_bench.py runs the text generation benchmarks on top of this.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional
+
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LLM_FIXTURES_MODE = os.environ.get('LLM_FIXTURES_MODE', 'off').lower()  # off | record | replay
+LLM_FIXTURES_PATH = os.environ.get('LLM_FIXTURES_PATH', 'llm_fixtures.jsonl')
+LLM_FIXTURES_TIME_SCALE = float(os.environ.get('LLM_FIXTURES_TIME_SCALE', 1.0))
+
+# Base URL of the provider clients when replaying without LLM_BASE_URL; never contacted
+REPLAY_BASE_URL = "http://llm-fixtures"
+
+# Response headers worth keeping (the client reads Retry-After)
+KEPT_HEADERS = ("content-type", "retry-after")
+
+def request_messages(body: bytes) -> List[dict]:
+    payload = json.loads(body or b"{}")
+    return [{"role": message.get("role"), "content": message.get("content")} for message in payload.get("messages", [])]
+
+def request_key(messages: List[dict]) -> str:
+    encoded = json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+class RecordingStream(httpx.AsyncByteStream):
+    """Response body passed through, with its lines and their times kept for the fixture"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, record: dict, started: float, recorder: "RecordingTransport"):
+        self.stream = stream
+        self.record = record
+        self.started = started
+        self.recorder = recorder
+        self.complete = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        buffer = b""
+        async for chunk in self.stream:
+            elapsed = round(time.monotonic() - self.started, 4)
+            *lines, buffer = (buffer + chunk).split(b"\n")
+            for line in lines:
+                text = line.decode("utf-8", errors="replace")
+                self.record["lines"].append([elapsed, text])
+                # The client stops reading at [DONE]; what follows it is not needed
+                self.complete = self.complete or text.strip() == "data: [DONE]"
+            yield chunk
+        if buffer:
+            self.record["lines"].append([round(time.monotonic() - self.started, 4), buffer.decode("utf-8", errors="replace")])
+        self.complete = True
+
+    async def aclose(self):
+        await self.stream.aclose()
+        # A response cut short (hedge loser, client gone) would replay as a broken stream
+        if self.complete:
+            self.complete = False
+            self.recorder.save(self.record)
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, path: Path, transport: httpx.AsyncBaseTransport):
+        self.path = path
+        self.transport = transport
+        self.lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        started = time.monotonic()
+        response = await self.transport.handle_async_request(request)
+        messages = request_messages(body)
+        record = {
+            "key": request_key(messages),
+            "model": json.loads(body or b"{}").get("model"),
+            "messages": messages,
+            "status": response.status_code,
+            "headers": {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers},
+            "lines": []
+        }
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=RecordingStream(response.stream, record, started, self),
+            extensions=response.extensions
+        )
+
+    def save(self, record: dict):
+        # One short append per finished response; appends from concurrent requests must not interleave
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        metrics.incr("llm_fixtures_recorded")
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+class ReplayStream(httpx.AsyncByteStream):
+    def __init__(self, lines: List[list], time_scale: float):
+        self.lines = lines
+        self.time_scale = time_scale
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        started = time.monotonic()
+        for at, line in self.lines:
+            # Paced against the start so sleep overhead does not add up
+            delay = started + at * self.time_scale - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield (line + "\n").encode("utf-8")
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    def __init__(self, path: Path, time_scale: float):
+        self.time_scale = time_scale
+        self.fixtures: Dict[str, List[dict]] = defaultdict(list)
+        self.served: Dict[str, int] = defaultdict(int)
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.fixtures[record["key"]].append(record)
+        logger.info(f"Replaying {sum(map(len, self.fixtures.values()))} recorded LLM responses from {path}")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        key = request_key(request_messages(await request.aread()))
+        recordings = self.fixtures.get(key)
+        if not recordings:
+            metrics.incr("llm_fixtures_missing")
+            return httpx.Response(404, json={"error": {"message": f"No recorded LLM response for request {key}"}})
+        record = recordings[self.served[key] % len(recordings)]
+        self.served[key] += 1
+        metrics.incr("llm_fixtures_replayed")
+        return httpx.Response(record["status"], headers=record["headers"], stream=ReplayStream(record["lines"], self.time_scale))
+
+_replay: Optional[ReplayTransport] = None
+
+def wrap(transport: httpx.AsyncBaseTransport) -> httpx.AsyncBaseTransport:
+    """The transport for a provider client in the current LLM_FIXTURES_MODE"""
+    global _replay
+    if LLM_FIXTURES_MODE == "record":
+        return RecordingTransport(Path(LLM_FIXTURES_PATH), transport)
+    if LLM_FIXTURES_MODE == "replay":
+        # One for all providers, so recordings are served in turn across them
+        if _replay is None:
+            _replay = ReplayTransport(Path(LLM_FIXTURES_PATH), LLM_FIXTURES_TIME_SCALE)
+        return _replay
+    return transport
@@ -0,0 +1,168 @@
+"""Adaptive concurrency limit for LLM requests (AIMD)
+
+All LLM requests of this server share one limit on requests in flight. It
+grows by about one per round of successful requests while it is saturated
+(additive increase), and shrinks to LLM_LIMIT_BACKOFF of itself on a 429 / 503
+/ timeout or when the recent time to first token jumps above
+LLM_LATENCY_SPIKE_FACTOR times its long-run baseline (multiplicative decrease,
+at most once per baseline latency). "Recent" is the median of the last few
+requests, so a single outlier (which hedging in llm_client deals with) does
+not shrink the limit. A burst of users then queues here instead of pushing the
+provider into rate limiting that fails everyone's request.
+
+Requests over the limit wait in one queue, Pro before free and first come
+first served within a tier. Whoever generates a text sets a Requester in the
+requester context variable; tasks started from there inherit it, so the
+limiter knows the tier and can publish the generation's queue position
+(textgen turns it into 'queue' events on the SSE stream).
+"""
+import asyncio
+import bisect
+import contextvars
+import itertools
+import logging
+import os
+import statistics
+import time
+from collections import deque
+from typing import List, Optional, Set
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LLM_LIMIT_INITIAL = float(os.environ.get('LLM_LIMIT_INITIAL', 8))
+LLM_LIMIT_MIN = int(os.environ.get('LLM_LIMIT_MIN', 1))
+LLM_LIMIT_MAX = int(os.environ.get('LLM_LIMIT_MAX', 64))
+LLM_LIMIT_BACKOFF = float(os.environ.get('LLM_LIMIT_BACKOFF', 0.5))
+LLM_LATENCY_SPIKE_FACTOR = float(os.environ.get('LLM_LATENCY_SPIKE_FACTOR', 2.0))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('LLM_QUEUE_TIMEOUT_SECONDS', 300))
+
+class LimiterQueueTimeout(Exception):
+    """Waited LLM_QUEUE_TIMEOUT_SECONDS without getting a slot"""
+
+class Requester:
+    """Who an LLM request is for; position is the best queue position of its waiting requests"""
+
+    def __init__(self, is_pro: bool = False):
+        self.is_pro = is_pro
+        self.position: Optional[int] = None
+
+requester: contextvars.ContextVar = contextvars.ContextVar("llm_requester", default=None)
+
+class Waiter:
+    def __init__(self, is_pro: bool, seq: int, owner: Optional[Requester]):
+        self.key = (0 if is_pro else 1, seq)
+        self.owner = owner
+        self.future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other: "Waiter") -> bool:
+        return self.key < other.key
+
+class AdaptiveLimiter:
+    def __init__(self):
+        self.limit = LLM_LIMIT_INITIAL
+        self.in_flight = 0
+        self.waiting: List[Waiter] = []
+        # Requesters that currently have a queue position
+        self.owners: Set[Requester] = set()
+        self.seq = itertools.count()
+        # Time to first token: long-run baseline of healthy requests, and the recent average
+        self.baseline: Optional[float] = None
+        self.recent: deque = deque(maxlen=9)
+        self.last_decrease = 0.0
+
+    @property
+    def capacity(self) -> int:
+        return max(LLM_LIMIT_MIN, int(self.limit))
+
+    async def acquire(self):
+        """Wait for a slot; the caller must release() it"""
+        owner = requester.get()
+        is_pro = owner.is_pro if owner else False
+        if not self.waiting and self.in_flight < self.capacity:
+            self.in_flight += 1
+            self.publish()
+            return
+
+        waiter = Waiter(is_pro, next(self.seq), owner)
+        bisect.insort(self.waiting, waiter)
+        self.publish()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter.future, LLM_QUEUE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise LimiterQueueTimeout(f"No LLM slot within {LLM_QUEUE_TIMEOUT_SECONDS:.0f}s")
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted just as the caller went away
+                self.release("cancelled")
+            raise
+        finally:
+            if waiter in self.waiting:
+                self.waiting.remove(waiter)
+            self.publish()
+            tier = "pro" if is_pro else "free"
+            metrics.incr("llm_queue_wait_seconds", time.monotonic() - started, tier=tier)
+            metrics.incr("llm_queued_requests", tier=tier)
+
+    def release(self, outcome: str, first_token_seconds: Optional[float] = None):
+        """outcome: ok | overload (429, 503, timeout) | error | cancelled"""
+        saturated = self.in_flight >= self.capacity or bool(self.waiting)
+        self.in_flight -= 1
+        if outcome == "overload":
+            self.decrease("overload")
+        elif outcome == "ok" and first_token_seconds is not None:
+            self.recent.append(first_token_seconds)
+            if self.baseline is not None and statistics.median(self.recent) > LLM_LATENCY_SPIKE_FACTOR * self.baseline:
+                self.decrease("latency")
+            elif first_token_seconds <= LLM_LATENCY_SPIKE_FACTOR * (self.baseline or first_token_seconds):
+                self.baseline = first_token_seconds if self.baseline is None else 0.95 * self.baseline + 0.05 * first_token_seconds
+                if saturated:
+                    self.limit = min(LLM_LIMIT_MAX, self.limit + 1 / self.limit)
+        self.grant()
+
+    def decrease(self, reason: str):
+        now = time.monotonic()
+        # One decrease per round trip: the requests already in flight reflect the old limit
+        if now - self.last_decrease < max(self.baseline or 0, 1.0):
+            return
+        self.last_decrease = now
+        old = self.limit
+        self.limit = max(LLM_LIMIT_MIN, self.limit * LLM_LIMIT_BACKOFF)
+        metrics.incr("llm_limit_decreases", reason=reason)
+        logger.warning(f"LLM concurrency limit {old:.1f} -> {self.limit:.1f} ({reason})")
+
+    def grant(self):
+        while self.waiting and self.in_flight < self.capacity:
+            waiter = self.waiting.pop(0)
+            if waiter.future.done():
+                continue
+            self.in_flight += 1
+            waiter.future.set_result(True)
+        self.publish()
+
+    def publish(self):
+        """Queue positions for requesters, and gauges"""
+        positions = {}
+        for idx, waiter in enumerate(self.waiting, start=1):
+            if waiter.owner is not None and waiter.owner not in positions:
+                positions[waiter.owner] = idx
+                waiter.owner.position = idx
+        for owner in self.owners - positions.keys():
+            owner.position = None
+        self.owners = set(positions)
+        metrics.set_gauge("llm_limit", round(self.limit, 2))
+        metrics.set_gauge("llm_in_flight", self.in_flight)
+        metrics.set_gauge("llm_queue_length", len(self.waiting))
+
+    def snapshot(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": len(self.waiting),
+            "queued_pro": sum(1 for waiter in self.waiting if waiter.key[0] == 0),
+            "baseline_first_token_seconds": round(self.baseline, 3) if self.baseline is not None else None
+        }
+
+limiter = AdaptiveLimiter()
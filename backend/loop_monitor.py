@@ -0,0 +1,143 @@
+"""Event-loop lag monitor
+
+A heartbeat coroutine ticks every LOOP_MONITOR_INTERVAL_SECONDS and records how
+late each tick ran. A watchdog thread notices when the ticks stop: once the loop
+has been stuck longer than LOOP_STALL_THRESHOLD_SECONDS it logs the stack of the
+loop thread and the task currently running, i.e. the code blocking the loop.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOP_MONITOR_ENABLED = os.environ.get('LOOP_MONITOR', '1') != '0'
+LOOP_MONITOR_INTERVAL_SECONDS = float(os.environ.get('LOOP_MONITOR_INTERVAL_SECONDS', 0.1))
+LOOP_STALL_THRESHOLD_SECONDS = float(os.environ.get('LOOP_STALL_THRESHOLD_SECONDS', 0.25))
+
+class LoopMonitor:
+    """Measures event-loop lag and reports stalls with the stack that caused them"""
+
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL_SECONDS, threshold: float = LOOP_STALL_THRESHOLD_SECONDS):
+        self.interval = interval
+        self.threshold = threshold
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.last_beat = time.perf_counter()
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.recent_stalls: deque = deque(maxlen=20)
+        # Stack captured by the watchdog while the current stall is still going on
+        self.captured: Optional[dict] = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start monitoring the running loop (call from a coroutine on that loop)"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.perf_counter()
+        self.task = self.loop.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-monitor", daemon=True).start()
+        logger.info(f"Loop monitor started (tick {self.interval}s, stall threshold {self.threshold}s)")
+
+    def stop(self):
+        self.stopping.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            with self.lock:
+                self.last_beat = now
+            self.record(max(0.0, now - expected))
+
+    def record(self, lag: float):
+        self.lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        metrics.set_gauge("loop_lag_seconds", round(lag, 4))
+        with self.lock:
+            captured, self.captured = self.captured, None
+        if lag < self.threshold:
+            return
+
+        self.stalls += 1
+        metrics.incr("loop_stalls")
+        metrics.incr("loop_stall_seconds", lag)
+        stall = {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "seconds": round(lag, 3),
+            "task": captured["task"] if captured else None,
+            "location": captured["location"] if captured else None
+        }
+        self.recent_stalls.append(stall)
+        if captured is None:
+            # Shorter than a watchdog tick: the blocking code already returned
+            logger.warning(f"Event loop stalled for {lag:.3f}s")
+
+    def _watch(self):
+        while not self.stopping.wait(self.interval):
+            with self.lock:
+                stalled_for = time.perf_counter() - self.last_beat - self.interval
+                if stalled_for < self.threshold or self.captured is not None:
+                    continue
+                captured = self.captured = self._capture()
+            logger.warning(
+                f"Event loop blocked for {stalled_for:.3f}s+ in task {captured['task']}:\n"
+                + "".join(captured["stack"])
+            )
+
+    def _capture(self) -> dict:
+        """Stack of the loop thread and the task it is running right now"""
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = traceback.format_stack(frame) if frame is not None else []
+        # Drop the event loop's own frames above the callback it is running
+        for idx in range(len(stack) - 1, -1, -1):
+            if f"asyncio{os.sep}events.py" in stack[idx]:
+                stack = stack[idx + 1:]
+                break
+        try:
+            task = asyncio.current_task(self.loop)
+        except RuntimeError:
+            task = None
+        task_name = None
+        if task is not None:
+            coro = task.get_coro()
+            task_name = f"{task.get_name()} ({getattr(coro, '__qualname__', coro)})"
+        return {
+            "task": task_name,
+            "stack": stack,
+            "location": stack[-1].strip().splitlines()[0] if stack else None
+        }
+
+    def snapshot(self) -> dict:
+        return {
+            "lag_seconds": round(self.lag, 4),
+            "max_lag_seconds": round(self.max_lag, 4),
+            "stall_threshold_seconds": self.threshold,
+            "stalls": self.stalls,
+            "recent_stalls": list(self.recent_stalls)
+        }
+
+monitor = LoopMonitor()
+
+def start():
+    if LOOP_MONITOR_ENABLED:
+        monitor.start()
+
+def snapshot() -> dict:
+    return monitor.snapshot()
@@ -0,0 +1,101 @@
+"""In-process counters and gauges for the admin endpoints
+
+Values are updated where the events happen, so reading them is cheap enough
+to poll every second.
+"""
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Dict, Optional
+
+_lock = threading.Lock()
+counters: Dict[str, float] = defaultdict(float)
+gauges: Dict[str, float] = {}
+
+def series(name: str, labels: dict) -> str:
+    """Series key in Prometheus style: name{label=value,...}"""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+def incr(name: str, value: float = 1, **labels):
+    with _lock:
+        counters[series(name, labels)] += value
+
+def set_gauge(name: str, value: float, **labels):
+    with _lock:
+        gauges[series(name, labels)] = value
+
+def snapshot() -> dict:
+    with _lock:
+        return {"counters": dict(counters), "gauges": dict(gauges)}
+
+def hit_rate(name: str) -> Optional[float]:
+    """Share of name{result=hit} among hits and misses"""
+    with _lock:
+        hits = counters.get(series(name, {"result": "hit"}), 0)
+        misses = counters.get(series(name, {"result": "miss"}), 0)
+    return round(hits / (hits + misses), 3) if hits + misses else None
+
+class RateWindow:
+    """Sum of recent values in one-second buckets, for throughput over the last window_seconds"""
+
+    def __init__(self, window_seconds: int = 60):
+        self.window_seconds = window_seconds
+        self.buckets: deque = deque()  # [second, total]
+        self.lock = threading.Lock()
+
+    def add(self, value: float = 1):
+        second = int(time.time())
+        with self.lock:
+            if self.buckets and self.buckets[-1][0] == second:
+                self.buckets[-1][1] += value
+            else:
+                self.buckets.append([second, value])
+            self._trim(second)
+
+    def rate(self) -> float:
+        """Average per second over the window"""
+        with self.lock:
+            self._trim(int(time.time()))
+            return sum(total for _, total in self.buckets) / self.window_seconds
+
+    def _trim(self, now: int):
+        while self.buckets and self.buckets[0][0] <= now - self.window_seconds:
+            self.buckets.popleft()
+
+class CpuMeter:
+    """Attributes process CPU time to the synthesis segments running at the time
+    ONNX Runtime runs inference on its own thread pool, so the calling thread's
+    CPU time misses most of the work. Instead, the process CPU consumed between
+    any two start/stop events is split evenly across the segments then running."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running: Dict[int, float] = {}
+        self.last = time.process_time()
+        self._tokens = itertools.count()
+
+    def start(self) -> int:
+        with self.lock:
+            self._settle()
+            token = next(self._tokens)
+            self.running[token] = 0.0
+            return token
+
+    def stop(self, token: int) -> float:
+        """CPU-seconds attributed to the segment since start()"""
+        with self.lock:
+            self._settle()
+            return self.running.pop(token)
+
+    def _settle(self):
+        now = time.process_time()
+        if self.running:
+            share = (now - self.last) / len(self.running)
+            for token in self.running:
+                self.running[token] += share
+        self.last = now
+
+cpu_meter = CpuMeter()
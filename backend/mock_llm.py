@@ -0,0 +1,144 @@
+"""OpenAI-compatible mock LLM provider for offline load tests of the text paths
+
+    cd backend && uvicorn mock_llm:app --port 8010
+    LLM_BASE_URL=http://localhost:8010/v1 uvicorn server:app ...
+
+Answers /v1/chat/completions (streaming or not) with filler narration of the
+word count the prompt asks for ("EXACTLY N words"), and outline prompts with
+a JSON outline, so both generation modes run end to end. Timing and failures
+come from the MOCK_LLM_* variables below and can be changed while it runs:
+
+    curl -X POST localhost:8010/mock/config -d '{"tokens_per_second": 200, "error_rate": 0.1}'
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+config = {
+    # Time to the first token, and how much it varies (share of the value, both ways)
+    "latency_ms": float(os.environ.get('MOCK_LLM_LATENCY_MS', 500)),
+    "jitter": float(os.environ.get('MOCK_LLM_JITTER', 0.2)),
+    # Tail: this share of requests waits slow_factor times longer for the first token
+    "slow_rate": float(os.environ.get('MOCK_LLM_SLOW_RATE', 0)),
+    "slow_factor": float(os.environ.get('MOCK_LLM_SLOW_FACTOR', 20)),
+    # One token is one word of the response
+    "tokens_per_second": float(os.environ.get('MOCK_LLM_TOKENS_PER_SECOND', 60)),
+    # Share of requests answered with 503 / 429
+    "error_rate": float(os.environ.get('MOCK_LLM_ERROR_RATE', 0)),
+    "rate_limit_rate": float(os.environ.get('MOCK_LLM_RATE_LIMIT_RATE', 0)),
+    # Requests in progress beyond this get 429, like a provider's concurrency quota (0 - no limit)
+    "max_concurrent": float(os.environ.get('MOCK_LLM_MAX_CONCURRENT', 0)),
+}
+
+WORDS = {
+    "ru": "история время город человек мир дорога утро свет море голос память дом путь ветер лес ночь".split(),
+    "en": "story time city person world road morning light sea voice memory home path wind forest night".split(),
+}
+
+stats = {"requests": 0, "active": 0, "errors": 0}
+
+app = FastAPI(title="Mock LLM")
+
+def jittered(seconds: float) -> float:
+    return max(0.0, seconds * (1 + random.uniform(-config["jitter"], config["jitter"])))
+
+def narration(prompt: str) -> list:
+    """Words (with trailing spaces) of a filler response of the requested length"""
+    match = re.search(r'EXACTLY (\d+) words', prompt)
+    count = int(match.group(1)) if match else 200
+    language = re.search(r' in (\S+?)[\s.]', prompt)
+    vocabulary = WORDS["ru"] if language and language.group(1).lower().startswith("ru") else WORDS["en"]
+    words = []
+    while len(words) < count:
+        sentence = [random.choice(vocabulary) for _ in range(min(random.randint(8, 16), count - len(words)))]
+        sentence[0] = sentence[0].capitalize()
+        sentence[-1] += "."
+        words += sentence
+    return [word + " " for word in words]
+
+def outline(prompt: str) -> list:
+    match = re.search(r'into (\d+) consecutive sections', prompt)
+    sections = int(match.group(1)) if match else 3
+    items = [{"title": f"Часть {idx + 1}", "summary": f"Раздел {idx + 1} продолжает рассказ.", "words": 100} for idx in range(sections)]
+    return [json.dumps(items, ensure_ascii=False)]
+
+def completion_chunk(completion_id: str, model: str, content: str = None, finish: str = None) -> str:
+    delta = {"content": content} if content is not None else {}
+    choice = {"index": 0, "delta": delta, "finish_reason": finish}
+    return "data: " + json.dumps({"id": completion_id, "object": "chat.completion.chunk", "model": model, "choices": [choice]}) + "\n\n"
+
+@app.post("/v1/chat/completions")
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    prompt = body["messages"][-1]["content"]
+    model = body.get("model", "mock")
+    stats["requests"] += 1
+
+    roll = random.random()
+    over_quota = config["max_concurrent"] and stats["active"] >= config["max_concurrent"]
+    if over_quota or roll < config["rate_limit_rate"]:
+        stats["errors"] += 1
+        return JSONResponse({"error": {"message": "Rate limit reached", "type": "rate_limit"}}, status_code=429, headers={"Retry-After": "1"})
+    if roll < config["rate_limit_rate"] + config["error_rate"]:
+        stats["errors"] += 1
+        return JSONResponse({"error": {"message": "Mock provider error", "type": "server_error"}}, status_code=503)
+
+    tokens = outline(prompt) if "Plan a narration" in prompt else narration(prompt)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    first_token = jittered(config["latency_ms"] / 1000)
+    if random.random() < config["slow_rate"]:
+        first_token *= config["slow_factor"]
+    per_token = 1 / config["tokens_per_second"] if config["tokens_per_second"] > 0 else 0
+
+    if not body.get("stream"):
+        stats["active"] += 1
+        try:
+            await asyncio.sleep(first_token + per_token * len(tokens))
+        finally:
+            stats["active"] -= 1
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens).strip()}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": len(tokens), "total_tokens": len(prompt.split()) + len(tokens)}
+        }
+
+    async def stream():
+        stats["active"] += 1
+        try:
+            await asyncio.sleep(first_token)
+            started = time.perf_counter()
+            for idx, token in enumerate(tokens):
+                # Paced against the start so sleep overhead does not add up
+                delay = started + idx * per_token - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield completion_chunk(completion_id, model, token)
+            yield completion_chunk(completion_id, model, finish="stop")
+            yield "data: [DONE]\n\n"
+        finally:
+            stats["active"] -= 1
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+@app.get("/mock/config")
+async def get_config():
+    return {**config, **stats}
+
+@app.post("/mock/config")
+async def update_config(request: Request):
+    changes = await request.json()
+    unknown = set(changes) - set(config)
+    if unknown:
+        return JSONResponse({"error": f"Unknown settings: {', '.join(sorted(unknown))}"}, status_code=400)
+    config.update({key: float(value) for key, value in changes.items()})
+    return config
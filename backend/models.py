@@ -92,6 +92,9 @@ class SubscriptionResponse(BaseModel):
     limit: Optional[int] = None  # None for pro (unlimited)
     can_generate: bool
     expires_at: Optional[datetime] = None
+    quota_mode: Literal["count", "cpu_seconds", "audio_minutes"] = "count"
+    compute_used: Optional[float] = None  # Metered usage in quota_mode units (compute quotas only)
+    compute_limit: Optional[float] = None
 
 class PayPalSubscriptionRequest(BaseModel):
     """PayPal subscription creation request"""
@@ -0,0 +1,350 @@
+"""Staged synthesis pipeline
+
+    segment -> phonemize -> infer -> post-process -> assemble/encode -> store
+
+Each stage runs as its own task(s), connected by bounded asyncio queues, so
+phonemization runs ahead of inference, and segments are appended to the final
+file while later ones are still being synthesized. A full queue blocks the
+stage in front of it (backpressure), which keeps memory bounded regardless of
+text length:
+
+    segment      - feeds segment texts in order; from a list, or from an async iterator
+                   while the text is still being written (the total is then only
+                   known at the end and progress uses an expected count)
+    phonemize    - text to phoneme ids on the phonemize pool (espeak is serialized
+                   by a global lock, so this keeps it out of inference slots)
+    infer        - batch_size workers, each synthesizing one segment at a time with
+                   retries (engine.synthesize_segment_resilient); writes segment_NNNN.wav
+    post-process - restores segment order, reads each segment's PCM and checks its format
+    assemble     - appends PCM to <audio_id>.wav in the job's temp dir on the encoding pool
+    store        - finalizes the file, moves it into the audio dir and measures the real duration
+
+Until the move the file only exists in the temp dir, so a cancelled or failed
+job leaves nothing in the audio dir; cleaning up the temp dir removes it too.
+
+Used by /audio/synthesize, /audio/synthesize-parallel, /audio/synthesize-with-progress,
+/audio/generate-and-speak, audiobooks and synth_worker.py.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import time
+import uuid
+import wave
+from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, List, Optional, Union
+
+import metrics
+import pools
+from engine import (
+    acquire_voice,
+    audio_throughput,
+    download_voice_model,
+    fetch_available_voices,
+    get_audio_duration,
+    release_voice,
+    sla_warning_event,
+    synthesize_segment_resilient,
+    write_silence
+)
+from jobs import SynthesisJob
+
+logger = logging.getLogger(__name__)
+
+# Decoded segments waiting for the assembler; each is up to ~1 minute of PCM
+PIPELINE_PCM_BUFFER_SEGMENTS = int(os.environ.get('PIPELINE_PCM_BUFFER_SEGMENTS', 4))
+
+def phonemize_segment(voice, text: str) -> List[List[int]]:
+    """Phoneme ids for each sentence of text (runs on the phonemize pool)"""
+    return [voice.phonemes_to_ids(phonemes) for phonemes in voice.phonemize(text)]
+
+def read_segment_pcm(segment_file: Path) -> tuple:
+    with wave.open(str(segment_file), 'rb') as wav_in:
+        return wav_in.getparams(), wav_in.readframes(wav_in.getnframes())
+
+def partial_file(temp_dir: Path, audio_id: str) -> Path:
+    """Where <audio_id>.wav is assembled until it is complete"""
+    return temp_dir / f"{audio_id}.wav"
+
+def open_wav_writer(path: Path, params) -> wave.Wave_write:
+    wav_out = wave.open(str(path), 'wb')
+    wav_out.setnchannels(params.nchannels)
+    wav_out.setsampwidth(params.sampwidth)
+    wav_out.setframerate(params.framerate)
+    return wav_out
+
+class SynthesisPipeline:
+    """One job's run through the stages; events() yields its progress events"""
+
+    def __init__(self, job: SynthesisJob, segments: Union[list, AsyncIterable[str]], voice, rate: float, batch_size: int,
+                 final_file: Path, estimated_audio_minutes: float, resume: bool, expected_segments: Optional[int] = None):
+        self.job = job
+        self.segments = segments
+        # None while segments are still arriving from an async iterator
+        self.total: Optional[int] = len(segments) if isinstance(segments, list) else None
+        self.expected_segments = expected_segments or self.total or 1
+        self.received = 0
+        self.voice = voice
+        self.rate = rate
+        self.workers = max(1, min(batch_size, self.total or batch_size))
+        self.final_file = final_file
+        self.assembling_file = partial_file(job.temp_dir, final_file.stem)
+        self.estimated_audio_minutes = estimated_audio_minutes
+        self.resume = resume
+
+        self.texts: asyncio.Queue = asyncio.Queue(maxsize=self.workers)
+        self.phonemized: asyncio.Queue = asyncio.Queue(maxsize=self.workers)
+        self.inferred: asyncio.Queue = asyncio.Queue(maxsize=self.workers)
+        self.pcm: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_PCM_BUFFER_SEGMENTS)
+        self.event_queue: asyncio.Queue = asyncio.Queue()
+
+        self.tasks: List[asyncio.Task] = []
+        self.error: Optional[BaseException] = None
+        self.inferred_count = 0
+        self.infer_workers_done = 0
+        self.assembled_count = 0
+        self.last_progress = -1
+        self.started_at = time.time()
+        self.sla_warned = False
+
+    async def events(self) -> AsyncIterator[dict]:
+        stages = [self.segment_stage(), self.phonemize_stage(), self.postprocess_stage(), self.assemble_stage()]
+        stages += [self.infer_stage() for _ in range(self.workers)]
+        self.tasks = [asyncio.get_running_loop().create_task(self.supervise(stage)) for stage in stages]
+        try:
+            while True:
+                event = await self.event_queue.get()
+                if event['type'] == 'error':
+                    raise self.error
+                yield event
+                if event['type'] == 'result':
+                    return
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def supervise(self, stage):
+        """Run a stage; the first failure stops every other stage and is raised by events()"""
+        try:
+            await stage
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+                self.event_queue.put_nowait({'type': 'error'})
+                for task in self.tasks:
+                    if task is not asyncio.current_task():
+                        task.cancel()
+
+    def segment_file(self, idx: int) -> Path:
+        return self.job.temp_dir / f"segment_{idx:04d}.wav"
+
+    def reusable(self, idx: int) -> bool:
+        # Finished before the job was drained
+        return self.resume and self.segment_file(idx).exists()
+
+    @property
+    def planned_total(self) -> int:
+        """Segment count for progress: exact once known, otherwise the expected count"""
+        if self.total is not None:
+            return self.total
+        return max(self.expected_segments, self.received + 1)
+
+    async def segment_stage(self):
+        if isinstance(self.segments, list):
+            for idx, text in enumerate(self.segments):
+                await self.texts.put((idx, text))
+        else:
+            async for text in self.segments:
+                await self.texts.put((self.received, text))
+                self.received += 1
+            self.total = self.received
+        await self.texts.put(None)
+
+    async def phonemize_stage(self):
+        while True:
+            item = await self.texts.get()
+            if item is None:
+                # One end marker per inference worker
+                for _ in range(self.workers):
+                    await self.phonemized.put(None)
+                return
+            idx, text = item
+            phoneme_ids = None
+            if not self.reusable(idx):
+                self.job.check_cancelled()
+                try:
+                    phoneme_ids = await pools.phonemize.run(phonemize_segment, self.voice, text)
+                except Exception as e:
+                    # Inference phonemizes the text itself (and retries) if this fails
+                    logger.warning(f"Phonemizing segment {idx} failed: {str(e)}")
+            await self.phonemized.put((idx, text, phoneme_ids))
+
+    async def infer_stage(self):
+        while True:
+            item = await self.phonemized.get()
+            if item is None:
+                self.infer_workers_done += 1
+                if self.infer_workers_done == self.workers:
+                    await self.inferred.put(None)
+                return
+            idx, text, phoneme_ids = item
+            if self.reusable(idx):
+                segment_file = self.segment_file(idx)
+            else:
+                segment_file = await synthesize_segment_resilient(
+                    text=text,
+                    voice=self.voice,
+                    rate=self.rate,
+                    segment_idx=idx,
+                    temp_dir=self.job.temp_dir,
+                    job=self.job,
+                    phoneme_ids=phoneme_ids
+                )
+            self.inferred_count += 1
+            self.report_inference()
+            await self.inferred.put((idx, segment_file))
+
+    async def postprocess_stage(self):
+        waiting = {}
+        next_idx = 0
+        while True:
+            item = await self.inferred.get()
+            if item is None:
+                # Every segment has been inferred, so all of them were passed on in order
+                break
+            idx, segment_file = item
+            waiting[idx] = segment_file
+            while next_idx in waiting:
+                self.job.check_cancelled()
+                params, frames = await pools.file_io.run(read_segment_pcm, waiting.pop(next_idx))
+                await self.pcm.put((next_idx, params, frames))
+                next_idx += 1
+        await self.pcm.put(None)
+
+    async def assemble_stage(self):
+        wav_out = None
+        try:
+            while True:
+                item = await self.pcm.get()
+                if item is None:
+                    break
+                idx, params, frames = item
+                if wav_out is None:
+                    wav_out = await pools.file_io.run(open_wav_writer, self.assembling_file, params)
+                elif (params.nchannels, params.sampwidth, params.framerate) != (wav_out.getnchannels(), wav_out.getsampwidth(), wav_out.getframerate()):
+                    raise ValueError(f"Segment {idx} has a different audio format")
+                await pools.encoding.run(wav_out.writeframes, frames)
+                self.assembled_count += 1
+                self.report_assembly()
+        finally:
+            if wav_out is not None:
+                await pools.file_io.run(wav_out.close)
+        await self.store_stage(wav_out is not None)
+
+    async def store_stage(self, has_audio: bool):
+        self.emit({'type': 'stage', 'stage': 'saving', 'message': 'Сохранение файла...', 'progress': 98})
+        if not has_audio:
+            await pools.file_io.run(write_silence, self.assembling_file, 0, self.voice.config.sample_rate)
+        await pools.file_io.run(os.replace, self.assembling_file, self.final_file)
+        audio_duration = await pools.file_io.run(get_audio_duration, self.final_file)
+        audio_throughput.add(audio_duration)
+        self.emit({'type': 'result', 'audio_path': str(self.final_file), 'duration': audio_duration, 'segments': self.total})
+
+    def emit(self, event: dict):
+        self.event_queue.put_nowait(event)
+
+    def report_inference(self):
+        """Progress 5-85% with ETA and speed, sent whenever the percentage moves"""
+        completed = self.inferred_count
+        total = self.planned_total
+        progress = int(5 + (completed / total) * 80)
+        if progress != self.last_progress or completed == self.total:
+            self.last_progress = progress
+            elapsed = time.time() - self.started_at
+            time_per_segment = elapsed / completed
+            eta_seconds = time_per_segment * (total - completed)
+            # Generation speed (audio_minutes per second)
+            audio_generated_minutes = (completed / total) * self.estimated_audio_minutes
+            speed = audio_generated_minutes / elapsed if elapsed > 0 else 0
+            eta_formatted = f"{int(eta_seconds // 60)}м {int(eta_seconds % 60)}с" if eta_seconds >= 60 else f"{int(eta_seconds)}с"
+
+            self.emit({'type': 'progress', 'progress': progress, 'message': f'Сегмент {completed}/{total}', 'stage': 'generating_segments', 'completed_segments': completed, 'total_segments': total, 'eta': eta_formatted, 'speed': round(speed, 2), 'elapsed': round(elapsed, 1)})
+
+            # Warn once if the job is now predicted to finish after its SLA deadline
+            if self.job.deadline and not self.sla_warned and time.time() + eta_seconds > self.job.deadline:
+                self.sla_warned = True
+                self.emit(sla_warning_event(self.job.deadline, time.time() + eta_seconds))
+
+        if completed == self.total:
+            # Most segments are already in the file by now; this stage is the tail
+            self.emit({'type': 'stage', 'stage': 'combining', 'message': 'Объединение аудио...', 'progress': 85})
+            self.report_assembly()
+
+    def report_assembly(self):
+        """Progress 85-98% for the part of the file still being assembled after inference"""
+        if self.total is None or self.inferred_count < self.total:
+            return
+        idx = self.assembled_count
+        if idx and (idx % max(1, self.total // 10) == 0 or idx == self.total):
+            progress = int(85 + (idx / self.total) * 13)
+            self.emit({'type': 'progress', 'progress': progress, 'message': f'Склейка {idx}/{self.total}', 'stage': 'combining'})
+
+async def run_synthesis(
+    job: SynthesisJob,
+    segments: Union[list, AsyncIterable[str]],
+    voice_key: str,
+    rate: float,
+    batch_size: int,
+    audio_dir: Path,
+    audio_id: str,
+    estimated_audio_minutes: float,
+    resume: bool = False,
+    expected_segments: Optional[int] = None
+) -> AsyncIterator[dict]:
+    """Synthesize segments into audio_dir/<audio_id>.wav, yielding progress events
+    The last event has type 'result' and carries the file path, real duration and segment count.
+    job.temp_dir must already exist; the caller cleans it up and releases job.voice_key.
+    With resume, segment files already in job.temp_dir are reused instead of synthesized.
+    segments may be an async iterator of texts still being written; expected_segments then sizes progress."""
+    total_segments = len(segments) if isinstance(segments, list) else expected_segments
+
+    # Stage 1: Load voice model (0-5%)
+    yield {'type': 'stage', 'stage': 'loading_model', 'message': 'Загрузка модели голоса...', 'progress': 0, 'total_segments': total_segments, 'estimated_audio_minutes': round(estimated_audio_minutes, 1)}
+
+    voices_data = await fetch_available_voices()
+    model_path, config_path = await download_voice_model(voice_key, voices_data)
+    voice_obj = await acquire_voice(voice_key, model_path, config_path)
+    job.voice_key = voice_key
+    job.check_cancelled()
+
+    yield {'type': 'progress', 'progress': 5, 'message': 'Модель загружена', 'stage': 'loading_model'}
+
+    # Stage 2: Segments flow through the pipeline (5-98%)
+    yield {'type': 'stage', 'stage': 'generating_segments', 'message': f'Генерация {total_segments} сегментов...', 'progress': 5, 'total_segments': total_segments}
+
+    pipeline = SynthesisPipeline(
+        job, segments, voice_obj, rate, batch_size,
+        audio_dir / f"{audio_id}.wav", estimated_audio_minutes, resume, expected_segments
+    )
+    metrics.incr("pipeline_runs")
+    async for event in pipeline.events():
+        yield event
+
+async def synthesize_to_file(segments: list, voice_key: str, rate: float, batch_size: int,
+                             audio_dir: Path, audio_id: str) -> tuple:
+    """Run the pipeline without progress reporting; returns (audio_path, duration)"""
+    job = SynthesisJob(str(uuid.uuid4()), "anonymous")
+    job.temp_dir = audio_dir / f"temp_{audio_id}"
+    job.temp_dir.mkdir(exist_ok=True)
+    try:
+        async for event in run_synthesis(job, segments, voice_key, rate, batch_size, audio_dir, audio_id, 0.0):
+            if event['type'] == 'result':
+                return Path(event['audio_path']), event['duration']
+    finally:
+        if job.voice_key:
+            release_voice(job.voice_key)
+        await pools.file_io.run(shutil.rmtree, job.temp_dir, True)
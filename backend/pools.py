@@ -0,0 +1,98 @@
+"""Named, separately sized thread pools (bulkheads) for blocking work
+
+    inference - Piper segment synthesis (ONNX Runtime releases the GIL)
+    phonemize - text to phonemes with espeak-ng (serialized by Piper's global lock)
+    file_io   - temp dir cleanup, WAV header reads, voice model downloads
+    encoding  - decoding segments, assembling and exporting the final audio
+
+A burst of encodes or disk work queues in its own pool instead of holding
+threads that inference needs, and the other way round.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class Pool:
+    """ThreadPoolExecutor that counts queued and running tasks and records pool_* metrics"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-pool")
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+
+    def submit(self, fn: Callable, *args, **kwargs) -> asyncio.Future:
+        """Schedule fn on this pool from the event loop
+        The returned future can be cancelled while the task is still queued."""
+        submitted_at = time.perf_counter()
+        state = {"started": False, "dropped": False}
+        with self.lock:
+            self.queued += 1
+
+        def call():
+            with self.lock:
+                if state["dropped"]:
+                    return None
+                state["started"] = True
+                self.queued -= 1
+                self.running += 1
+            started_at = time.perf_counter()
+            metrics.incr("pool_wait_seconds", started_at - submitted_at, pool=self.name)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                metrics.incr("pool_busy_seconds", time.perf_counter() - started_at, pool=self.name)
+                metrics.incr("pool_tasks", pool=self.name)
+
+        def dropped(future: asyncio.Future):
+            if not future.cancelled():
+                return
+            with self.lock:
+                if not state["started"]:
+                    state["dropped"] = True
+                    self.queued -= 1
+                    metrics.incr("pool_tasks_dropped", pool=self.name)
+
+        future = asyncio.get_running_loop().run_in_executor(self.executor, call)
+        future.add_done_callback(dropped)
+        return future
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        return await self.submit(fn, *args, **kwargs)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            queued, running = self.queued, self.running
+        return {
+            "workers": self.workers,
+            "running": running,
+            "queued": queued,
+            "saturation": round(running / self.workers, 3)
+        }
+
+cpu_count = multiprocessing.cpu_count()
+
+# Optimized for Railway 8 vCPU: 2x CPU cores or minimum 16 threads
+inference = Pool("inference", int(os.environ.get('INFERENCE_WORKERS', max(cpu_count * 2, 16))))
+phonemize = Pool("phonemize", int(os.environ.get('PHONEMIZE_WORKERS', 2)))
+file_io = Pool("file_io", int(os.environ.get('FILE_IO_WORKERS', 4)))
+encoding = Pool("encoding", int(os.environ.get('ENCODING_WORKERS', max(cpu_count // 2, 2))))
+
+all_pools: Dict[str, Pool] = {pool.name: pool for pool in (inference, phonemize, file_io, encoding)}
+logger.info("Initialized pools: " + ", ".join(f"{pool.name}={pool.workers}" for pool in all_pools.values()))
+
+def snapshot() -> dict:
+    return {name: pool.snapshot() for name, pool in all_pools.items()}
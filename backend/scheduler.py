@@ -0,0 +1,333 @@
+import asyncio
+import math
+import os
+import time
+from dataclasses import dataclass, field
+from collections import defaultdict
+from itertools import count
+from typing import Dict, List, Optional
+
+# ============================================================================
+# QUEUE MANAGEMENT SYSTEM (Fair Share with Pro Priority)
+# ============================================================================
+
+# Per-tier latency SLAs: a job should finish within base + cost_factor * predicted cost
+SLA_TIERS = {
+    "pro": {
+        "base_seconds": float(os.environ.get('SLA_PRO_BASE_SECONDS', 30)),
+        "cost_factor": float(os.environ.get('SLA_PRO_COST_FACTOR', 1.5))
+    },
+    "free": {
+        "base_seconds": float(os.environ.get('SLA_FREE_BASE_SECONDS', 120)),
+        "cost_factor": float(os.environ.get('SLA_FREE_COST_FACTOR', 3.0))
+    }
+}
+
+# Every running job keeps at least this many segments in flight, whatever its deadline
+SEGMENT_FAIR_FLOOR = int(os.environ.get('SEGMENT_FAIR_FLOOR', 1))
+
+# Wall seconds per segment assumed until real jobs have been measured
+DEFAULT_SEGMENT_SECONDS = float(os.environ.get('DEFAULT_SEGMENT_SECONDS', 1.0))
+
+# What the fair-share rule compares between users: "jobs" (active job count)
+# or "cpu_seconds" (metered CPU time, decaying with FAIR_SHARE_HALF_LIFE_SECONDS)
+FAIR_SHARE_METRIC = os.environ.get('FAIR_SHARE_METRIC', 'jobs')
+FAIR_SHARE_HALF_LIFE_SECONDS = float(os.environ.get('FAIR_SHARE_HALF_LIFE_SECONDS', 600))
+
+# Segments submitted per batch before load scaling (see get_batch_size_for_user)
+PRO_BATCH_SIZE = int(os.environ.get('PRO_BATCH_SIZE', 50))
+FREE_BATCH_SIZE = int(os.environ.get('FREE_BATCH_SIZE', 30))
+
+# Time source for all scheduling decisions; simulator.py swaps in a virtual clock
+clock = time.time
+
+# Admission control: requests whose predicted queue wait exceeds the tier
+# threshold are rejected with 429; past ADMISSION_MAX_QUEUE everyone gets 503.
+# A threshold of 0 disables wait-based shedding for that tier.
+ADMISSION_MAX_WAIT_SECONDS = {
+    "pro": float(os.environ.get('ADMISSION_PRO_MAX_WAIT_SECONDS', 900)),
+    "free": float(os.environ.get('ADMISSION_FREE_MAX_WAIT_SECONDS', 60))
+}
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', 50))
+
+def tier_for(is_pro: bool) -> str:
+    return "pro" if is_pro else "free"
+
+def sla_deadline(is_pro: bool, predicted_cost: float, start_time: float) -> float:
+    """Target completion time (epoch seconds) for a job of this tier and predicted cost"""
+    sla = SLA_TIERS[tier_for(is_pro)]
+    return start_time + sla["base_seconds"] + sla["cost_factor"] * predicted_cost
+
+@dataclass
+class AdmissionDecision:
+    """Outcome of admission control for one request"""
+    admitted: bool
+    status_code: int  # 200, 429 (over tier wait threshold) or 503 (queue full)
+    predicted_wait: float
+    retry_after: int = 0
+
+def admission_decision(is_pro: bool, predicted_wait: float, queue_length: int) -> AdmissionDecision:
+    """Admit or shed a request given its predicted queue wait and the current queue length"""
+    max_wait = ADMISSION_MAX_WAIT_SECONDS[tier_for(is_pro)]
+    if queue_length >= ADMISSION_MAX_QUEUE:
+        return AdmissionDecision(False, 503, predicted_wait, max(1, math.ceil(predicted_wait / max(queue_length, 1))))
+    if max_wait > 0 and predicted_wait > max_wait:
+        # Retry once enough of the backlog has drained to fit under the threshold
+        return AdmissionDecision(False, 429, predicted_wait, max(1, math.ceil(predicted_wait - max_wait)))
+    return AdmissionDecision(True, 200, predicted_wait)
+
+@dataclass
+class QueueJob:
+    """Represents a job in the queue"""
+    job_id: str
+    user_id: str
+    is_pro: bool
+    segments_count: int
+    start_time: float = field(default_factory=lambda: clock())
+    priority_score: float = 0.0
+    predicted_cost: float = 0.0  # Predicted synthesis wall time, seconds
+    deadline: float = 0.0  # Epoch seconds; derived from tier SLA if not given
+    started_at: float = 0.0  # Set when the job leaves the queue
+    
+    def __post_init__(self):
+        # Pro users get 2x priority
+        base_priority = 2.0 if self.is_pro else 1.0
+        # FIFO: jobs that arrived earlier get slight priority boost
+        wait_time_bonus = (clock() - self.start_time) * 0.01
+        self.priority_score = base_priority + wait_time_bonus
+        if not self.deadline:
+            self.deadline = sla_deadline(self.is_pro, self.predicted_cost, self.start_time)
+    
+    @property
+    def tier(self) -> str:
+        return tier_for(self.is_pro)
+
+class QueueManager:
+    """Manages audio generation queue with fair share and priority
+    Jobs are admitted earliest-deadline-first; the fair share rules below act as floors"""
+    def __init__(self, max_concurrent_jobs: int = 3):
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.active_jobs: Dict[str, QueueJob] = {}
+        self.queue: List[QueueJob] = []
+        self.lock = asyncio.Lock()
+        self.user_active_jobs: Dict[str, int] = defaultdict(int)
+        # Moving average of wall seconds per segment, used to predict job cost
+        self.segment_seconds = DEFAULT_SEGMENT_SECONDS
+        # Recently metered CPU-seconds per user: (value, updated_at)
+        self.user_cpu_seconds: Dict[str, tuple] = {}
+        self.sla_stats: Dict[str, dict] = {
+            tier: {"completed": 0, "met": 0, "slack_total": 0.0} for tier in SLA_TIERS
+        }
+        
+    async def add_job(self, job: QueueJob) -> int:
+        """Add job to queue and return position"""
+        async with self.lock:
+            self.queue.append(job)
+            # Earliest deadline first (Pro SLAs are tighter, so Pro still goes ahead of new free jobs)
+            self.queue.sort(key=lambda j: j.deadline)
+            return self.queue.index(job) + 1
+    
+    async def can_start_job(self, job: QueueJob) -> bool:
+        """Check if job can start based on fair share policy"""
+        async with self.lock:
+            # If under max concurrent limit, allow the earliest deadlines
+            free_slots = self.max_concurrent_jobs - len(self.active_jobs)
+            if free_slots > 0:
+                return job not in self.queue or self.queue.index(job) < free_slots
+            
+            if FAIR_SHARE_METRIC == "cpu_seconds":
+                # Fair share by compute: allow users who recently used less CPU than active users on average
+                active_users = list(self.user_active_jobs)
+                avg_cpu_per_user = sum(self.recent_cpu_seconds(u) for u in active_users) / max(len(active_users), 1)
+                if self.recent_cpu_seconds(job.user_id) < avg_cpu_per_user:
+                    return True
+            else:
+                # Fair share: check if this user has fewer active jobs than others
+                user_job_count = self.user_active_jobs[job.user_id]
+                avg_jobs_per_user = len(self.active_jobs) / max(len(self.user_active_jobs), 1)
+                
+                # Allow if user has fewer than average jobs
+                if user_job_count < avg_jobs_per_user:
+                    return True
+            
+            # Pro users can bypass if they have priority
+            if job.is_pro and len(self.active_jobs) < self.max_concurrent_jobs * 1.5:
+                return True
+                
+            return False
+    
+    async def start_job(self, job: QueueJob):
+        """Mark job as started"""
+        async with self.lock:
+            if job in self.queue:
+                self.queue.remove(job)
+            job.started_at = clock()
+            self.active_jobs[job.job_id] = job
+            self.user_active_jobs[job.user_id] += 1
+    
+    async def finish_job(self, job_id: str):
+        """Mark job as finished"""
+        async with self.lock:
+            if job_id in self.active_jobs:
+                job = self.active_jobs.pop(job_id)
+                self.user_active_jobs[job.user_id] = max(0, self.user_active_jobs[job.user_id] - 1)
+                if self.user_active_jobs[job.user_id] == 0:
+                    del self.user_active_jobs[job.user_id]
+    
+    async def remove_job(self, job_id: str) -> bool:
+        """Drop a job whether it is still queued or already active"""
+        async with self.lock:
+            for job in self.queue:
+                if job.job_id == job_id:
+                    self.queue.remove(job)
+                    return True
+        if job_id in self.active_jobs:
+            await self.finish_job(job_id)
+            return True
+        return False
+    
+    async def get_queue_position(self, job_id: str) -> Optional[int]:
+        """Get position in queue (None if active or not found)"""
+        async with self.lock:
+            if job_id in self.active_jobs:
+                return 0  # Active
+            for idx, job in enumerate(self.queue):
+                if job.job_id == job_id:
+                    return idx + 1
+            return None
+    
+    def snapshot(self) -> dict:
+        """Active and queued jobs for the admin engine view"""
+        def describe(job: QueueJob) -> dict:
+            return {
+                "job_id": job.job_id,
+                "user_id": job.user_id,
+                "tier": job.tier,
+                "segments": job.segments_count,
+                "predicted_cost": round(job.predicted_cost, 1),
+                "deadline_in": round(job.deadline - clock(), 1)
+            }
+        return {
+            "max_concurrent_jobs": self.max_concurrent_jobs,
+            "active": [describe(job) for job in list(self.active_jobs.values())],
+            "queued": [describe(job) for job in list(self.queue)],
+            "user_active_jobs": dict(self.user_active_jobs),
+            "segment_seconds": round(self.segment_seconds, 3)
+        }
+    
+    def predict_cost(self, segments_count: int) -> float:
+        """Predicted synthesis wall time in seconds for a job of this size"""
+        return segments_count * self.segment_seconds
+    
+    def predicted_finish(self, job: QueueJob, now: Optional[float] = None) -> float:
+        """Predicted completion time (epoch seconds) of a queued or running job"""
+        now = now or clock()
+        if job.job_id in self.active_jobs:
+            return max(now, job.started_at + job.predicted_cost)
+        
+        # Work ahead of this job drains over max_concurrent_jobs slots
+        ahead = self._active_remaining(now)
+        for queued in self.queue:
+            if queued is job:
+                break
+            ahead += queued.predicted_cost
+        return now + ahead / self.max_concurrent_jobs + job.predicted_cost
+    
+    def predicted_wait(self, is_pro: bool, segments_count: int, now: Optional[float] = None) -> float:
+        """Predicted seconds a new job would wait in the queue before starting"""
+        now = now or clock()
+        deadline = sla_deadline(is_pro, self.predict_cost(segments_count), now)
+        ahead = [j for j in self.queue if j.deadline <= deadline]
+        if len(self.active_jobs) + len(ahead) < self.max_concurrent_jobs:
+            return 0.0
+        work = self._active_remaining(now) + sum(j.predicted_cost for j in ahead)
+        return work / self.max_concurrent_jobs
+    
+    def _active_remaining(self, now: float) -> float:
+        return sum(max(0.0, j.started_at + j.predicted_cost - now) for j in self.active_jobs.values())
+    
+    def record_completion(self, job: QueueJob, generation_time: float, finished_at: Optional[float] = None):
+        """Update the cost model and the SLA attainment counters for a finished job"""
+        self.observe_job_time(job.segments_count, generation_time)
+        slack = job.deadline - (finished_at or clock())
+        stats = self.sla_stats[job.tier]
+        stats["completed"] += 1
+        stats["met"] += 1 if slack >= 0 else 0
+        stats["slack_total"] += slack
+    
+    def observe_job_time(self, segments_count: int, generation_time: float):
+        if segments_count > 0 and generation_time > 0:
+            self.segment_seconds = 0.8 * self.segment_seconds + 0.2 * (generation_time / segments_count)
+    
+    def record_usage(self, user_id: str, cpu_seconds: float):
+        """Add a finished job's metered CPU time to the user's fair-share account"""
+        self.user_cpu_seconds[user_id] = (self.recent_cpu_seconds(user_id) + cpu_seconds, clock())
+    
+    def recent_cpu_seconds(self, user_id: str) -> float:
+        value, updated_at = self.user_cpu_seconds.get(user_id, (0.0, clock()))
+        return value * 0.5 ** ((clock() - updated_at) / FAIR_SHARE_HALF_LIFE_SECONDS)
+    
+    def sla_report(self) -> Dict[str, dict]:
+        """Per-tier SLA attainment since startup"""
+        report = {}
+        for tier, stats in self.sla_stats.items():
+            completed = stats["completed"]
+            report[tier] = {
+                "completed": completed,
+                "met": stats["met"],
+                "missed": completed - stats["met"],
+                "attainment": round(stats["met"] / completed, 3) if completed else None,
+                "avg_slack_seconds": round(stats["slack_total"] / completed, 1) if completed else None,
+                "sla": SLA_TIERS[tier]
+            }
+        return report
+    
+    def get_batch_size_for_user(self, is_pro: bool) -> int:
+        """Calculate batch size based on user tier and current load"""
+        base_batch = PRO_BATCH_SIZE if is_pro else FREE_BATCH_SIZE  # Pro gets larger batches
+        
+        # Reduce batch size if many concurrent jobs
+        active_count = len(self.active_jobs)
+        if active_count > 2:
+            base_batch = int(base_batch * 0.7)
+        if active_count > 4:
+            base_batch = int(base_batch * 0.5)
+            
+        return max(base_batch, 20)  # Minimum 20
+
+class SegmentDispatcher:
+    """Hands executor slots to segments earliest-deadline-first
+    A job with fewer than SEGMENT_FAIR_FLOOR segments in flight is served before
+    deadline order, so jobs with distant deadlines still make progress."""
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.in_flight = 0
+        self.job_in_flight: Dict[str, int] = defaultdict(int)
+        self.waiters: List[tuple] = []  # (deadline, seq, job_key, future)
+        self._seq = count()
+    
+    def acquire(self, job_key: str, deadline: float) -> asyncio.Future:
+        """Future that resolves once the segment may run; cancel it to give up the place"""
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.append((deadline, next(self._seq), job_key, future))
+        self._dispatch()
+        return future
+    
+    def release(self, job_key: str):
+        self.in_flight -= 1
+        self.job_in_flight[job_key] -= 1
+        if self.job_in_flight[job_key] <= 0:
+            del self.job_in_flight[job_key]
+        self._dispatch()
+    
+    def _dispatch(self):
+        while self.in_flight < self.slots:
+            self.waiters = [w for w in self.waiters if not w[3].done()]
+            if not self.waiters:
+                return
+            starving = [w for w in self.waiters if self.job_in_flight.get(w[2], 0) < SEGMENT_FAIR_FLOOR]
+            waiter = min(starving or self.waiters)
+            self.waiters.remove(waiter)
+            self.in_flight += 1
+            self.job_in_flight[waiter[2]] += 1
+            waiter[3].set_result(None)
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks, Depends, Response, Request
+from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks, Depends, Header, Response, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
@@ -7,22 +7,17 @@ import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Literal, Dict
+from typing import AsyncIterable, AsyncIterator, List, Optional, Literal, Dict
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import asyncio
+import time
 import io
-from emergentintegrations.llm.chat import LlmChat, UserMessage
 import json
-import urllib.request
-import wave
-from piper import PiperVoice
-from piper.config import SynthesisConfig
-from pydub import AudioSegment
-import re
 import struct
-from concurrent.futures import ThreadPoolExecutor
-import multiprocessing
+import shutil
+import signal
+import socket
 
 # Import auth and subscription modules
 from auth import (
@@ -34,11 +29,13 @@ from auth import (
     get_google_user_info,
     create_or_update_user,
     create_session,
+    get_user_by_session_token,
     verify_email_token
 )
 from subscription import (
     get_subscription_status,
     check_can_generate,
+    limit_message,
     log_usage,
     create_paypal_subscription,
     cancel_subscription,
@@ -53,6 +50,45 @@ from models import (
     AdminGrantProRequest,
     AdminStatsResponse
 )
+from jobs import (
+    SynthesisJob,
+    JobCancelled,
+    CANCEL_DRAIN_TIMEOUT,
+    register_job,
+    get_job,
+    unregister_job,
+    spawn_release,
+    spawn_task,
+    jobs as live_jobs,
+    recent_cancel_latencies
+)
+from scheduler import QueueJob, QueueManager, sla_deadline, tier_for, admission_decision
+from engine import (
+    estimate_duration,
+    fetch_available_voices,
+    download_voice_model,
+    acquire_voice,
+    release_voice,
+    split_text_into_segments,
+    get_audio_dir,
+    completion_event,
+    sla_warning_event,
+    metered_usage,
+    snapshot as engine_state
+)
+from pipeline import partial_file, run_synthesis, synthesize_to_file
+import audiobook
+import job_queue
+import llm_client
+import textgen
+import text_cache
+import loop_monitor
+import metrics
+import pools
+import speak
+import speech_rate
+import tts_stream
+import usage as usage_ledger
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -73,124 +109,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Piper configuration
-PIPER_MODELS_DIR = ROOT_DIR / "piper_models"
-PIPER_MODELS_DIR.mkdir(exist_ok=True)
-VOICES_CACHE_FILE = PIPER_MODELS_DIR / "voices_cache.json"
-
-# Cache for loaded Piper voices
-loaded_voices: Dict[str, PiperVoice] = {}
-
-# Thread pool executor for maximum parallelization (optimized for Railway 8 vCPU)
-max_workers = max(multiprocessing.cpu_count() * 2, 16)  # Use 2x CPU cores or minimum 16 threads
-executor = ThreadPoolExecutor(max_workers=max_workers)
-logger.info(f"Initialized ThreadPoolExecutor with {max_workers} workers")
-
-# ============================================================================
-# QUEUE MANAGEMENT SYSTEM (Fair Share with Pro Priority)
-# ============================================================================
-import time
-from dataclasses import dataclass, field
-from collections import defaultdict
-
-@dataclass
-class QueueJob:
-    """Represents a job in the queue"""
-    job_id: str
-    user_id: str
-    is_pro: bool
-    segments_count: int
-    start_time: float = field(default_factory=time.time)
-    priority_score: float = 0.0
-    
-    def __post_init__(self):
-        # Pro users get 2x priority
-        base_priority = 2.0 if self.is_pro else 1.0
-        # FIFO: jobs that arrived earlier get slight priority boost
-        wait_time_bonus = (time.time() - self.start_time) * 0.01
-        self.priority_score = base_priority + wait_time_bonus
-
-class QueueManager:
-    """Manages audio generation queue with fair share and priority"""
-    def __init__(self, max_concurrent_jobs: int = 3):
-        self.max_concurrent_jobs = max_concurrent_jobs
-        self.active_jobs: Dict[str, QueueJob] = {}
-        self.queue: List[QueueJob] = []
-        self.lock = asyncio.Lock()
-        self.user_active_jobs: Dict[str, int] = defaultdict(int)
-        
-    async def add_job(self, job: QueueJob) -> int:
-        """Add job to queue and return position"""
-        async with self.lock:
-            self.queue.append(job)
-            # Sort by priority (higher priority first)
-            self.queue.sort(key=lambda j: j.priority_score, reverse=True)
-            return self.queue.index(job) + 1
-    
-    async def can_start_job(self, job: QueueJob) -> bool:
-        """Check if job can start based on fair share policy"""
-        async with self.lock:
-            # If under max concurrent limit, allow
-            if len(self.active_jobs) < self.max_concurrent_jobs:
-                return True
-            
-            # Fair share: check if this user has fewer active jobs than others
-            user_job_count = self.user_active_jobs[job.user_id]
-            avg_jobs_per_user = len(self.active_jobs) / max(len(self.user_active_jobs), 1)
-            
-            # Allow if user has fewer than average jobs
-            if user_job_count < avg_jobs_per_user:
-                return True
-            
-            # Pro users can bypass if they have priority
-            if job.is_pro and len(self.active_jobs) < self.max_concurrent_jobs * 1.5:
-                return True
-                
-            return False
-    
-    async def start_job(self, job: QueueJob):
-        """Mark job as started"""
-        async with self.lock:
-            if job in self.queue:
-                self.queue.remove(job)
-            self.active_jobs[job.job_id] = job
-            self.user_active_jobs[job.user_id] += 1
-    
-    async def finish_job(self, job_id: str):
-        """Mark job as finished"""
-        async with self.lock:
-            if job_id in self.active_jobs:
-                job = self.active_jobs.pop(job_id)
-                self.user_active_jobs[job.user_id] = max(0, self.user_active_jobs[job.user_id] - 1)
-                if self.user_active_jobs[job.user_id] == 0:
-                    del self.user_active_jobs[job.user_id]
-    
-    async def get_queue_position(self, job_id: str) -> Optional[int]:
-        """Get position in queue (None if active or not found)"""
-        async with self.lock:
-            if job_id in self.active_jobs:
-                return 0  # Active
-            for idx, job in enumerate(self.queue):
-                if job.job_id == job_id:
-                    return idx + 1
-            return None
-    
-    def get_batch_size_for_user(self, is_pro: bool) -> int:
-        """Calculate batch size based on user tier and current load"""
-        base_batch = 50 if is_pro else 30  # Pro gets larger batches
-        
-        # Reduce batch size if many concurrent jobs
-        active_count = len(self.active_jobs)
-        if active_count > 2:
-            base_batch = int(base_batch * 0.7)
-        if active_count > 4:
-            base_batch = int(base_batch * 0.5)
-            
-        return max(base_batch, 20)  # Minimum 20
-
 # Global queue manager
 queue_manager = QueueManager(max_concurrent_jobs=3)  # 3 concurrent generations for 8 vCPU
 
+# Where audio synthesis runs: "inline" in this process, or "queue" to hand jobs
+# to synth_worker.py processes through the durable Mongo job queue
+SYNTHESIS_MODE = os.environ.get('SYNTHESIS_MODE', 'inline')
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 0.5))
+# Update interval of the /api/admin/engine/stream feed
+ENGINE_FEED_SECONDS = float(os.environ.get('ENGINE_FEED_SECONDS', 1.0))
+
+# Graceful drain on SIGTERM: stop admitting, let active jobs run for up to
+# DRAIN_TIMEOUT_SECONDS, then persist what is left for the next start
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get('DRAIN_TIMEOUT_SECONDS', 25))
+DRAIN_REASON = "Server draining"
+# Generate-and-speak jobs have no complete text to persist, so draining just stops them
+LIVE_DRAIN_REASON = "Server draining, live job stopped"
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}"
+draining = False
+drain_finished = False
+
 # Models
 class Voice(BaseModel):
     name: str
@@ -203,6 +141,8 @@ class TextGenerateRequest(BaseModel):
     prompt: str
     duration_minutes: int
     language: str = "en-US"
+    mode: Optional[Literal["outline", "sequential"]] = None  # default: TEXT_GENERATION_MODE
+    reuse_cached: bool = False  # answer from text_cache when the same script was generated before
     
 class TextGenerateResponse(BaseModel):
     id: str
@@ -216,6 +156,15 @@ class AudioSynthesizeRequest(BaseModel):
     rate: float = 1.0  # Speed: 0.5 to 2.0 (1.0 = normal)
     language: str = "en-US"
 
+class GenerateAndSpeakRequest(BaseModel):
+    prompt: str
+    duration_minutes: int
+    voice: str
+    rate: float = 1.0
+    language: str = "en-US"
+    mode: Optional[Literal["outline", "sequential"]] = None
+    reuse_cached: bool = False
+
 class AudioSynthesizeResponse(BaseModel):
     id: str
     audio_url: str
@@ -232,186 +181,6 @@ class GenerationHistory(BaseModel):
     language: str
     created_at: str
 
-# Helper function to estimate speaking duration
-def estimate_duration(text: str, rate: float = 1.0) -> float:
-    """Estimate audio duration in seconds. Average: 150 words per minute"""
-    words = len(text.split())
-    
-    # Base: 150 words per minute
-    base_minutes = words / 150
-    adjusted_minutes = base_minutes / rate
-    
-    return adjusted_minutes * 60  # Convert to seconds
-
-# Helper function to calculate target word count
-def calculate_word_count(duration_minutes: int) -> int:
-    """Calculate target word count for desired duration"""
-    return duration_minutes * 150  # 150 words per minute
-
-# Helper function to get audio duration from WAV file
-def get_audio_duration(wav_path: Path) -> float:
-    """Get duration of WAV audio file in seconds"""
-    try:
-        with wave.open(str(wav_path), 'rb') as wav_file:
-            frames = wav_file.getnframes()
-            rate = wav_file.getframerate()
-            duration = frames / float(rate)
-            return duration
-    except Exception as e:
-        logger.error(f"Error getting audio duration: {str(e)}")
-        return 0.0
-
-# Helper function to generate text chunks
-async def generate_text_chunk(
-    prompt: str, 
-    target_words: int, 
-    language: str,
-    is_complete: bool = True,
-    is_first: bool = True,
-    is_last: bool = False,
-    previous_content: Optional[str] = None
-) -> str:
-    """Generate a chunk of text using LLM"""
-    
-    # For short texts (≤5 minutes = ≤750 words): use EXACT target, no compensation
-    # For long texts (>5 minutes): slight compensation (1.1x) because LLM tends to underproduce
-    if target_words <= 750:
-        adjusted_words = target_words  # No compensation for short texts - be precise!
-    else:
-        adjusted_words = int(target_words * 1.1)  # Only 10% extra for long texts
-    
-    # Create LLM chat instance with strict system message
-    chat = LlmChat(
-        api_key=os.environ.get('EMERGENT_LLM_KEY'),
-        session_id=str(uuid.uuid4()),
-        system_message="You are a professional narrator and content writer. Create engaging, natural-flowing narration scripts suitable for audio. Write in a continuous narrative style without section headers or labels. IMPORTANT: Write EXACTLY the requested word count - no more, no less. Be precise with length."
-    ).with_model("openai", "gpt-4o-mini")
-    
-    # Build prompt based on chunk position
-    if is_complete:
-        # Single complete text
-        user_prompt = f"""Create a narration script about: {prompt}
-
-CRITICAL REQUIREMENT: Write EXACTLY {adjusted_words} words in {language}. Not more, not less. This is very important for timing.
-Style: Natural, conversational narration suitable for audio storytelling.
-Write as a continuous narrative without any section labels, headers, or markers like "Introduction", "Conclusion", etc.
-Just tell the story or explain the topic in an engaging, flowing way.
-Be concise and precise - hit exactly {adjusted_words} words."""
-    
-    elif is_first:
-        # First chunk of multi-part text
-        user_prompt = f"""Begin a narration script about: {prompt}
-
-This is the opening of a longer narration. Write EXACTLY {adjusted_words} words in {language}.
-Style: Natural, conversational narration suitable for audio.
-Start the story/topic naturally without labels like "Introduction".
-Write in a continuous narrative flow that will continue in the next part.
-End at a natural pause point, but don't conclude the topic.
-Be precise - exactly {adjusted_words} words."""
-    
-    elif is_last:
-        # Last chunk
-        context_preview = previous_content[-500:] if previous_content and len(previous_content) > 500 else previous_content
-        user_prompt = f"""Continue and conclude the narration about: {prompt}
-
-Previous content ended with: "...{context_preview}"
-
-Write EXACTLY {adjusted_words} words in {language} to conclude this narration.
-Continue naturally from where the previous part ended.
-Wrap up the topic naturally without using labels like "Conclusion" or "In conclusion".
-Just bring the narrative to a natural, satisfying end.
-Be precise - exactly {adjusted_words} words."""
-    
-    else:
-        # Middle chunk
-        context_preview = previous_content[-500:] if previous_content and len(previous_content) > 500 else previous_content
-        user_prompt = f"""Continue the narration about: {prompt}
-
-Previous content ended with: "...{context_preview}"
-
-Write EXACTLY {adjusted_words} words in {language} to continue this narration.
-Continue naturally from where the previous part ended.
-Maintain the same tone and style.
-End at a natural pause point, but don't conclude - there's more to come.
-Be precise - exactly {adjusted_words} words."""
-    
-    # Generate text
-    user_message = UserMessage(text=user_prompt)
-    response = await chat.send_message(user_message)
-    
-    return response.strip()
-
-# Piper helper functions
-async def fetch_available_voices() -> Dict:
-    """Fetch available Piper voices from HuggingFace"""
-    try:
-        if VOICES_CACHE_FILE.exists():
-            with open(VOICES_CACHE_FILE, 'r') as f:
-                return json.load(f)
-        
-        url = "https://huggingface.co/rhasspy/piper-voices/raw/main/voices.json"
-        with urllib.request.urlopen(url, timeout=10) as response:
-            voices_data = json.loads(response.read())
-        
-        # Cache the data
-        with open(VOICES_CACHE_FILE, 'w') as f:
-            json.dump(voices_data, f)
-        
-        return voices_data
-    except Exception as e:
-        logger.error(f"Error fetching voices: {e}")
-        return {}
-
-async def download_voice_model(voice_key: str, voices_data: Dict) -> tuple[Path, Path]:
-    """Download a Piper voice model and config if not already present"""
-    try:
-        voice_info = voices_data.get(voice_key)
-        if not voice_info:
-            raise ValueError(f"Voice {voice_key} not found")
-        
-        # Find .onnx and .onnx.json files in the files dict
-        model_file_path = None
-        config_file_path = None
-        
-        for file_path in voice_info['files'].keys():
-            if file_path.endswith('.onnx.json'):
-                config_file_path = file_path
-            elif file_path.endswith('.onnx'):
-                model_file_path = file_path
-        
-        if not model_file_path or not config_file_path:
-            raise ValueError(f"Model or config file not found for {voice_key}")
-        
-        # Construct URLs
-        model_url = f"https://huggingface.co/rhasspy/piper-voices/resolve/main/{model_file_path}"
-        config_url = f"https://huggingface.co/rhasspy/piper-voices/resolve/main/{config_file_path}"
-        
-        model_path = PIPER_MODELS_DIR / f"{voice_key}.onnx"
-        config_path = PIPER_MODELS_DIR / f"{voice_key}.onnx.json"
-        
-        # Download if not exists
-        if not model_path.exists():
-            logger.info(f"Downloading model for {voice_key}...")
-            urllib.request.urlretrieve(model_url, model_path)
-            logger.info(f"Model downloaded: {model_path}")
-        
-        if not config_path.exists():
-            logger.info(f"Downloading config for {voice_key}...")
-            urllib.request.urlretrieve(config_url, config_path)
-            logger.info(f"Config downloaded: {config_path}")
-        
-        return model_path, config_path
-    except Exception as e:
-        logger.error(f"Error downloading voice model: {e}")
-        raise
-
-def get_or_load_voice(voice_key: str, model_path: Path, config_path: Path) -> PiperVoice:
-    """Get a cached voice or load it"""
-    if voice_key not in loaded_voices:
-        logger.info(f"Loading voice: {voice_key}")
-        loaded_voices[voice_key] = PiperVoice.load(str(model_path), str(config_path))
-    return loaded_voices[voice_key]
-
 @api_router.get("/")
 async def root():
     return {"message": "Text-to-Speech API"}
@@ -626,6 +395,85 @@ async def get_admin_stats(admin_user: User = Depends(require_admin)):
         logger.error(f"Error getting stats: {str(e)}")
         raise HTTPException(status_code=500, detail="Error fetching statistics")
 
+@api_router.get("/admin/workers")
+async def get_synthesis_workers(admin_user: User = Depends(require_admin)):
+    """Live synthesis workers, their resident voices and voice-affinity hit rate"""
+    try:
+        workers = []
+        for worker in await job_queue.list_workers():
+            stats = worker.get("stats", {})
+            leases = stats.get("warm_leases", 0) + stats.get("cold_leases", 0)
+            workers.append({
+                "worker_id": worker["_id"],
+                "capacity": worker.get("capacity", 0),
+                "active_jobs": worker.get("active_jobs", 0),
+                "resident_voices": worker.get("resident_voices", []),
+                "warm_leases": stats.get("warm_leases", 0),
+                "cold_leases": stats.get("cold_leases", 0),
+                "affinity_hit_rate": round(stats.get("warm_leases", 0) / leases, 3) if leases else None,
+                "heartbeat_at": worker["heartbeat_at"].isoformat()
+            })
+        
+        return {"workers": workers, "affinity": await job_queue.get_affinity_stats()}
+        
+    except Exception as e:
+        logger.error(f"Error getting workers: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error fetching workers")
+
+@api_router.get("/admin/sla")
+async def get_sla_report(admin_user: User = Depends(require_admin)):
+    """Per-tier SLA attainment for synthesis jobs"""
+    try:
+        if SYNTHESIS_MODE == "queue":
+            tiers = await job_queue.get_sla_report()
+        else:
+            tiers = queue_manager.sla_report()
+        return {"mode": SYNTHESIS_MODE, "tiers": tiers}
+        
+    except Exception as e:
+        logger.error(f"Error getting SLA report: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error fetching SLA report")
+
+def engine_snapshot() -> dict:
+    """Queue and engine state from incrementally maintained counters; cheap enough to poll every second"""
+    cancel_latencies = list(recent_cancel_latencies)
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "mode": SYNTHESIS_MODE,
+        "queue": queue_manager.snapshot(),
+        "jobs": {
+            "live": len(live_jobs),
+            "avg_time_to_free_cpu": round(sum(cancel_latencies) / len(cancel_latencies), 3) if cancel_latencies else None
+        },
+        **engine_state(),
+        "event_loop": loop_monitor.snapshot(),
+        "streaming": tts_stream.snapshot(),
+        "llm": llm_client.snapshot(),
+        "text_cache": text_cache.snapshot(),
+        "speech_rate": speech_rate.snapshot(),
+        "metrics": metrics.snapshot()
+    }
+
+@api_router.get("/admin/engine")
+async def get_engine_snapshot(admin_user: User = Depends(require_admin)):
+    """Live view of the synthesis queue and engine"""
+    return engine_snapshot()
+
+@api_router.get("/admin/engine/stream")
+async def stream_engine_snapshot(admin_user: User = Depends(require_admin)):
+    """SSE feed of the engine snapshot every ENGINE_FEED_SECONDS"""
+    async def generate_snapshots():
+        while True:
+            yield f"data: {json.dumps(engine_snapshot())}\n\n"
+            await asyncio.sleep(ENGINE_FEED_SECONDS)
+    
+    return StreamingResponse(generate_snapshots(), media_type="text/event-stream")
+
+@api_router.get("/admin/metrics")
+async def get_metrics(admin_user: User = Depends(require_admin)):
+    """In-process counters and gauges (admission decisions, ...)"""
+    return metrics.snapshot()
+
 @api_router.post("/admin/grant-pro")
 async def admin_grant_pro(
     request: AdminGrantProRequest,
@@ -701,15 +549,130 @@ async def get_voices():
         logger.error(f"Error fetching voices: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching voices: {str(e)}")
 
+# Text generations are saved while they are written: the text_generations document
+# is created with status "generating", gets the plan and every finished chunk, and
+# is completed with the whole text. An interrupted one (failed chunk, client gone)
+# is resumed by id from its first missing chunk without charging the quota again.
+def new_text_generation(text_id: str, user_id: str, prompt: str, language: str, duration_minutes: int,
+                        mode: Optional[str], voice: Optional[str] = None, rate: float = 1.0) -> dict:
+    return {
+        "id": text_id,
+        "user_id": user_id,
+        "text": "",
+        "prompt": prompt,
+        "language": language,
+        "word_count": 0,
+        "duration_minutes": duration_minutes,
+        "target_words": textgen.calculate_word_count(duration_minutes, language, voice, rate),
+        "mode": mode,
+        "status": "generating",
+        "chunks": {},
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+async def get_own_generation(text_id: str, user: User) -> dict:
+    generation = await db.text_generations.find_one({"id": text_id}, {"_id": 0})
+    if not generation:
+        raise HTTPException(status_code=404, detail="Text generation not found")
+    if generation["user_id"] != user.id and not user.is_admin:
+        raise HTTPException(status_code=403, detail="Not allowed to access this text generation")
+    return generation
+
+def resume_state(generation: dict) -> dict:
+    """What textgen.generate_script needs to continue a saved generation"""
+    return {
+        "plan": generation.get("plan"),
+        "chunks": {int(section): text for section, text in (generation.get("chunks") or {}).items()}
+    }
+
+async def saved_script(text_id: str, events: AsyncIterator[dict]) -> AsyncIterator[dict]:
+    """Script events, with 'plan' and 'chunk' saved to the generation instead of passed on"""
+    async for event in events:
+        if event['type'] == 'plan':
+            plan = {key: value for key, value in event.items() if key != 'type'}
+            await db.text_generations.update_one({"id": text_id}, {"$set": {"plan": plan}})
+        elif event['type'] == 'chunk':
+            await db.text_generations.update_one({"id": text_id}, {"$set": {f"chunks.{event['section']}": event['text']}})
+        else:
+            yield event
+
+def script_for(generation: dict, stream: bool, is_pro: bool, cached: Optional[dict] = None,
+               trim: bool = True) -> AsyncIterator[dict]:
+    """Events of a new, cached or resumed generation"""
+    if cached:
+        return text_cache.replay(cached, stream)
+    resume = resume_state(generation) if generation.get("plan") else None
+    return saved_script(generation["id"], textgen.generate_script(
+        generation["prompt"], generation["target_words"], generation["language"], generation.get("mode"),
+        stream, is_pro, resume, trim
+    ))
+
+async def complete_text_generation(generation: dict, text: str, cached: Optional[dict] = None) -> int:
+    """Save the finished text; returns its word count"""
+    word_count = len(text.split())
+    done = {"text": text, "word_count": word_count, "status": "complete"}
+    if cached:
+        done["cached_from"] = cached["generation_id"]
+    await db.text_generations.update_one({"id": generation["id"]}, {"$set": done, "$unset": {"chunks": ""}})
+    if not cached:
+        await text_cache.store(generation["prompt"], generation["language"], generation["duration_minutes"], text, generation["id"])
+    return word_count
+
+def sse_message(event: dict, text_id: Optional[str] = None) -> str:
+    """SSE message; with the generation id as event id, an EventSource that reconnects resumes it"""
+    if text_id:
+        return f"id: {text_id}\ndata: {json.dumps(event)}\n\n"
+    return f"data: {json.dumps(event)}\n\n"
+
+async def text_progress_messages(generation: dict, stream: bool, is_pro: bool,
+                                 cached: Optional[dict] = None) -> AsyncIterator[str]:
+    text_id = generation["id"]
+    try:
+        if generation.get("status") == "complete":
+            generated_text = generation["text"]
+        else:
+            done = len(generation.get("chunks") or {})
+            info_msg = f'Генерация текста ({generation["target_words"]} слов)'
+            yield sse_message({'type': 'info', 'message': info_msg, 'progress': 0, 'text_id': text_id, 'resumed_chunks': done}, text_id)
+            
+            async for event in script_for(generation, stream, is_pro, cached):
+                if event['type'] == 'result':
+                    generated_text = event['text']
+                else:
+                    yield sse_message(event, text_id)
+            
+            await complete_text_generation(generation, generated_text, cached)
+        
+        word_count = len(generated_text.split())
+        estimated_duration = estimate_duration(generated_text, language=generation["language"])
+        
+        # Send completion
+        yield sse_message({'type': 'complete', 'progress': 100, 'text_id': text_id, 'text': generated_text, 'word_count': word_count, 'estimated_duration': estimated_duration}, text_id)
+        
+    except Exception as e:
+        logger.error(f"Error in SSE text generation {text_id}: {str(e)}", exc_info=True)
+        yield sse_message({'type': 'error', 'message': str(e), 'text_id': text_id, 'resumable': True}, text_id)
+
 # Text generation with progress tracking via SSE
 @api_router.get("/text/generate-with-progress")
 async def generate_text_with_progress(
     prompt: str,
     duration_minutes: int,
     language: str = "en-US",
+    mode: Optional[Literal["outline", "sequential"]] = None,
+    stream: bool = True,
+    reuse_cached: bool = False,
+    last_event_id: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user)
 ):
-    """Generate text with real-time progress updates via SSE (requires auth)"""
+    """Generate text with real-time progress updates via SSE (requires auth)
+    With stream, the text arrives while it is written as 'delta' events {section, text};
+    joining each section's deltas in section order gives the text of the final 'complete' event.
+    With reuse_cached, a script generated before for the same request is returned instead.
+    The first event has the text_id; a reconnect with it as Last-Event-ID (as EventSource
+    does) continues that generation, like GET /text/generations/{text_id}/resume."""
+    if last_event_id:
+        return await resume_text_generation_stream(last_event_id, stream, current_user)
     
     async def generate_progress():
         try:
@@ -717,95 +680,65 @@ async def generate_text_with_progress(
             can_generate_info = await check_can_generate(current_user.id)
             
             if not can_generate_info["can_generate"]:
-                error_msg = f'Достигнут дневной лимит ({can_generate_info["limit"]} генераций). Обновитесь до Pro для безлимитного доступа.'
-                yield f"data: {json.dumps({'type': 'error', 'message': error_msg})}\n\n"
+                error_msg = limit_message(can_generate_info)
+                yield sse_message({'type': 'error', 'message': error_msg})
                 return
             
             # Log usage
             await log_usage(current_user.id, "text_generation")
             
-            text_id = str(uuid.uuid4())
-            target_words = calculate_word_count(duration_minutes)
-            chunk_size = 1200
-            
-            info_msg = f'Генерация текста ({target_words} слов)'
-            yield f"data: {json.dumps({'type': 'info', 'message': info_msg, 'progress': 0})}\n\n"
-            
-            if target_words <= chunk_size:
-                # Short text
-                yield f"data: {json.dumps({'type': 'progress', 'progress': 50, 'message': 'Генерация текста...'})}\n\n"
-                
-                generated_text = await generate_text_chunk(
-                    prompt, 
-                    target_words, 
-                    language, 
-                    is_complete=True
-                )
-                
-                yield f"data: {json.dumps({'type': 'progress', 'progress': 100, 'message': 'Текст готов'})}\n\n"
-            else:
-                # Long text with chunks
-                num_chunks = (target_words + chunk_size - 1) // chunk_size
-                chunks = []
-                
-                yield f"data: {json.dumps({'type': 'info', 'message': f'Генерация {num_chunks} частей', 'progress': 0})}\n\n"
-                
-                for i in range(num_chunks):
-                    remaining_words = target_words - sum(len(chunk.split()) for chunk in chunks)
-                    chunk_words = min(chunk_size, remaining_words)
-                    
-                    if chunk_words <= 0:
-                        break
-                    
-                    is_first = (i == 0)
-                    is_last = (i == num_chunks - 1)
-                    
-                    chunk_text = await generate_text_chunk(
-                        prompt,
-                        chunk_words,
-                        language,
-                        is_complete=False,
-                        is_first=is_first,
-                        is_last=is_last,
-                        previous_content=" ".join(chunks) if chunks else None
-                    )
-                    
-                    chunks.append(chunk_text)
-                    progress = int(((i + 1) / num_chunks) * 100)
-                    
-                    yield f"data: {json.dumps({'type': 'progress', 'progress': progress, 'message': f'Часть {i+1}/{num_chunks}'})}\n\n"
-                
-                generated_text = " ".join(chunks)
-            
-            word_count = len(generated_text.split())
-            estimated_duration = estimate_duration(generated_text)
-            
-            # Save to database
-            generation_doc = {
-                "id": text_id,
-                "user_id": current_user.id,
-                "text": generated_text,
-                "prompt": prompt,
-                "language": language,
-                "word_count": word_count,
-                "duration_minutes": duration_minutes,
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }
-            
-            await db.text_generations.insert_one(generation_doc)
-            
-            # Send completion
-            yield f"data: {json.dumps({'type': 'complete', 'progress': 100, 'text_id': text_id, 'text': generated_text, 'word_count': word_count, 'estimated_duration': estimated_duration})}\n\n"
-            
+            subscription = await get_subscription_status(current_user.id)
+            generation = new_text_generation(str(uuid.uuid4()), current_user.id, prompt, language, duration_minutes, mode)
+            await db.text_generations.insert_one({**generation})
+            cached = await text_cache.lookup(prompt, language, duration_minutes) if reuse_cached else None
         except Exception as e:
             logger.error(f"Error in SSE text generation: {str(e)}", exc_info=True)
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+            yield sse_message({'type': 'error', 'message': str(e)})
+            return
+        
+        async for message in text_progress_messages(generation, stream, subscription.tier == "pro", cached):
+            yield message
     
     return StreamingResponse(generate_progress(), media_type="text/event-stream")
 
+@api_router.get("/text/generations/{text_id}/resume")
+async def resume_text_generation_stream(text_id: str, stream: bool = True, current_user: User = Depends(get_current_user)):
+    """Continue an interrupted generation via SSE from its first missing chunk (same events as
+    /text/generate-with-progress; finished chunks come first as deltas). Does not count against the quota."""
+    generation = await get_own_generation(text_id, current_user)
+    subscription = await get_subscription_status(current_user.id)
+    return StreamingResponse(
+        text_progress_messages(generation, stream, subscription.tier == "pro"),
+        media_type="text/event-stream"
+    )
+
+async def collect_text(generation: dict, is_pro: bool, cached: Optional[dict] = None) -> TextGenerateResponse:
+    """Run a generation to the end for the non-streaming endpoints"""
+    if generation.get("status") == "complete":
+        generated_text = generation["text"]
+    else:
+        async for event in script_for(generation, False, is_pro, cached):
+            if event['type'] == 'result':
+                generated_text = event['text']
+        await complete_text_generation(generation, generated_text, cached)
+    
+    word_count = len(generated_text.split())
+    estimated_duration = estimate_duration(generated_text, language=generation["language"])
+    
+    logger.info(f"Generated text: {word_count} words, estimated duration: {estimated_duration:.1f}s")
+    
+    return TextGenerateResponse(
+        id=generation["id"],
+        text=generated_text,
+        word_count=word_count,
+        estimated_duration=estimated_duration
+    )
+
 @api_router.post("/text/generate", response_model=TextGenerateResponse)
 async def generate_text(request: TextGenerateRequest, current_user: User = Depends(get_current_user)):
-    """Generate text based on prompt and duration using LLM (requires auth)"""
+    """Generate text based on prompt and duration using LLM (requires auth)
+    If it fails part way, the error detail has the text_id for POST /text/generations/{text_id}/resume."""
+    generation = None
     try:
         # Check if user can generate
         can_generate_info = await check_can_generate(current_user.id)
@@ -813,158 +746,274 @@ async def generate_text(request: TextGenerateRequest, current_user: User = Depen
         if not can_generate_info["can_generate"]:
             raise HTTPException(
                 status_code=429, 
-                detail=f'Достигнут дневной лимит ({can_generate_info["limit"]} генераций). Обновитесь до Pro для безлимитного доступа.'
+                detail=limit_message(can_generate_info)
             )
         
         # Log usage
         await log_usage(current_user.id, "text_generation")
         
-        # Calculate target word count
-        target_words = calculate_word_count(request.duration_minutes)
-        
-        # For long texts, generate in chunks to avoid LLM token limits
-        # Each chunk targets ~1200 words (LLM can handle this comfortably)
-        chunk_size = 1200
-        
-        if target_words <= chunk_size:
-            # Short text - generate in one go
-            generated_text = await generate_text_chunk(
-                request.prompt, 
-                target_words, 
-                request.language, 
-                is_complete=True
-            )
-        else:
-            # Long text - generate in multiple chunks
-            num_chunks = (target_words + chunk_size - 1) // chunk_size  # Ceiling division
-            chunks = []
-            
-            for i in range(num_chunks):
-                # Calculate words for this chunk
-                remaining_words = target_words - sum(len(chunk.split()) for chunk in chunks)
-                chunk_words = min(chunk_size, remaining_words)
-                
-                if chunk_words <= 0:
-                    break
-                
-                # Generate chunk
-                is_first = (i == 0)
-                is_last = (i == num_chunks - 1)
-                
-                chunk_text = await generate_text_chunk(
-                    request.prompt,
-                    chunk_words,
-                    request.language,
-                    is_complete=False,
-                    is_first=is_first,
-                    is_last=is_last,
-                    previous_content=" ".join(chunks) if chunks else None
-                )
-                
-                chunks.append(chunk_text)
-                logger.info(f"Generated chunk {i+1}/{num_chunks}: {len(chunk_text.split())} words")
-            
-            # Combine all chunks
-            generated_text = " ".join(chunks)
-        
-        word_count = len(generated_text.split())
-        estimated_duration = estimate_duration(generated_text)
-        
-        logger.info(f"Generated text: {word_count} words, estimated duration: {estimated_duration:.1f}s")
+        subscription = await get_subscription_status(current_user.id)
+        generation = new_text_generation(str(uuid.uuid4()), current_user.id, request.prompt, request.language,
+                                         request.duration_minutes, request.mode)
+        await db.text_generations.insert_one({**generation})
+        cached = await text_cache.lookup(request.prompt, request.language, request.duration_minutes) if request.reuse_cached else None
         
-        # Save to database
-        text_id = str(uuid.uuid4())
-        generation_doc = {
-            "id": text_id,
-            "user_id": current_user.id,
-            "text": generated_text,
-            "prompt": request.prompt,
-            "language": request.language,
-            "word_count": word_count,
-            "duration_minutes": request.duration_minutes,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        
-        await db.text_generations.insert_one(generation_doc)
-        
-        return TextGenerateResponse(
-            id=text_id,
-            text=generated_text,
-            word_count=word_count,
-            estimated_duration=estimated_duration
-        )
+        return await collect_text(generation, subscription.tier == "pro", cached)
         
     except Exception as e:
         logger.error(f"Error generating text: {str(e)}")
+        if generation is not None:
+            raise HTTPException(status_code=500, detail={"message": f"Error generating text: {str(e)}", "text_id": generation["id"]})
         raise HTTPException(status_code=500, detail=f"Error generating text: {str(e)}")
 
-# Helper function to split text into segments
-def split_text_into_segments(text: str, max_segment_length: int = 600) -> list:
-    """
-    Split text into segments by sentences while trying to keep segment lengths reasonable
-    Optimized at 600 chars for maximum parallelization on 8 vCPU
-    Smaller segments = more parallel tasks = faster generation
-    Also adds pauses at punctuation marks for more natural speech
-    """
-    # Add pauses at punctuation for natural speech rhythm
-    # Add longer pause after sentence-ending punctuation (.!?)
-    text = re.sub(r'([.!?])\s+', r'\1 ... ', text)  # Add pause after sentences
-    # Add shorter pause after commas, semicolons, colons
-    text = re.sub(r'([,;:])\s+', r'\1 .. ', text)  # Add pause after internal punctuation
+@api_router.post("/text/generations/{text_id}/resume", response_model=TextGenerateResponse)
+async def resume_text_generation(text_id: str, current_user: User = Depends(get_current_user)):
+    """Finish an interrupted generation from its first missing chunk (does not count against the quota)"""
+    generation = await get_own_generation(text_id, current_user)
+    subscription = await get_subscription_status(current_user.id)
+    try:
+        return await collect_text(generation, subscription.tier == "pro")
+    except Exception as e:
+        logger.error(f"Error resuming text generation {text_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail={"message": f"Error generating text: {str(e)}", "text_id": text_id})
+
+async def release_synthesis_job(job: SynthesisJob):
+    """Free everything a synthesis job holds once its running segments have stopped"""
+    if not await job.wait_idle(CANCEL_DRAIN_TIMEOUT):
+        logger.warning(f"Job {job.job_id} still has {job.segments_in_flight} segments running after {CANCEL_DRAIN_TIMEOUT}s")
+    
+    await queue_manager.remove_job(job.job_id)
+    if job.voice_key:
+        release_voice(job.voice_key)
+        job.voice_key = None
+    # A drained job keeps its finished segments for the restart to resume from
+    if job.temp_dir is not None and job.cancel_reason != DRAIN_REASON:
+        await pools.file_io.run(shutil.rmtree, job.temp_dir, True)
+    unregister_job(job.job_id)
+
+async def inline_synthesis_events(job: SynthesisJob, resume: bool = False,
+                                  segments: Optional[AsyncIterable[str]] = None) -> AsyncIterator[dict]:
+    """Queue, synthesize and save an inline job described by job.params, yielding SSE event dicts
+    Shared by /audio/synthesize-with-progress, /audio/generate-and-speak and jobs restored after a drain.
+    With resume, segments already in the job's temp dir are reused.
+    segments (generate-and-speak) are synthesized while the text is still being written; queueing
+    and ETA then use params["expected_segments"] and params["estimated_duration"], and
+    params["text"] must be complete by the time they end."""
+    params = job.params
+    audio_id = params["audio_id"]
+    audio_dir = get_audio_dir()
     
-    # Split by sentences (periods, exclamation marks, question marks)
-    sentences = re.split(r'(?<=[.!?])\s+', text)
+    job.temp_dir = audio_dir / f"temp_{audio_id}"
+    job.temp_dir.mkdir(exist_ok=True)
+    
+    if segments is None:
+        # Split text early to get segment count for queue
+        segments = split_text_into_segments(params["text"])
+        total_segments = len(segments)
+        
+        # Estimate audio duration for ETA calculation
+        estimated_audio_duration = estimate_duration(params["text"], params["rate"], params["voice"], params["language"])
+    else:
+        total_segments = params["expected_segments"]
+        estimated_audio_duration = params["estimated_duration"]
+    estimated_audio_minutes = estimated_audio_duration / 60
+    
+    # Create queue job
+    queue_job = QueueJob(
+        job_id=job.job_id,
+        user_id=job.user_id,
+        is_pro=params["is_pro"],
+        segments_count=total_segments,
+        predicted_cost=queue_manager.predict_cost(total_segments)
+    )
+    job.deadline = queue_job.deadline
     
-    segments = []
-    current_segment = ""
+    # Admitted just as the server started draining: hand the job to the next start
+    await hand_off_if_draining(job)
     
-    for sentence in sentences:
-        # If adding this sentence would exceed max length, start a new segment
-        if current_segment and len(current_segment) + len(sentence) > max_segment_length:
-            segments.append(current_segment.strip())
-            current_segment = sentence
+    # Add to queue
+    queue_position = await queue_manager.add_job(queue_job)
+    
+    if queue_position > 1:
+        yield {'type': 'queue', 'message': f'В очереди (позиция {queue_position})', 'progress': 0, 'queue_position': queue_position}
+    
+    # Wait for our turn
+    sla_warned = False
+    while not await queue_manager.can_start_job(queue_job):
+        await asyncio.sleep(1)
+        job.check_cancelled()
+        await hand_off_if_draining(job)
+        queue_position = await queue_manager.get_queue_position(job.job_id)
+        if queue_position and queue_position > 0:
+            yield {'type': 'queue', 'message': f'В очереди (позиция {queue_position})', 'progress': 0, 'queue_position': queue_position}
+        predicted_finish = queue_manager.predicted_finish(queue_job)
+        if not sla_warned and predicted_finish > queue_job.deadline:
+            sla_warned = True
+            yield sla_warning_event(queue_job.deadline, predicted_finish)
+    
+    # Start job
+    job.check_cancelled()
+    await hand_off_if_draining(job)
+    await queue_manager.start_job(queue_job)
+    job.status = "running"
+    generation_start_time = time.time()
+    
+    # Get batch size based on user tier and current load
+    batch_size = queue_manager.get_batch_size_for_user(params["is_pro"])
+    
+    async for event in run_synthesis(
+        job, segments, params["voice"], params["rate"], batch_size,
+        audio_dir, audio_id, estimated_audio_minutes, resume=resume, expected_segments=total_segments
+    ):
+        if event['type'] == 'result':
+            final_file = Path(event['audio_path'])
+            audio_duration = event['duration']
+            total_segments = event['segments']
+        else:
+            yield event
+    
+    # Calculate total generation time and final speed
+    total_generation_time = time.time() - generation_start_time
+    final_speed = (audio_duration / 60) / total_generation_time if total_generation_time > 0 else 0
+    
+    # Save to database
+    usage = metered_usage(job, audio_duration)
+    audio_doc = {
+        "id": audio_id,
+        "user_id": job.user_id,
+        "text": params["text"],
+        "word_count": len(params["text"].split()),
+        "voice": params["voice"],
+        "rate": params["rate"],
+        "language": params["language"],
+        "audio_path": str(final_file),
+        "duration": audio_duration,
+        "generation_time": total_generation_time,
+        "generation_speed": final_speed,
+        **usage,
+        "segment_failures": job.segment_failures,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    
+    await db.audio_generations.insert_one(audio_doc)
+    await usage_ledger.record_usage(job.user_id, job.job_id, usage["cpu_seconds"], audio_duration, total_segments)
+    job.status = "completed"
+    queue_manager.record_completion(queue_job, total_generation_time)
+    queue_manager.record_usage(job.user_id, usage["cpu_seconds"])
+    
+    # Send completion with stats
+    yield completion_event(audio_id, audio_duration, total_generation_time, usage, job.segment_failures)
+
+async def check_admission(user_id: str, segments_count: int):
+    """Shed a request for segments_count segments with 429/503 and Retry-After if its predicted queue wait is too long"""
+    if draining:
+        metrics.incr("admission_decisions", decision="shed_draining")
+        raise HTTPException(
+            status_code=503,
+            detail={"message": "Сервер перезапускается. Попробуйте через несколько секунд.", "retry_after": 5},
+            headers={"Retry-After": "5"}
+        )
+    
+    subscription = await get_subscription_status(user_id)
+    is_pro = subscription.tier == "pro"
+    
+    if SYNTHESIS_MODE == "queue":
+        backlog = await job_queue.get_backlog()
+        queue_length = backlog["queued_jobs"]
+        if backlog["free_slots"] > queue_length:
+            predicted_wait = 0.0
         else:
-            current_segment += " " + sentence if current_segment else sentence
+            predicted_wait = backlog["queued_segments"] * queue_manager.segment_seconds / max(backlog["capacity"], 1)
+    else:
+        queue_length = len(queue_manager.queue)
+        predicted_wait = queue_manager.predicted_wait(is_pro, segments_count)
+    
+    decision = admission_decision(is_pro, predicted_wait, queue_length)
+    tier = tier_for(is_pro)
+    metrics.set_gauge("admission_predicted_wait_seconds", round(predicted_wait, 1), tier=tier)
+    metrics.incr("admission_decisions", tier=tier, decision="admitted" if decision.admitted else f"shed_{decision.status_code}")
+    if decision.admitted:
+        return
     
-    # Add remaining segment
-    if current_segment:
-        segments.append(current_segment.strip())
+    logger.info(f"Shedding {tier} request from {user_id}: predicted wait {predicted_wait:.0f}s, queue {queue_length}")
+    if decision.status_code == 503:
+        message = f'Очередь переполнена. Попробуйте через {decision.retry_after} с.'
+    else:
+        message = f'Сервер загружен: ожидание в очереди около {round(predicted_wait)} с. Попробуйте через {decision.retry_after} с.'
+    raise HTTPException(
+        status_code=decision.status_code,
+        detail={
+            "message": message,
+            "predicted_wait_seconds": round(predicted_wait, 1),
+            "retry_after": decision.retry_after
+        },
+        headers={"Retry-After": str(decision.retry_after)}
+    )
+
+async def stream_queued_synthesis(request: AudioSynthesizeRequest, user_id: str):
+    """SSE messages for a job run by synth_worker.py (SYNTHESIS_MODE=queue)
+    Enqueues the job in Mongo and relays the progress events workers write back"""
+    job_id = str(uuid.uuid4())
+    
+    subscription = await get_subscription_status(user_id)
+    segments = split_text_into_segments(request.text)
+    estimated_audio_minutes = estimate_duration(request.text, request.rate, request.voice, request.language) / 60
+    is_pro = subscription.tier == "pro"
+    deadline = sla_deadline(is_pro, queue_manager.predict_cost(len(segments)), time.time())
+    
+    await job_queue.enqueue_job(
+        job_id=job_id,
+        user_id=user_id,
+        is_pro=is_pro,
+        text=request.text,
+        voice=request.voice,
+        rate=request.rate,
+        language=request.language,
+        segments_count=len(segments),
+        estimated_audio_minutes=estimated_audio_minutes,
+        deadline=deadline
+    )
     
-    return segments
-
-# Helper function to synthesize a single audio segment (optimized - no voice loading)
-async def synthesize_audio_segment_fast(
-    text: str,
-    voice: PiperVoice,
-    rate: float,
-    segment_idx: int,
-    temp_dir: Path
-) -> Path:
-    """Synthesize audio for a single text segment using pre-loaded voice"""
+    finished = False
     try:
-        # Generate audio file path
-        segment_file = temp_dir / f"segment_{segment_idx:04d}.wav"
-        
-        # Synthesize using optimized thread pool
-        def synthesize():
-            syn_config = SynthesisConfig(
-                length_scale=1.0 / rate,
-                noise_scale=0.667,
-                noise_w_scale=0.8
-            )
+        yield f"data: {json.dumps({'type': 'job', 'job_id': job_id})}\n\n"
+        
+        events_seen = 0
+        last_position = None
+        while True:
+            job_doc = await job_queue.get_job(job_id, events_from=events_seen)
+            if job_doc is None:
+                raise RuntimeError(f"Job {job_id} disappeared from the queue")
             
-            with wave.open(str(segment_file), 'wb') as wav_out:
-                voice.synthesize_wav(text, wav_out, syn_config=syn_config)
-        
-        # Use shared thread pool executor for better performance
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(executor, synthesize)
-        
-        return segment_file
-        
-    except Exception as e:
-        logger.error(f"Error synthesizing segment {segment_idx}: {str(e)}")
-        raise
+            for event in job_doc["events"]:
+                yield f"data: {json.dumps(event)}\n\n"
+                events_seen += 1
+                if event.get("type") == "complete":
+                    # Keep this node's cost model current so new deadlines stay realistic
+                    queue_manager.observe_job_time(len(segments), event.get("generation_time", 0))
+                    queue_manager.record_usage(user_id, event.get("cpu_seconds", 0.0))
+            
+            if job_doc["status"] in job_queue.TERMINAL_STATUSES:
+                finished = True
+                break
+            
+            if drain_finished:
+                # This API node is going away; the job stays queued for the workers
+                yield f"data: {json.dumps(handoff_event(job_id))}\n\n"
+                finished = True
+                break
+            
+            if job_doc["status"] == "queued":
+                queue_position = await job_queue.get_queue_position(job_doc)
+                if queue_position > 1 and queue_position != last_position:
+                    yield f"data: {json.dumps({'type': 'queue', 'message': f'В очереди (позиция {queue_position})', 'progress': 0, 'queue_position': queue_position})}\n\n"
+                last_position = queue_position
+            
+            await asyncio.sleep(JOB_POLL_SECONDS)
+    finally:
+        if not finished:
+            # Client went away: let the worker stop (or never start) the job
+            spawn_task(job_queue.request_cancel(job_id))
 
 # New endpoint with parallel processing and progress tracking
 @api_router.post("/audio/synthesize-parallel", response_model=AudioSynthesizeResponse)
@@ -972,71 +1021,19 @@ async def synthesize_audio_parallel(request: AudioSynthesizeRequest):
     """Synthesize audio from text using parallel processing for faster generation"""
     try:
         audio_id = str(uuid.uuid4())
-        audio_dir = Path("/app/backend/audio_files")
-        audio_dir.mkdir(exist_ok=True)
-        
-        # Create temp directory for segments
-        temp_dir = audio_dir / f"temp_{audio_id}"
-        temp_dir.mkdir(exist_ok=True)
+        audio_dir = get_audio_dir()
         
         text_length = len(request.text)
         logger.info(f"Starting parallel audio generation for {text_length} characters")
         
-        # Load voice once (optimization)
-        voices_data = await fetch_available_voices()
-        model_path, config_path = await download_voice_model(request.voice, voices_data)
-        voice = get_or_load_voice(request.voice, model_path, config_path)
-        
         # Split text into segments (using larger segments for better performance)
         segments = split_text_into_segments(request.text)
         logger.info(f"Split text into {len(segments)} segments for parallel processing")
         
-        # Generate segments in batches to avoid memory issues
-        batch_size = 25  # Process 25 segments at a time (optimized for speed)
-        all_segment_files = []
-        
-        for batch_start in range(0, len(segments), batch_size):
-            batch_end = min(batch_start + batch_size, len(segments))
-            batch_segments = segments[batch_start:batch_end]
-            
-            # Generate batch in parallel using pre-loaded voice
-            tasks = []
-            for idx, segment in enumerate(batch_segments):
-                global_idx = batch_start + idx
-                task = synthesize_audio_segment_fast(
-                    text=segment,
-                    voice=voice,
-                    rate=request.rate,
-                    segment_idx=global_idx,
-                    temp_dir=temp_dir
-                )
-                tasks.append(task)
-            
-            # Wait for batch to complete
-            batch_files = await asyncio.gather(*tasks)
-            all_segment_files.extend(batch_files)
-            logger.info(f"Batch {batch_start//batch_size + 1} complete: {len(batch_files)} segments")
-        
-        segment_files = all_segment_files
-        logger.info(f"All {len(segment_files)} segments generated, combining...")
-        
-        # Combine all audio segments into one file
-        final_audio = AudioSegment.empty()
-        for segment_file in sorted(segment_files):
-            segment_audio = AudioSegment.from_wav(str(segment_file))
-            final_audio += segment_audio
-        
-        # Export combined audio
-        final_file = audio_dir / f"{audio_id}.wav"
-        final_audio.export(str(final_file), format="wav")
-        
+        # Up to 25 segments in inference at a time (optimized for speed)
+        final_file, _ = await synthesize_to_file(segments, request.voice, request.rate, 25, audio_dir, audio_id)
         logger.info(f"Combined audio saved: {final_file}")
         
-        # Clean up temp directory
-        for file in temp_dir.glob("*.wav"):
-            file.unlink()
-        temp_dir.rmdir()
-        
         # Save to database
         audio_doc = {
             "id": audio_id,
@@ -1072,192 +1069,203 @@ async def synthesize_audio_with_progress(
     Features: Queue management, ETA, speed tracking, fair share, Pro priority
     Uses POST method to support large texts (up to 1 hour audio) that exceed URL length limits"""
     
+    # Reject up front when the queue is too long, before holding a stream open
+    await check_admission(current_user.id, len(split_text_into_segments(request.text)))
+    
     async def generate_progress():
         job_id = str(uuid.uuid4())
-        generation_start_time = None
+        job = None
         
         try:
             # Check if user can generate
             can_generate_info = await check_can_generate(current_user.id)
             
             if not can_generate_info["can_generate"]:
-                error_msg = f'Достигнут дневной лимит ({can_generate_info["limit"]} генераций). Обновитесь до Pro для безлимитного доступа.'
+                error_msg = limit_message(can_generate_info)
                 yield f"data: {json.dumps({'type': 'error', 'message': error_msg})}\n\n"
                 return
             
             # Log usage
             await log_usage(current_user.id, "audio_generation")
             
-            audio_id = str(uuid.uuid4())
-            BASE_DIR = Path(__file__).resolve().parent
-            audio_dir = Path(os.getenv("AUDIO_OUTPUT_DIR", BASE_DIR / "audio_files"))
-            audio_dir.mkdir(parents=True, exist_ok=True)
+            if SYNTHESIS_MODE == "queue":
+                async for message in stream_queued_synthesis(request, current_user.id):
+                    yield message
+                return
             
-            temp_dir = audio_dir / f"temp_{audio_id}"
-            temp_dir.mkdir(exist_ok=True)
+            # Register job so it can be cancelled via DELETE /api/jobs/{job_id}
+            job = register_job(SynthesisJob(job_id, current_user.id))
+            yield f"data: {json.dumps({'type': 'job', 'job_id': job_id})}\n\n"
             
             # Get user subscription tier
             subscription = await get_subscription_status(current_user.id)
-            is_pro = subscription.tier == "pro"
-            
-            # Split text early to get segment count for queue
-            segments = split_text_into_segments(request.text)
-            total_segments = len(segments)
+            job.params = {
+                "audio_id": str(uuid.uuid4()),
+                "text": request.text,
+                "voice": request.voice,
+                "rate": request.rate,
+                "language": request.language,
+                "is_pro": subscription.tier == "pro"
+            }
             
-            # Estimate audio duration for ETA calculation
-            estimated_audio_duration = estimate_duration(request.text, request.rate)
-            estimated_audio_minutes = estimated_audio_duration / 60
+            async for event in inline_synthesis_events(job):
+                yield f"data: {json.dumps(event)}\n\n"
+        
+        except JobCancelled as e:
+            logger.info(f"SSE audio synthesis {job_id} cancelled: {str(e)}")
+            if job is not None and job.cancel_reason == DRAIN_REASON:
+                yield f"data: {json.dumps(handoff_event(job_id))}\n\n"
+            else:
+                yield f"data: {json.dumps({'type': 'cancelled', 'job_id': job_id, 'message': 'Генерация отменена'})}\n\n"
+        except Exception as e:
+            logger.error(f"Error in SSE audio synthesis: {str(e)}", exc_info=True)
+            if job is not None:
+                job.status = "failed"
+            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+        finally:
+            if job is not None:
+                # Client went away (or generator was closed) mid-job: stop the CPU work
+                if job.status in ("queued", "running"):
+                    job.cancel("Client disconnected")
+                spawn_release(job, release_synthesis_job)
+    
+    return StreamingResponse(generate_progress(), media_type="text/event-stream")
+
+# SSE endpoint that writes the script and narrates it at the same time (protocol in speak.py)
+@api_router.post("/audio/generate-and-speak")
+async def generate_and_speak(
+    request: GenerateAndSpeakRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """Generate a script and synthesize it while it is being written, via SSE (requires auth)
+    Text events: 'delta', 'text_progress', 'text_complete' (with text_id); audio events are those of
+    /audio/synthesize-with-progress, and 'live_audio' gives a URL that plays the WAV as it grows."""
+    # Shed with the segment count the script is expected to split into
+    target_words = textgen.calculate_word_count(request.duration_minutes, request.language, request.voice, request.rate)
+    await check_admission(current_user.id, speak.expected_segments(target_words))
+    
+    async def generate_progress():
+        job_id = str(uuid.uuid4())
+        job = None
+        tasks = []
+        
+        try:
+            can_generate_info = await check_can_generate(current_user.id)
+            if not can_generate_info["can_generate"]:
+                error_msg = limit_message(can_generate_info)
+                yield f"data: {json.dumps({'type': 'error', 'message': error_msg})}\n\n"
+                return
             
-            # Create queue job
-            queue_job = QueueJob(
-                job_id=job_id,
-                user_id=current_user.id,
-                is_pro=is_pro,
-                segments_count=total_segments
-            )
+            await log_usage(current_user.id, "text_generation")
+            await log_usage(current_user.id, "audio_generation")
             
-            # Add to queue
-            queue_position = await queue_manager.add_job(queue_job)
+            subscription = await get_subscription_status(current_user.id)
+            audio_id = str(uuid.uuid4())
+            text_id = str(uuid.uuid4())
+            generation = new_text_generation(text_id, current_user.id, request.prompt, request.language,
+                                             request.duration_minutes, request.mode, request.voice, request.rate)
+            target_words = generation["target_words"]
+            await db.text_generations.insert_one({**generation})
+            cached = await text_cache.lookup(request.prompt, request.language, request.duration_minutes) if request.reuse_cached else None
+            feed = speak.SegmentFeed()
+            # Text and audio events from both tasks; None once synthesis is done
+            events: asyncio.Queue = asyncio.Queue()
             
-            if queue_position > 1:
-                yield f"data: {json.dumps({'type': 'queue', 'message': f'В очереди (позиция {queue_position})', 'progress': 0, 'queue_position': queue_position})}\n\n"
+            async def write_text():
+                try:
+                    # Not trimmed: what was written is already being spoken
+                    async for event in script_for(generation, True, subscription.tier == "pro", cached, trim=False):
+                        if event['type'] in ('delta', 'section_done'):
+                            feed.add(event)
+                        if event['type'] == 'delta':
+                            events.put_nowait(event)
+                        elif event['type'] == 'result':
+                            generated_text = event['text']
+                        elif event['type'] != 'section_done':
+                            events.put_nowait({**event, 'type': 'text_progress'})
+                    
+                    # Complete before the last segment leaves the feed, so the audio record gets it
+                    if job is not None:
+                        job.params["text"] = generated_text
+                    word_count = await complete_text_generation(generation, generated_text, cached)
+                    events.put_nowait({'type': 'text_complete', 'text_id': text_id, 'text': generated_text, 'word_count': word_count})
+                    feed.finish()
+                except Exception as e:
+                    feed.finish(e)
+                    events.put_nowait(e)
+                    raise
             
-            # Wait for our turn
-            while not await queue_manager.can_start_job(queue_job):
-                await asyncio.sleep(1)
-                queue_position = await queue_manager.get_queue_position(job_id)
-                if queue_position and queue_position > 0:
-                    yield f"data: {json.dumps({'type': 'queue', 'message': f'В очереди (позиция {queue_position})', 'progress': 0, 'queue_position': queue_position})}\n\n"
+            if SYNTHESIS_MODE == "queue":
+                # Workers only take complete texts: write first, then queue the synthesis
+                tasks.append(asyncio.ensure_future(write_text()))
+                while True:
+                    event = await events.get()
+                    if isinstance(event, Exception):
+                        raise event
+                    yield f"data: {json.dumps(event)}\n\n"
+                    if event['type'] == 'text_complete':
+                        break
+                synthesis_request = AudioSynthesizeRequest(
+                    text=event['text'], voice=request.voice, rate=request.rate, language=request.language
+                )
+                async for message in stream_queued_synthesis(synthesis_request, current_user.id):
+                    yield message
+                return
             
-            # Start job
-            await queue_manager.start_job(queue_job)
-            generation_start_time = time.time()
+            # Register job so it can be cancelled via DELETE /api/jobs/{job_id}
+            job = register_job(SynthesisJob(job_id, current_user.id))
+            job.params = {
+                "audio_id": audio_id,
+                "text": "",
+                "voice": request.voice,
+                "rate": request.rate,
+                "language": request.language,
+                "is_pro": subscription.tier == "pro",
+                "live": True,
+                "expected_segments": speak.expected_segments(target_words),
+                # target_words is what duration_minutes takes at this voice's rate
+                "estimated_duration": request.duration_minutes * 60
+            }
+            yield f"data: {json.dumps({'type': 'job', 'job_id': job_id, 'text_id': text_id})}\n\n"
+            yield f"data: {json.dumps({'type': 'live_audio', 'audio_id': audio_id, 'audio_url': f'/audio/live/{audio_id}'})}\n\n"
             
-            try:
-                # Stage 1: Load voice model (0-5%)
-                yield f"data: {json.dumps({'type': 'stage', 'stage': 'loading_model', 'message': 'Загрузка модели голоса...', 'progress': 0, 'total_segments': total_segments, 'estimated_audio_minutes': round(estimated_audio_minutes, 1)})}\n\n"
-                
-                voices_data = await fetch_available_voices()
-                model_path, config_path = await download_voice_model(request.voice, voices_data)
-                voice_obj = get_or_load_voice(request.voice, model_path, config_path)
-                
-                yield f"data: {json.dumps({'type': 'progress', 'progress': 5, 'message': 'Модель загружена', 'stage': 'loading_model'})}\n\n"
-                
-                # Stage 2: Generate audio segments (5-85%)
-                yield f"data: {json.dumps({'type': 'stage', 'stage': 'generating_segments', 'message': f'Генерация {total_segments} сегментов...', 'progress': 5, 'total_segments': total_segments})}\n\n"
-                
-                # Get batch size based on user tier and current load
-                batch_size = queue_manager.get_batch_size_for_user(is_pro)
-                completed_segments = 0
-                all_segment_files = []
-                
-                segments_start_time = time.time()
-                
-                for batch_start in range(0, total_segments, batch_size):
-                    batch_end = min(batch_start + batch_size, total_segments)
-                    batch_segments = segments[batch_start:batch_end]
-                    
-                    # Generate batch in parallel
-                    tasks = []
-                    for idx, segment in enumerate(batch_segments):
-                        global_idx = batch_start + idx
-                        task = synthesize_audio_segment_fast(
-                            text=segment,
-                            voice=voice_obj,
-                            rate=request.rate,
-                            segment_idx=global_idx,
-                            temp_dir=temp_dir
-                        )
-                        tasks.append(task)
-                    
-                    # Wait for batch to complete
-                    batch_files = await asyncio.gather(*tasks)
-                    all_segment_files.extend(batch_files)
-                    
-                    completed_segments += len(batch_segments)
-                    progress = int(5 + (completed_segments / total_segments) * 80)  # 5-85% for generation
-                    
-                    # Calculate ETA and speed
-                    elapsed = time.time() - segments_start_time
-                    if completed_segments > 0:
-                        time_per_segment = elapsed / completed_segments
-                        remaining_segments = total_segments - completed_segments
-                        eta_seconds = time_per_segment * remaining_segments
-                        
-                        # Calculate generation speed (audio_minutes per second)
-                        audio_generated_minutes = (completed_segments / total_segments) * estimated_audio_minutes
-                        speed = audio_generated_minutes / elapsed if elapsed > 0 else 0
-                        
-                        eta_formatted = f"{int(eta_seconds // 60)}м {int(eta_seconds % 60)}с" if eta_seconds >= 60 else f"{int(eta_seconds)}с"
-                        
-                        yield f"data: {json.dumps({'type': 'progress', 'progress': progress, 'message': f'Сегмент {completed_segments}/{total_segments}', 'stage': 'generating_segments', 'completed_segments': completed_segments, 'total_segments': total_segments, 'eta': eta_formatted, 'speed': round(speed, 2), 'elapsed': round(elapsed, 1)})}\n\n"
-                    else:
-                        yield f"data: {json.dumps({'type': 'progress', 'progress': progress, 'message': f'Сегмент {completed_segments}/{total_segments}', 'stage': 'generating_segments', 'completed_segments': completed_segments, 'total_segments': total_segments})}\n\n"
-                
-                # Stage 3: Combine audio segments (85-98%)
-                yield f"data: {json.dumps({'type': 'stage', 'stage': 'combining', 'message': 'Объединение аудио...', 'progress': 85})}\n\n"
-                
-                final_audio = AudioSegment.empty()
-                total_files = len(all_segment_files)
-                
-                for idx, segment_file in enumerate(sorted(all_segment_files), 1):
-                    segment_audio = AudioSegment.from_wav(str(segment_file))
-                    final_audio += segment_audio
-                    
-                    # Progress during combining (85-98%)
-                    combine_progress = int(85 + (idx / total_files) * 13)
-                    
-                    # Show progress every 10 files or on last file
-                    if idx % max(1, total_files // 10) == 0 or idx == total_files:
-                        yield f"data: {json.dumps({'type': 'progress', 'progress': combine_progress, 'message': f'Склейка {idx}/{total_files}', 'stage': 'combining'})}\n\n"
-                
-                # Stage 4: Save file (98-100%)
-                yield f"data: {json.dumps({'type': 'stage', 'stage': 'saving', 'message': 'Сохранение файла...', 'progress': 98})}\n\n"
-                
-                final_file = audio_dir / f"{audio_id}.wav"
-                final_audio.export(str(final_file), format="wav")
-                
-                # Get real audio duration
-                audio_duration = get_audio_duration(final_file)
-                
-                # Clean up temp files
-                for file in temp_dir.glob("*.wav"):
-                    file.unlink()
-                temp_dir.rmdir()
-                
-                # Calculate total generation time and final speed
-                total_generation_time = time.time() - generation_start_time
-                final_speed = (audio_duration / 60) / total_generation_time if total_generation_time > 0 else 0
-                
-                # Save to database
-                audio_doc = {
-                    "id": audio_id,
-                    "user_id": current_user.id,
-                    "text": request.text,
-                    "voice": request.voice,
-                    "rate": request.rate,
-                    "language": request.language,
-                    "audio_path": str(final_file),
-                    "duration": audio_duration,
-                    "generation_time": total_generation_time,
-                    "generation_speed": final_speed,
-                    "created_at": datetime.now(timezone.utc).isoformat()
-                }
-                
-                await db.audio_generations.insert_one(audio_doc)
-                
-                # Send completion with stats
-                yield f"data: {json.dumps({'type': 'complete', 'progress': 100, 'audio_id': audio_id, 'audio_url': f'/audio/download/{audio_id}', 'duration': audio_duration, 'generation_time': round(total_generation_time, 1), 'speed': round(final_speed, 2), 'message': f'Готово! ({round(audio_duration/60, 1)} мин за {round(total_generation_time, 1)}с, скорость {round(final_speed, 1)}x)'})}\n\n"
-                
-            finally:
-                # Always finish job in queue
-                await queue_manager.finish_job(job_id)
+            async def narrate():
+                try:
+                    async for event in inline_synthesis_events(job, segments=feed):
+                        events.put_nowait(event)
+                    events.put_nowait(None)
+                except Exception as e:
+                    events.put_nowait(e)
             
+            tasks.append(asyncio.ensure_future(write_text()))
+            tasks.append(asyncio.ensure_future(narrate()))
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                if isinstance(event, Exception):
+                    raise event
+                yield f"data: {json.dumps(event)}\n\n"
+        
+        except JobCancelled as e:
+            logger.info(f"Generate-and-speak {job_id} cancelled: {str(e)}")
+            if job is not None and job.cancel_reason == LIVE_DRAIN_REASON:
+                message = 'Сервер перезапускается. Готовый текст сохранён в истории, озвучку запустите заново.'
+            else:
+                message = 'Генерация отменена'
+            yield f"data: {json.dumps({'type': 'cancelled', 'job_id': job_id, 'message': message})}\n\n"
         except Exception as e:
-            logger.error(f"Error in SSE audio synthesis: {str(e)}", exc_info=True)
-            if generation_start_time:
-                await queue_manager.finish_job(job_id)
+            logger.error(f"Error in generate-and-speak: {str(e)}", exc_info=True)
+            if job is not None:
+                job.status = "failed"
             yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+            if job is not None:
+                if job.status in ("queued", "running"):
+                    job.cancel("Client disconnected")
+                spawn_release(job, release_synthesis_job)
     
     return StreamingResponse(generate_progress(), media_type="text/event-stream")
 
@@ -1268,42 +1276,14 @@ async def synthesize_audio(request: AudioSynthesizeRequest):
         # Create unique ID
         audio_id = str(uuid.uuid4())
         
-        # Create audio directory if it doesn't exist
-        audio_dir = Path("/app/backend/audio_files")
-        audio_dir.mkdir(exist_ok=True)
-        
-        # Generate audio file paths
-        wav_file = audio_dir / f"{audio_id}.wav"
+        audio_dir = get_audio_dir()
         
         text_length = len(request.text)
         logger.info(f"Generating audio for text of length: {text_length} characters with voice: {request.voice}")
         
-        # Fetch voices data and download model if needed
-        voices_data = await fetch_available_voices()
-        model_path, config_path = await download_voice_model(request.voice, voices_data)
-        
-        # Load or get cached voice
-        voice = get_or_load_voice(request.voice, model_path, config_path)
-        
-        # Synthesize audio
-        logger.info(f"Synthesizing with Piper voice: {request.voice}, rate: {request.rate}")
-        
-        # Run synthesis in thread pool to avoid blocking
-        def synthesize():
-            # Create synthesis config with speed adjustment
-            # length_scale is inverse of speed (higher = slower, lower = faster)
-            syn_config = SynthesisConfig(
-                length_scale=1.0 / request.rate,  # Convert rate to length_scale
-                noise_scale=0.667,
-                noise_w_scale=0.8
-            )
-            
-            with wave.open(str(wav_file), 'wb') as wav_out:
-                # Synthesize directly to WAV file
-                voice.synthesize_wav(request.text, wav_out, syn_config=syn_config)
-        
-        # Run in thread pool
-        await asyncio.to_thread(synthesize)
+        # Same pipeline as the parallel endpoint
+        segments = split_text_into_segments(request.text)
+        wav_file, _ = await synthesize_to_file(segments, request.voice, request.rate, 25, audio_dir, audio_id)
         
         logger.info(f"Audio file saved: {wav_file}")
         
@@ -1332,6 +1312,76 @@ async def synthesize_audio(request: AudioSynthesizeRequest):
         logger.error(f"Error synthesizing audio: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error synthesizing audio: {str(e)}")
 
+@api_router.websocket("/audio/stream")
+async def stream_audio(websocket: WebSocket):
+    """Bidirectional streaming TTS: text increments in, PCM per sentence out (protocol in tts_stream.py)"""
+    token = websocket.cookies.get("session_token") or websocket.query_params.get("token")
+    user = await get_user_by_session_token(token) if token else None
+    await websocket.accept()
+    if user is None:
+        await websocket.close(code=1008, reason="Not authenticated")
+        return
+    if draining:
+        await websocket.close(code=1013, reason="Server draining")
+        return
+    
+    voice_key = None
+    session = None
+    try:
+        can_generate_info = await check_can_generate(user.id)
+        if not can_generate_info["can_generate"]:
+            await websocket.send_json({'type': 'error', 'message': limit_message(can_generate_info)})
+            await websocket.close(code=1008)
+            return
+        
+        start = await asyncio.wait_for(websocket.receive_json(), tts_stream.STREAM_IDLE_TIMEOUT_SECONDS)
+        if start.get("type") != "start" or not start.get("voice"):
+            await websocket.send_json({'type': 'error', 'message': 'Первое сообщение должно быть {"type": "start", "voice": ...}'})
+            await websocket.close(code=1003)
+            return
+        rate = float(start.get("rate", 1.0))
+        window = max(0, int(start.get("window", tts_stream.STREAM_DEFAULT_WINDOW)))
+        
+        voices_data = await fetch_available_voices()
+        model_path, config_path = await download_voice_model(start["voice"], voices_data)
+        voice = await acquire_voice(start["voice"], model_path, config_path)
+        voice_key = start["voice"]
+        
+        await log_usage(user.id, "audio_stream")
+        await websocket.send_json({
+            'type': 'ready',
+            'sample_rate': voice.config.sample_rate,
+            'sample_width': 2,
+            'channels': 1,
+            'window': window
+        })
+        
+        session = tts_stream.StreamSession(websocket, voice, rate, window, lambda: draining)
+        await session.run()
+        await websocket.close()
+    except WebSocketDisconnect:
+        logger.info(f"Stream session of user {user.id} disconnected")
+    except tts_stream.StreamClosed as e:
+        await websocket.send_json({'type': 'error', 'message': str(e)})
+        await websocket.close(code=1008)
+    except asyncio.TimeoutError:
+        await websocket.close(code=1008, reason="No start message")
+    except Exception as e:
+        logger.error(f"Error in audio stream: {str(e)}", exc_info=True)
+        try:
+            await websocket.send_json({'type': 'error', 'message': str(e)})
+            await websocket.close(code=1011)
+        except Exception:
+            pass
+    finally:
+        if voice_key:
+            release_voice(voice_key)
+        if session is not None and session.latencies:
+            await usage_ledger.record_usage(
+                user.id, session.session_id, round(session.cpu_seconds, 3),
+                round(session.audio_seconds, 2), len(session.latencies)
+            )
+
 @api_router.get("/audio/download/{audio_id}")
 async def download_audio(audio_id: str):
     """Download generated audio file"""
@@ -1362,6 +1412,21 @@ async def download_audio(audio_id: str):
         logger.error(f"Error downloading audio: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error downloading audio: {str(e)}")
 
+@api_router.get("/audio/live/{audio_id}")
+async def live_audio(audio_id: str):
+    """Audio of a running generate-and-speak job as it is synthesized (streaming WAV)"""
+    def is_running() -> bool:
+        return any(job.params.get("audio_id") == audio_id for job in list(live_jobs.values()) if job.params)
+    
+    audio_dir = get_audio_dir()
+    if not is_running():
+        # Finished (or never existed): the regular download serves it
+        return await download_audio(audio_id)
+    
+    # Assembled in the job's temp dir, then moved into the audio dir
+    paths = [partial_file(audio_dir / f"temp_{audio_id}", audio_id), audio_dir / f"{audio_id}.wav"]
+    return StreamingResponse(speak.live_wav(paths, is_running), media_type="audio/wav")
+
 @api_router.get("/history", response_model=List[GenerationHistory])
 async def get_history(current_user: User = Depends(get_current_user)):
     """Get generation history for current user"""
@@ -1388,6 +1453,345 @@ async def get_history(current_user: User = Depends(get_current_user)):
         logger.error(f"Error fetching history: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching history: {str(e)}")
 
+# ============================================================================
+# AUDIOBOOK ENDPOINTS
+# ============================================================================
+
+async def get_own_book(book_id: str, user: User) -> dict:
+    book = await audiobook.get_book(book_id)
+    if not book:
+        raise HTTPException(status_code=404, detail="Audiobook not found")
+    if book["user_id"] != user.id and not user.is_admin:
+        raise HTTPException(status_code=403, detail="Not allowed to access this audiobook")
+    return book
+
+@api_router.post("/audiobooks")
+async def create_audiobook(
+    request: Request,
+    filename: str,
+    voice: str,
+    rate: float = 1.0,
+    language: str = "ru-RU",
+    current_user: User = Depends(get_current_user)
+):
+    """Upload a TXT/Markdown/EPUB document as the raw request body and start an audiobook (requires auth)
+    The body is streamed to disk, so the size is limited only by AUDIOBOOK_MAX_UPLOAD_MB."""
+    # Checked before the upload: a bad voice would otherwise fail every chapter hours later
+    voices_data = await fetch_available_voices()
+    if voice not in voices_data:
+        raise HTTPException(status_code=400, detail=f"Неизвестный голос: {voice}")
+    await check_admission(current_user.id, audiobook.expected_segments(int(request.headers.get("content-length") or 0)))
+    
+    can_generate_info = await check_can_generate(current_user.id)
+    if not can_generate_info["can_generate"]:
+        raise HTTPException(status_code=403, detail=limit_message(can_generate_info))
+    
+    subscription = await get_subscription_status(current_user.id)
+    is_pro = subscription.tier == "pro"
+    try:
+        book = await audiobook.create_book(
+            current_user.id, filename, request.stream(), voice, rate, language, is_pro, INSTANCE_ID
+        )
+    except audiobook.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except audiobook.BookFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    await log_usage(current_user.id, "audiobook")
+    audiobook.start(book, INSTANCE_ID, queue_manager.get_batch_size_for_user(is_pro), queue_manager.segment_seconds)
+    
+    return {
+        "id": book["id"],
+        "title": book["title"],
+        "status": book["status"],
+        "chars": book["chars"],
+        "estimated_duration": book["estimated_duration"],
+        "chapters": [{"index": chapter["index"], "title": chapter["title"], "chars": chapter["chars"]} for chapter in book["chapters"]]
+    }
+
+@api_router.get("/audiobooks")
+async def list_audiobooks(current_user: User = Depends(get_current_user)):
+    """Audiobooks of the current user, newest first"""
+    books = await db.audiobooks.find(
+        {"user_id": current_user.id},
+        {"_id": 0, "id": 1, "title": 1, "status": 1, "chars": 1, "duration": 1, "created_at": 1, "completed_at": 1}
+    ).sort("created_at", -1).to_list(100)
+    return books
+
+@api_router.get("/audiobooks/{book_id}")
+async def get_audiobook(book_id: str, current_user: User = Depends(get_current_user)):
+    """Book status with per-chapter status, progress and durations; the chapter index once completed"""
+    return await get_own_book(book_id, current_user)
+
+@api_router.get("/audiobooks/{book_id}/progress")
+async def stream_audiobook_progress(book_id: str, current_user: User = Depends(get_current_user)):
+    """SSE feed of overall and per-chapter progress until the book finishes"""
+    await get_own_book(book_id, current_user)
+    
+    async def generate_progress():
+        while True:
+            book = await audiobook.get_book(book_id)
+            if not book:
+                return
+            chapters = [
+                {key: chapter.get(key) for key in ("index", "title", "status", "progress", "duration", "error")}
+                for chapter in book["chapters"]
+            ]
+            total_chars = sum(chapter["chars"] for chapter in book["chapters"]) or 1
+            progress = sum(chapter["chars"] * (chapter.get("progress") or 0) for chapter in book["chapters"]) / total_chars
+            event = {
+                'type': 'complete' if book["status"] == "completed" else 'progress',
+                'status': book["status"],
+                'progress': round(progress, 1),
+                'chapters': chapters
+            }
+            if book["status"] == "completed":
+                event.update(duration=book["duration"], chapter_index=book["chapter_index"], audio_url=f'/audiobooks/{book_id}/download')
+            elif book["status"] in audiobook.TERMINAL_STATUSES:
+                event.update(type='error' if book["status"] == "failed" else 'cancelled', message=book.get("error"))
+            yield f"data: {json.dumps(event)}\n\n"
+            if book["status"] in audiobook.TERMINAL_STATUSES:
+                return
+            await asyncio.sleep(ENGINE_FEED_SECONDS)
+    
+    return StreamingResponse(generate_progress(), media_type="text/event-stream")
+
+@api_router.get("/audiobooks/{book_id}/download")
+async def download_audiobook(book_id: str, current_user: User = Depends(get_current_user)):
+    """The whole book as one WAV file"""
+    book = await get_own_book(book_id, current_user)
+    if book["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Audiobook is {book['status']}")
+    audio_path = Path(book["audio_path"])
+    if not audio_path.exists():
+        raise HTTPException(status_code=404, detail="Audio file not found")
+    return FileResponse(path=audio_path, media_type="audio/wav", filename=f"audiobook_{book_id}.wav")
+
+@api_router.get("/audiobooks/{book_id}/chapters/{number}/download")
+async def download_audiobook_chapter(book_id: str, number: int, current_user: User = Depends(get_current_user)):
+    """One chapter (numbered from 1) as soon as it is finished, before the whole book is"""
+    book = await get_own_book(book_id, current_user)
+    if not 1 <= number <= len(book["chapters"]):
+        raise HTTPException(status_code=404, detail="Chapter not found")
+    if book["chapters"][number - 1]["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Chapter is {book['chapters'][number - 1]['status']}")
+    audio_path = audiobook.chapter_audio_path(book_id, number - 1)
+    if not audio_path.exists():
+        raise HTTPException(status_code=404, detail="Audio file not found")
+    return FileResponse(path=audio_path, media_type="audio/wav", filename=f"audiobook_{book_id}_{number:03d}.wav")
+
+@api_router.delete("/audiobooks/{book_id}")
+async def cancel_audiobook(book_id: str, current_user: User = Depends(get_current_user)):
+    """Cancel an unfinished audiobook, or delete a finished one with its files"""
+    book = await get_own_book(book_id, current_user)
+    if book["status"] not in audiobook.TERMINAL_STATUSES:
+        await audiobook.cancel_book(book_id)
+        return {"success": True, "id": book_id, "status": "cancelled"}
+    await audiobook.delete_book_files(book_id)
+    await db.audiobooks.delete_one({"id": book_id})
+    return {"success": True, "id": book_id, "status": "deleted"}
+
+# ============================================================================
+# JOB CONTROL ENDPOINTS
+# ============================================================================
+
+@api_router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, current_user: User = Depends(get_current_user)):
+    """Cancel a queued or running synthesis job and wait for its CPU work to stop"""
+    job = get_job(job_id)
+    
+    if not job and SYNTHESIS_MODE == "queue":
+        return await cancel_queued_job(job_id, current_user)
+    
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    if job.user_id != current_user.id and not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not allowed to cancel this job")
+    
+    if not job.cancel("Cancelled by user"):
+        raise HTTPException(status_code=409, detail=f"Job already {job.status}")
+    
+    cpu_freed = await job.wait_idle(CANCEL_DRAIN_TIMEOUT)
+    
+    return {
+        "success": True,
+        "job_id": job_id,
+        "status": job.status,
+        "cpu_freed": cpu_freed,
+        "time_to_free_cpu": round(job.time_to_free_cpu, 3) if job.time_to_free_cpu is not None else None
+    }
+
+async def cancel_queued_job(job_id: str, current_user: User) -> dict:
+    """Cancel a job in the durable queue and wait for its worker to stop it"""
+    job_doc = await job_queue.get_job(job_id)
+    
+    if not job_doc:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    if job_doc["user_id"] != current_user.id and not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not allowed to cancel this job")
+    
+    if job_doc["status"] in job_queue.TERMINAL_STATUSES or job_doc.get("cancel_requested"):
+        raise HTTPException(status_code=409, detail=f"Job already {job_doc['status']}")
+    
+    await job_queue.request_cancel(job_id)
+    
+    # Worker notices the request on its next heartbeat
+    deadline = time.time() + CANCEL_DRAIN_TIMEOUT
+    while job_doc["status"] not in job_queue.TERMINAL_STATUSES and time.time() < deadline:
+        await asyncio.sleep(JOB_POLL_SECONDS)
+        job_doc = await job_queue.get_job(job_id, events_from=-1)
+    
+    time_to_free_cpu = job_doc.get("time_to_free_cpu")
+    return {
+        "success": True,
+        "job_id": job_id,
+        "status": job_doc["status"],
+        "cpu_freed": job_doc["status"] in job_queue.TERMINAL_STATUSES,
+        "time_to_free_cpu": round(time_to_free_cpu, 3) if time_to_free_cpu is not None else None
+    }
+
+# ============================================================================
+# GRACEFUL DRAIN
+# ============================================================================
+
+def handoff_event(job_id: str) -> dict:
+    """SSE event for a job this server will not finish before it restarts"""
+    return {
+        'type': 'handoff',
+        'job_id': job_id,
+        'message': 'Сервер перезапускается. Генерация продолжится автоматически, готовое аудио появится в истории.'
+    }
+
+def count_segment_files(temp_dir: Path) -> int:
+    return len(list(temp_dir.glob("segment_*.wav"))) if temp_dir.exists() else 0
+
+async def persist_job(job: SynthesisJob):
+    """Save an inline job so the next server start can finish it from its finished segments"""
+    segments_done = await pools.file_io.run(count_segment_files, job.temp_dir) if job.temp_dir else 0
+    await db.pending_synthesis.replace_one(
+        {"_id": job.job_id},
+        {
+            "_id": job.job_id,
+            "user_id": job.user_id,
+            **job.params,
+            "segments_done": segments_done,
+            "claimed_by": None,
+            "persisted_at": datetime.now(timezone.utc)
+        },
+        upsert=True
+    )
+    logger.info(f"Persisted job {job.job_id} ({segments_done} segments done)")
+
+def resumable(job: SynthesisJob) -> bool:
+    """Whether a drained job can be persisted for the next start (it has its whole text)"""
+    return bool(job.params) and not job.params.get("live")
+
+async def stop_for_drain(job: SynthesisJob):
+    if resumable(job):
+        await persist_job(job)
+        job.cancel(DRAIN_REASON)
+    else:
+        job.cancel(LIVE_DRAIN_REASON)
+
+async def hand_off_if_draining(job: SynthesisJob):
+    """Persist and stop a job that has not started yet once the server is draining"""
+    if draining and not job.cancelled:
+        await stop_for_drain(job)
+    job.check_cancelled()
+
+async def drain():
+    """Stop admitting jobs, let running ones finish until DRAIN_TIMEOUT_SECONDS, persist the rest"""
+    global draining, drain_finished
+    if draining:
+        return
+    draining = True
+    logger.info(
+        f"Draining: {len(queue_manager.active_jobs)} running, {len(queue_manager.queue)} queued jobs, "
+        f"deadline {DRAIN_TIMEOUT_SECONDS:.0f}s"
+    )
+    
+    # Queued jobs will not start on this instance any more
+    for job in list(live_jobs.values()):
+        if job.status == "queued" and job.params:
+            await stop_for_drain(job)
+    
+    # Audiobooks run for hours: hand them over right away, they resume from their finished segments
+    await audiobook.drain(DRAIN_REASON)
+    
+    deadline = time.time() + DRAIN_TIMEOUT_SECONDS
+    while queue_manager.active_jobs and time.time() < deadline:
+        await asyncio.sleep(0.5)
+    
+    # Out of time: stop the rest at a sentence boundary and keep their finished segments
+    unfinished = [job for job in live_jobs.values() if job.status == "running" and job.params]
+    for job in unfinished:
+        job.cancel(DRAIN_REASON if resumable(job) else LIVE_DRAIN_REASON)
+    for job in unfinished:
+        await job.wait_idle(CANCEL_DRAIN_TIMEOUT)
+        if resumable(job):
+            await persist_job(job)
+    
+    drain_finished = True
+    logger.info(f"Drain finished, {len(unfinished)} running jobs persisted for the next start")
+
+async def drain_and_exit():
+    await drain()
+    # Let uvicorn run its normal shutdown now that nothing is left to wait for
+    os.kill(os.getpid(), signal.SIGINT)
+
+async def run_restored_job(doc: dict):
+    """Finish a job persisted by a drained server; the result shows up in the user's history"""
+    job = register_job(SynthesisJob(doc["_id"], doc["user_id"]))
+    job.params = {key: doc[key] for key in ("audio_id", "text", "voice", "rate", "language", "is_pro")}
+    try:
+        async for _ in inline_synthesis_events(job, resume=True):
+            pass
+        await db.pending_synthesis.delete_one({"_id": job.job_id})
+        logger.info(f"Restored job {job.job_id} completed")
+    except JobCancelled as e:
+        # Drained again: persist_job already released the claim for the next start
+        if job.cancel_reason != DRAIN_REASON:
+            await db.pending_synthesis.delete_one({"_id": job.job_id})
+        logger.info(f"Restored job {job.job_id} cancelled: {str(e)}")
+    except Exception as e:
+        logger.error(f"Restored job {job.job_id} failed: {str(e)}", exc_info=True)
+        job.status = "failed"
+        await db.pending_synthesis.delete_one({"_id": job.job_id})
+    finally:
+        if job.status in ("queued", "running"):
+            job.cancel("Restored job stopped")
+        await release_synthesis_job(job)
+
+async def restore_pending_jobs():
+    """Claim jobs persisted by a drained server and finish them here"""
+    stale = datetime.now(timezone.utc) - timedelta(hours=1)
+    restored = 0
+    while True:
+        # Claimed by another instance that died before finishing: take it over after an hour
+        doc = await db.pending_synthesis.find_one_and_update(
+            {"$or": [{"claimed_by": None}, {"claimed_at": {"$lt": stale}}]},
+            {"$set": {"claimed_by": INSTANCE_ID, "claimed_at": datetime.now(timezone.utc)}}
+        )
+        if doc is None:
+            break
+        spawn_task(run_restored_job(doc))
+        restored += 1
+    if restored:
+        logger.info(f"Restored {restored} jobs persisted by a drained server")
+
+@api_router.get("/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+@api_router.get("/health/ready")
+async def readiness():
+    """Readiness for the load balancer: false as soon as the server starts draining"""
+    if draining:
+        return JSONResponse(status_code=503, content={"ready": False, "draining": True})
+    return {"ready": True, "draining": False}
+
 # Include router
 app.include_router(api_router)
 
@@ -1399,6 +1803,34 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def ensure_job_queue_indexes():
+    await usage_ledger.ensure_indexes()
+    await audiobook.ensure_indexes()
+    await text_cache.ensure_indexes()
+    spawn_task(speech_rate.refresh_periodically(db))
+    if SYNTHESIS_MODE == "queue":
+        await job_queue.ensure_indexes()
+    else:
+        await restore_pending_jobs()
+    await audiobook.restore(INSTANCE_ID, queue_manager.get_batch_size_for_user(False), queue_manager.segment_seconds)
+
+@app.on_event("startup")
+async def start_loop_monitor():
+    loop_monitor.start()
+
+@app.on_event("startup")
+async def install_drain_handler():
+    # Replaces uvicorn's SIGTERM handler: drain first, then exit through its SIGINT path
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: spawn_task(drain_and_exit()))
+    except (NotImplementedError, RuntimeError, ValueError):
+        logger.warning("SIGTERM drain handler not installed (no signal support in this loop/thread)")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Stopped without SIGTERM (Ctrl+C, reload): still persist whatever is unfinished
+    await drain()
+    loop_monitor.monitor.stop()
+    await llm_client.close()
     client.close()
\ No newline at end of file
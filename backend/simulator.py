@@ -0,0 +1,348 @@
+"""Discrete-event simulator for synthesis queue and scheduler capacity planning
+
+Replays a job mix through the real QueueManager, SegmentDispatcher and
+admission policy from scheduler.py on a virtual clock, with a per-voice cost
+model standing in for Piper inference. Nothing is synthesized, so hours of
+traffic replay in seconds:
+
+    python simulator.py                                         # synthetic mix, current settings
+    python simulator.py --mix jobs.jsonl --costs costs.json
+    python simulator.py --sweep max_concurrent_jobs=2,3,4,6 --sweep workers=8,16
+    python simulator.py --set cpus=4 --sweep free_batch=20,30,50 --json report.json
+
+A job mix is JSON lines, one job per line (arrival in seconds from the start):
+    {"arrival": 12.5, "chars": 8000, "tier": "free", "voice": "ru_RU-irina-medium", "user": "u1"}
+
+A cost model is a JSON object keyed by voice, with "default" for the rest:
+    {"default": {"seconds_per_char": 0.004, "load_seconds": 2.0}, "en_US-lessac-high": {...}}
+"""
+import argparse
+import asyncio
+import heapq
+import itertools
+import json
+import math
+import random
+import sys
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, fields
+from typing import Dict, List, Optional
+
+import scheduler
+from scheduler import QueueJob, QueueManager, SegmentDispatcher, admission_decision, tier_for
+
+DEFAULT_COSTS = {"default": {"seconds_per_char": 0.004, "load_seconds": 2.0}}
+
+@dataclass
+class SimParams:
+    """Settings under test; names are what --set and --sweep accept"""
+    max_concurrent_jobs: int = 3
+    workers: int = 16  # Executor threads, i.e. SegmentDispatcher slots
+    cpus: int = 8  # Segments beyond this many slow each other down
+    pro_batch: int = scheduler.PRO_BATCH_SIZE
+    free_batch: int = scheduler.FREE_BATCH_SIZE
+    admission: bool = True
+    free_max_wait: float = scheduler.ADMISSION_MAX_WAIT_SECONDS["free"]
+    pro_max_wait: float = scheduler.ADMISSION_MAX_WAIT_SECONDS["pro"]
+    max_queue: int = scheduler.ADMISSION_MAX_QUEUE
+    fair_share: str = scheduler.FAIR_SHARE_METRIC  # jobs | cpu_seconds
+    poll_seconds: float = 1.0  # Queue poll interval of /audio/synthesize-with-progress
+    segment_chars: int = 500  # Average segment length produced by split_text_into_segments
+    assemble_seconds_per_segment: float = 0.02
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop whose clock jumps to the next timer instead of sleeping"""
+
+    def __init__(self):
+        super().__init__()
+        self._virtual_now = 0.0
+
+    def time(self) -> float:
+        return self._virtual_now
+
+    def _run_once(self):
+        if not self._ready:
+            # Drop cancelled timers so the heap head is the next real event
+            while self._scheduled and self._scheduled[0]._cancelled:
+                self._timer_cancelled_count -= 1
+                heapq.heappop(self._scheduled)._scheduled = False
+            if self._scheduled:
+                self._virtual_now = max(self._virtual_now, self._scheduled[0]._when)
+        super()._run_once()
+
+@contextmanager
+def applied(params: SimParams):
+    """Point the scheduler module at the simulated settings for one run"""
+    saved = (
+        scheduler.PRO_BATCH_SIZE, scheduler.FREE_BATCH_SIZE,
+        dict(scheduler.ADMISSION_MAX_WAIT_SECONDS), scheduler.ADMISSION_MAX_QUEUE,
+        scheduler.FAIR_SHARE_METRIC, scheduler.clock
+    )
+    scheduler.PRO_BATCH_SIZE = params.pro_batch
+    scheduler.FREE_BATCH_SIZE = params.free_batch
+    scheduler.ADMISSION_MAX_WAIT_SECONDS.update({"free": params.free_max_wait, "pro": params.pro_max_wait})
+    scheduler.ADMISSION_MAX_QUEUE = params.max_queue
+    scheduler.FAIR_SHARE_METRIC = params.fair_share
+    try:
+        yield
+    finally:
+        (scheduler.PRO_BATCH_SIZE, scheduler.FREE_BATCH_SIZE, admission_max_wait,
+         scheduler.ADMISSION_MAX_QUEUE, scheduler.FAIR_SHARE_METRIC, scheduler.clock) = saved
+        scheduler.ADMISSION_MAX_WAIT_SECONDS.update(admission_max_wait)
+
+def synthetic_mix(
+    jobs: int = 300,
+    per_minute: float = 12.0,
+    pro_share: float = 0.2,
+    users: int = 50,
+    mean_chars: int = 6000,
+    voices: Optional[List[str]] = None,
+    seed: int = 1
+) -> List[dict]:
+    """Poisson arrivals, log-normal text lengths, a few heavy users and a few popular voices"""
+    rng = random.Random(seed)
+    voices = voices or ["ru_RU-irina-medium", "ru_RU-denis-medium", "en_US-lessac-medium", "de_DE-thorsten-medium"]
+    user_weights = [1 / (i + 1) for i in range(users)]
+    voice_weights = [1 / (i + 1) for i in range(len(voices))]
+    pro_users = int(users * pro_share)
+
+    mix, arrival = [], 0.0
+    for _ in range(jobs):
+        arrival += rng.expovariate(per_minute / 60)
+        user = rng.choices(range(users), weights=user_weights)[0]
+        chars = int(rng.lognormvariate(math.log(mean_chars) - 0.5, 1.0))
+        mix.append({
+            "arrival": round(arrival, 2),
+            "chars": max(200, min(chars, 60000)),
+            "tier": "pro" if user < pro_users else "free",
+            "voice": rng.choices(voices, weights=voice_weights)[0],
+            "user": f"user{user}"
+        })
+    return mix
+
+def load_mix(path: str) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)], 1)
+
+class Simulation:
+    """One replay of a job mix under one set of parameters"""
+
+    def __init__(self, mix: List[dict], costs: Dict[str, dict], params: SimParams):
+        self.mix = sorted(mix, key=lambda job: job["arrival"])
+        self.costs = costs
+        self.params = params
+        self.loaded_voices = set()
+        self.finished: List[dict] = []
+        self.shed: Dict[str, int] = {"pro": 0, "free": 0}
+        self.busy_slot_seconds = 0.0
+
+    def cost_for(self, voice: str) -> dict:
+        return {**self.costs["default"], **self.costs.get(voice, {})}
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue_manager = QueueManager(max_concurrent_jobs=self.params.max_concurrent_jobs)
+        self.dispatcher = SegmentDispatcher(self.params.workers)
+        await asyncio.gather(*(self.job(idx, spec) for idx, spec in enumerate(self.mix)))
+
+    async def job(self, idx: int, spec: dict):
+        """Same path as the inline /audio/synthesize-with-progress handler"""
+        await asyncio.sleep(spec["arrival"])
+        arrival = self.loop.time()
+        is_pro = spec.get("tier") == "pro"
+        chars = int(spec["chars"])
+        segments = [self.params.segment_chars] * (chars // self.params.segment_chars)
+        if chars % self.params.segment_chars or not segments:
+            segments.append(chars % self.params.segment_chars or chars)
+
+        if self.params.admission:
+            predicted_wait = self.queue_manager.predicted_wait(is_pro, len(segments))
+            if not admission_decision(is_pro, predicted_wait, len(self.queue_manager.queue)).admitted:
+                self.shed[tier_for(is_pro)] += 1
+                return
+
+        job_id = f"job{idx}"
+        queue_job = QueueJob(
+            job_id=job_id,
+            user_id=spec.get("user", job_id),
+            is_pro=is_pro,
+            segments_count=len(segments),
+            predicted_cost=self.queue_manager.predict_cost(len(segments))
+        )
+        await self.queue_manager.add_job(queue_job)
+        while not await self.queue_manager.can_start_job(queue_job):
+            await asyncio.sleep(self.params.poll_seconds)
+        await self.queue_manager.start_job(queue_job)
+        started = self.loop.time()
+
+        cost = self.cost_for(spec["voice"])
+        if spec["voice"] not in self.loaded_voices:
+            self.loaded_voices.add(spec["voice"])
+            await asyncio.sleep(cost["load_seconds"])
+
+        batch_size = self.queue_manager.get_batch_size_for_user(is_pro)
+        for batch_start in range(0, len(segments), batch_size):
+            await asyncio.gather(*(
+                self.segment(job_id, queue_job.deadline, segment_chars * cost["seconds_per_char"])
+                for segment_chars in segments[batch_start:batch_start + batch_size]
+            ))
+        await asyncio.sleep(len(segments) * self.params.assemble_seconds_per_segment)
+
+        finished = self.loop.time()
+        self.queue_manager.record_completion(queue_job, finished - started, finished)
+        self.queue_manager.record_usage(queue_job.user_id, chars * cost["seconds_per_char"])
+        await self.queue_manager.finish_job(job_id)
+        self.finished.append({
+            "tier": queue_job.tier,
+            "user": queue_job.user_id,
+            "arrival": arrival,
+            "wait": started - arrival,
+            "service": finished - started,
+            "turnaround": finished - arrival,
+            "segments": len(segments),
+            "finished": finished
+        })
+
+    async def segment(self, job_id: str, deadline: float, cpu_seconds: float):
+        """Hold a dispatcher slot for the segment's inference time, stretched when CPUs are oversubscribed"""
+        await self.dispatcher.acquire(job_id, deadline)
+        try:
+            duration = cpu_seconds * max(1.0, self.dispatcher.in_flight / self.params.cpus)
+            self.busy_slot_seconds += duration
+            await asyncio.sleep(duration)
+        finally:
+            self.dispatcher.release(job_id)
+
+    def report(self) -> dict:
+        done = self.finished
+        makespan = max((job["finished"] for job in done), default=0.0) - (self.mix[0]["arrival"] if self.mix else 0.0)
+        by_tier = {tier: [job for job in done if job["tier"] == tier] for tier in ("pro", "free")}
+
+        # Jain's index over each user's mean share of time spent being served (1.0 = perfectly fair)
+        user_shares: Dict[str, List[float]] = {}
+        for job in done:
+            user_shares.setdefault(job["user"], []).append(job["service"] / job["turnaround"] if job["turnaround"] else 1.0)
+        shares = [sum(values) / len(values) for values in user_shares.values()]
+        jain = (sum(shares) ** 2) / (len(shares) * sum(s * s for s in shares)) if shares else None
+
+        return {
+            "params": asdict(self.params),
+            "jobs": len(self.mix),
+            "completed": len(done),
+            "shed": self.shed,
+            "makespan_seconds": round(makespan, 1),
+            "throughput": {
+                "jobs_per_hour": round(len(done) / makespan * 3600, 1) if makespan else None,
+                "segments_per_second": round(sum(job["segments"] for job in done) / makespan, 2) if makespan else None,
+                "slot_utilization": round(self.busy_slot_seconds / (self.params.workers * makespan), 3) if makespan else None
+            },
+            "wait": {
+                tier: {"p50": percentile([j["wait"] for j in jobs], 50), "p99": percentile([j["wait"] for j in jobs], 99)}
+                for tier, jobs in (("all", done), *by_tier.items())
+            },
+            "turnaround": {
+                tier: {"p50": percentile([j["turnaround"] for j in jobs], 50), "p99": percentile([j["turnaround"] for j in jobs], 99)}
+                for tier, jobs in (("all", done), *by_tier.items())
+            },
+            "fairness": {
+                "jain_index": round(jain, 3) if jain is not None else None,
+                "mean_slowdown": {
+                    tier: round(sum(j["turnaround"] / j["service"] for j in jobs) / len(jobs), 2) if jobs else None
+                    for tier, jobs in by_tier.items()
+                }
+            },
+            "sla": {tier: stats["attainment"] for tier, stats in self.queue_manager.sla_report().items()}
+        }
+
+def simulate(mix: List[dict], costs: Dict[str, dict], params: SimParams) -> dict:
+    """Run one simulation on a fresh virtual-clock loop and return its report"""
+    loop = VirtualClockLoop()
+    simulation = Simulation(mix, costs, params)
+    with applied(params):
+        scheduler.clock = loop.time
+        try:
+            loop.run_until_complete(simulation.run())
+        finally:
+            loop.close()
+    return simulation.report()
+
+def parse_value(name: str, raw: str):
+    field_type = {f.name: f.type for f in fields(SimParams)}[name]
+    if field_type is bool:
+        return raw.lower() in ("1", "true", "yes", "on")
+    return field_type(raw)
+
+def print_table(reports: List[dict], swept: List[str]):
+    columns = swept + ["done", "shed", "jobs/h", "util", "wait p50", "wait p99", "pro p99", "free p99", "jain", "sla pro", "sla free"]
+    rows = []
+    for r in reports:
+        rows.append([str(r["params"][name]) for name in swept] + [
+            str(r["completed"]),
+            str(r["shed"]["pro"] + r["shed"]["free"]),
+            str(r["throughput"]["jobs_per_hour"]),
+            str(r["throughput"]["slot_utilization"]),
+            str(r["wait"]["all"]["p50"]),
+            str(r["wait"]["all"]["p99"]),
+            str(r["wait"]["pro"]["p99"]),
+            str(r["wait"]["free"]["p99"]),
+            str(r["fairness"]["jain_index"]),
+            str(r["sla"]["pro"]),
+            str(r["sla"]["free"])
+        ])
+    widths = [max(len(col), *(len(row[i]) for row in rows)) for i, col in enumerate(columns)]
+    print("  ".join(col.rjust(w) for col, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(cell.rjust(w) for cell, w in zip(row, widths)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a job mix through the synthesis scheduler on a virtual clock")
+    parser.add_argument("--mix", help="JSON lines job mix (default: synthetic)")
+    parser.add_argument("--costs", help="JSON per-voice cost model")
+    parser.add_argument("--jobs", type=int, default=300, help="synthetic mix: number of jobs")
+    parser.add_argument("--per-minute", type=float, default=12.0, help="synthetic mix: mean arrivals per minute")
+    parser.add_argument("--pro-share", type=float, default=0.2, help="synthetic mix: share of Pro users")
+    parser.add_argument("--mean-chars", type=int, default=6000, help="synthetic mix: mean text length")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="override a SimParams field")
+    parser.add_argument("--sweep", action="append", default=[], metavar="NAME=V1,V2", help="try each value of a field")
+    parser.add_argument("--json", help="also write full reports to this file")
+    args = parser.parse_args()
+
+    mix = load_mix(args.mix) if args.mix else synthetic_mix(
+        jobs=args.jobs, per_minute=args.per_minute, pro_share=args.pro_share, mean_chars=args.mean_chars, seed=args.seed
+    )
+    costs = DEFAULT_COSTS
+    if args.costs:
+        with open(args.costs) as f:
+            costs = {**DEFAULT_COSTS, **json.load(f)}
+
+    base = {}
+    for item in args.set:
+        name, raw = item.split("=", 1)
+        base[name] = parse_value(name, raw)
+    sweeps = {}
+    for item in args.sweep:
+        name, raw = item.split("=", 1)
+        sweeps[name] = [parse_value(name, value) for value in raw.split(",")]
+
+    reports = []
+    for combination in itertools.product(*sweeps.values()):
+        params = SimParams(**{**base, **dict(zip(sweeps.keys(), combination))})
+        reports.append(simulate(mix, costs, params))
+
+    print(f"{len(mix)} jobs over {mix[-1]['arrival'] / 60:.0f} min" if mix else "Empty job mix")
+    print_table(reports, list(sweeps.keys()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+        print(f"Reports written to {args.json}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""Generate-and-speak: synthesis of a script that is still being written
+
+The text side streams the script (textgen.generate_script with stream=True);
+SegmentFeed turns its deltas into synthesis segments in text order as soon as
+their sentences are complete, and the synthesis pipeline takes them as an
+async iterator. Narration starts after the first sentences instead of after
+the whole script, so a long script costs about max(LLM time, TTS time)
+rather than their sum.
+
+Outline sections are written concurrently but spoken in order: deltas of a
+later section are held until every earlier one is done.
+
+The WAV is appended to (in the job's temp dir) while segments arrive; live_wav()
+serves it as it grows and follows it into the audio dir when it is complete (a streaming WAV header with open-ended sizes), so playback can start
+before synthesis is finished.
+"""
+import asyncio
+import logging
+import os
+import struct
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+import pools
+from engine import split_text_into_segments
+from tts_stream import SentenceSplitter
+
+logger = logging.getLogger(__name__)
+
+# The first segment is short so audio starts early; later ones are full size
+SPEAK_FIRST_SEGMENT_CHARS = int(os.environ.get('SPEAK_FIRST_SEGMENT_CHARS', 150))
+SPEAK_SEGMENT_CHARS = int(os.environ.get('SPEAK_SEGMENT_CHARS', 600))
+LIVE_WAV_POLL_SECONDS = float(os.environ.get('LIVE_WAV_POLL_SECONDS', 0.25))
+LIVE_WAV_CHUNK_BYTES = 64 * 1024
+
+# Header size of the PCM WAV files the pipeline writes (wave module: RIFF + fmt + data)
+WAV_HEADER_BYTES = 44
+
+def expected_segments(target_words: int) -> int:
+    """Segment count a script of target_words will roughly split into (~7 chars per word)"""
+    return max(1, target_words * 7 // SPEAK_SEGMENT_CHARS)
+
+class SegmentFeed:
+    """Synthesis segments from streamed script events, in text order
+    add() takes 'delta' and 'section_done' events, finish() ends the text;
+    iterating yields segments until then."""
+
+    def __init__(self):
+        self.splitter = SentenceSplitter()
+        self.current = 0
+        self.done = set()
+        # Text of sections after the current one, held until it is done
+        self.held: Dict[int, str] = {}
+        self.sentences: List[str] = []
+        self.emitted = 0
+        self.segments: asyncio.Queue = asyncio.Queue()
+        self.error: Optional[BaseException] = None
+
+    def add(self, event: dict):
+        if event['type'] == 'delta':
+            if event['section'] == self.current:
+                self.take(self.splitter.feed(event['text']))
+            else:
+                self.held[event['section']] = self.held.get(event['section'], "") + event['text']
+        elif event['type'] == 'section_done':
+            self.done.add(event['section'])
+            while self.current in self.done:
+                # A section ends at a sentence boundary
+                self.take(self.splitter.flush())
+                self.current += 1
+                self.take(self.splitter.feed(self.held.pop(self.current, "")))
+
+    def finish(self, error: Optional[BaseException] = None):
+        """End of the text; with error, iteration raises it once queued segments are used up"""
+        self.take(self.splitter.flush())
+        self.take([], final=True)
+        self.error = error
+        self.segments.put_nowait(None)
+
+    def take(self, sentences: List[str], final: bool = False):
+        self.sentences.extend(sentences)
+        group = " ".join(self.sentences)
+        limit = SPEAK_FIRST_SEGMENT_CHARS if self.emitted == 0 else SPEAK_SEGMENT_CHARS
+        if group and (final or len(group) >= limit):
+            self.sentences = []
+            for segment in split_text_into_segments(group):
+                self.segments.put_nowait(segment)
+                self.emitted += 1
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        while True:
+            segment = await self.segments.get()
+            if segment is None:
+                break
+            yield segment
+        if self.error is not None:
+            raise self.error
+
+def streaming_header(header: bytes) -> bytes:
+    """WAV header with RIFF and data sizes set to the maximum, as for a stream of unknown length"""
+    return header[:4] + struct.pack('<I', 0xFFFFFFFF) + header[8:40] + struct.pack('<I', 0xFFFFFFFF)
+
+def read_from(paths: List[Path], offset: int, size: int) -> bytes:
+    """Bytes of the first of paths that exists (the file moves from the first to the second when complete)"""
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                return f.read(size)
+        except FileNotFoundError:
+            continue
+    return b""
+
+async def live_wav(paths: List[Path], is_running: Callable[[], bool]) -> AsyncIterator[bytes]:
+    """The WAV being written at paths[0] and moved to paths[1], ending once is_running() is false and it is read to the end"""
+    header = b""
+    while len(header) < WAV_HEADER_BYTES:
+        running = is_running()
+        header = await pools.file_io.run(read_from, paths, 0, WAV_HEADER_BYTES)
+        if len(header) < WAV_HEADER_BYTES:
+            if not running:
+                return
+            await asyncio.sleep(LIVE_WAV_POLL_SECONDS)
+    yield streaming_header(header)
+
+    offset = WAV_HEADER_BYTES
+    while True:
+        # Checked before reading, so the last read after the job ends sees the whole file
+        running = is_running()
+        data = await pools.file_io.run(read_from, paths, offset, LIVE_WAV_CHUNK_BYTES)
+        if data:
+            offset += len(data)
+            yield data
+        elif not running:
+            return
+        else:
+            await asyncio.sleep(LIVE_WAV_POLL_SECONDS)
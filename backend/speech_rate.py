@@ -0,0 +1,148 @@
+"""Speaking rates learned from finished audio
+
+Piper voices do not all speak at 150 words per minute: languages differ in word
+length and voices in pace. Every finished generation in audio_generations has
+its text and word count, voice, language, rate and measured duration, so the words per minute
+and characters per second of each voice are known after a few generations.
+refresh() aggregates the latest SPEECH_RATE_HISTORY of them (server-side) into
+three levels, most specific first:
+
+    voice and rate  - as measured
+    voice           - all rates, normalized to rate 1.0 (Piper's length_scale is 1 / rate)
+    language        - all voices of the language, normalized the same way
+
+A level is used once it has SPEECH_RATE_MIN_SAMPLES generations; otherwise the
+next one, and finally SPEECH_RATE_DEFAULT_WPM. textgen.calculate_word_count and
+engine.estimate_duration read the result, so "10 minutes" asks the LLM for the
+words a 10-minute narration in that language and voice needs.
+"""
+import asyncio
+import logging
+import os
+from typing import Dict, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SPEECH_RATE_DEFAULT_WPM = float(os.environ.get('SPEECH_RATE_DEFAULT_WPM', 150))
+SPEECH_RATE_MIN_SAMPLES = int(os.environ.get('SPEECH_RATE_MIN_SAMPLES', 3))
+SPEECH_RATE_MIN_SECONDS = float(os.environ.get('SPEECH_RATE_MIN_SECONDS', 20))
+SPEECH_RATE_HISTORY = int(os.environ.get('SPEECH_RATE_HISTORY', 2000))
+SPEECH_RATE_REFRESH_SECONDS = float(os.environ.get('SPEECH_RATE_REFRESH_SECONDS', 900))
+
+# Measurements further than this factor from the default are broken (silence, wrong duration) and skipped
+PLAUSIBLE_FACTOR = 2.5
+
+# Totals per level: {"words", "chars", "seconds", "samples"}; seconds are at rate 1.0 except by_voice_rate
+by_voice_rate: Dict[Tuple[str, float], dict] = {}
+by_voice: Dict[str, dict] = {}
+by_language: Dict[str, dict] = {}
+
+def language_key(language: Optional[str]) -> str:
+    """Primary language subtag: en-US, en_GB and en share their rates"""
+    return (language or "").replace("_", "-").split("-")[0].lower()
+
+def rate_key(rate: float) -> float:
+    return round(float(rate or 1.0), 2)
+
+def measured(language: Optional[str], voice: Optional[str], rate: float) -> Tuple[Optional[dict], float]:
+    """Most specific totals with enough samples, and the factor from their rate to the requested one"""
+    stats = by_voice_rate.get((voice, rate_key(rate))) if voice else None
+    if stats and stats["samples"] >= SPEECH_RATE_MIN_SAMPLES:
+        return stats, 1.0
+    for stats in (by_voice.get(voice) if voice else None, by_language.get(language_key(language))):
+        if stats and stats["samples"] >= SPEECH_RATE_MIN_SAMPLES:
+            return stats, rate or 1.0
+    return None, rate or 1.0
+
+def words_per_minute(language: Optional[str] = None, voice: Optional[str] = None, rate: float = 1.0) -> float:
+    stats, factor = measured(language, voice, rate)
+    if stats is None:
+        return SPEECH_RATE_DEFAULT_WPM * factor
+    return stats["words"] / stats["seconds"] * 60 * factor
+
+def chars_per_second(language: Optional[str] = None, voice: Optional[str] = None, rate: float = 1.0) -> Optional[float]:
+    """None until something was measured (then durations are estimated from words)"""
+    stats, factor = measured(language, voice, rate)
+    if stats is None:
+        return None
+    return stats["chars"] / stats["seconds"] * factor
+
+def add(totals: dict, key, words: int, chars: int, seconds: float, samples: int):
+    entry = totals.setdefault(key, {"words": 0, "chars": 0, "seconds": 0.0, "samples": 0})
+    entry["words"] += words
+    entry["chars"] += chars
+    entry["seconds"] += seconds
+    entry["samples"] += samples
+
+async def refresh(db):
+    """Recompute the rates from the latest finished generations"""
+    groups = await db.audio_generations.aggregate([
+        {"$match": {"duration": {"$gte": SPEECH_RATE_MIN_SECONDS}, "text": {"$type": "string"}}},
+        {"$sort": {"created_at": -1}},
+        {"$limit": SPEECH_RATE_HISTORY},
+        {"$project": {
+            "voice": 1,
+            "language": 1,
+            "rate": 1,
+            "duration": 1,
+            "chars": {"$strLenCP": "$text"},
+            # Counted as len(text.split()), like the word targets; older records lack word_count
+            "words": {"$ifNull": ["$word_count", {"$size": {"$regexFindAll": {"input": "$text", "regex": r"\S+"}}}]}
+        }},
+        {"$group": {
+            "_id": {"voice": "$voice", "language": "$language", "rate": "$rate"},
+            "words": {"$sum": "$words"},
+            "chars": {"$sum": "$chars"},
+            "seconds": {"$sum": "$duration"},
+            "samples": {"$sum": 1}
+        }}
+    ]).to_list(None)
+
+    voice_rate, voice, language = {}, {}, {}
+    for group in groups:
+        key = group["_id"]
+        rate = rate_key(key.get("rate"))
+        if not key.get("voice") or group["seconds"] <= 0:
+            continue
+        wpm = group["words"] / group["seconds"] * 60
+        expected = SPEECH_RATE_DEFAULT_WPM * rate
+        if not expected / PLAUSIBLE_FACTOR <= wpm <= expected * PLAUSIBLE_FACTOR:
+            logger.warning(f"Ignoring implausible speaking rate {wpm:.0f} wpm for {key}")
+            continue
+        words, chars, seconds, samples = group["words"], group["chars"], group["seconds"], group["samples"]
+        add(voice_rate, (key["voice"], rate), words, chars, seconds, samples)
+        # Normalized to rate 1.0
+        add(voice, key["voice"], words, chars, seconds * rate, samples)
+        add(language, language_key(key.get("language")), words, chars, seconds * rate, samples)
+
+    by_voice_rate.clear()
+    by_voice_rate.update(voice_rate)
+    by_voice.clear()
+    by_voice.update(voice)
+    by_language.clear()
+    by_language.update(language)
+    metrics.set_gauge("speech_rate_voices", len(by_voice))
+    logger.info(f"Speaking rates refreshed: {len(by_voice)} voices, {len(by_language)} languages")
+
+async def refresh_periodically(db):
+    while True:
+        try:
+            await refresh(db)
+        except Exception as e:
+            logger.error(f"Error refreshing speaking rates: {str(e)}")
+        await asyncio.sleep(SPEECH_RATE_REFRESH_SECONDS)
+
+def snapshot() -> dict:
+    """Words per minute at rate 1.0 per language and voice"""
+    return {
+        "languages": {
+            key: {"wpm": round(stats["words"] / stats["seconds"] * 60, 1), "samples": stats["samples"]}
+            for key, stats in by_language.items()
+        },
+        "voices": {
+            key: {"wpm": round(stats["words"] / stats["seconds"] * 60, 1), "samples": stats["samples"]}
+            for key, stats in by_voice.items()
+        }
+    }
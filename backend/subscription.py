@@ -6,6 +6,7 @@ from typing import Optional
 from fastapi import HTTPException
 from motor.motor_asyncio import AsyncIOMotorClient
 from models import Subscription, SubscriptionResponse, User
+from usage import get_usage, QUOTA_MODE, FREE_TIER_DAILY_CPU_SECONDS, FREE_TIER_DAILY_AUDIO_MINUTES
 import paypalrestsdk
 from dotenv import load_dotenv
 from pathlib import Path
@@ -109,24 +110,45 @@ async def check_can_generate(user_id: str) -> dict:
                 "can_generate": True,
                 "tier": "pro",
                 "usage_today": 0,
-                "limit": None
+                "limit": None,
+                "quota_mode": QUOTA_MODE
             }
         
         # Free users have daily limit
         usage_today = await get_usage_count(user_id, hours=24)
-        can_generate = usage_today < FREE_TIER_DAILY_LIMIT
+        if QUOTA_MODE == "count":
+            return {
+                "can_generate": usage_today < FREE_TIER_DAILY_LIMIT,
+                "tier": "free",
+                "usage_today": usage_today,
+                "limit": FREE_TIER_DAILY_LIMIT,
+                "quota_mode": QUOTA_MODE
+            }
         
+        # Compute-based quota: metered CPU-seconds or audio minutes from the usage ledger
+        compute = await get_usage(user_id, hours=24)
+        compute_limit = FREE_TIER_DAILY_CPU_SECONDS if QUOTA_MODE == "cpu_seconds" else FREE_TIER_DAILY_AUDIO_MINUTES
         return {
-            "can_generate": can_generate,
+            "can_generate": compute[QUOTA_MODE] < compute_limit,
             "tier": "free",
             "usage_today": usage_today,
-            "limit": FREE_TIER_DAILY_LIMIT
+            "limit": None,
+            "quota_mode": QUOTA_MODE,
+            "compute_used": compute[QUOTA_MODE],
+            "compute_limit": compute_limit
         }
         
     except Exception as e:
         logger.error(f"Error checking generation limit: {str(e)}")
         raise HTTPException(status_code=500, detail="Error checking limits")
 
+def limit_message(usage_info: dict) -> str:
+    """User-facing message for a free user who hit the daily quota"""
+    if usage_info.get("quota_mode", "count") == "count":
+        return f'Достигнут дневной лимит ({usage_info["limit"]} генераций). Обновитесь до Pro для безлимитного доступа.'
+    unit = "CPU-секунд" if usage_info["quota_mode"] == "cpu_seconds" else "минут аудио"
+    return f'Достигнут дневной лимит ({usage_info["compute_used"]:g} из {usage_info["compute_limit"]:g} {unit}). Обновитесь до Pro для безлимитного доступа.'
+
 async def get_subscription_status(user_id: str) -> SubscriptionResponse:
     """Get full subscription status for user"""
     try:
@@ -139,7 +161,10 @@ async def get_subscription_status(user_id: str) -> SubscriptionResponse:
             usage_today=usage_info["usage_today"],
             limit=usage_info["limit"],
             can_generate=usage_info["can_generate"],
-            expires_at=subscription.expires_at
+            expires_at=subscription.expires_at,
+            quota_mode=usage_info.get("quota_mode", "count"),
+            compute_used=usage_info.get("compute_used"),
+            compute_limit=usage_info.get("compute_limit")
         )
         
     except Exception as e:
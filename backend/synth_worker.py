@@ -0,0 +1,266 @@
+"""Synthesis worker: leases jobs from the durable Mongo queue and runs Piper
+
+Run one or more of these next to the API (SYNTHESIS_MODE=queue):
+
+    python synth_worker.py
+
+API and worker nodes scale independently; they only share MongoDB and the
+AUDIO_OUTPUT_DIR volume.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import socket
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from pymongo import ReturnDocument
+
+import job_queue
+import engine
+import loop_monitor
+import pools
+import usage as usage_ledger
+from engine import get_audio_dir, release_voice, split_text_into_segments, completion_event, metered_usage
+from pipeline import run_synthesis
+from jobs import SynthesisJob, JobCancelled, CANCEL_DRAIN_TIMEOUT
+from scheduler import QueueJob, QueueManager
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("synth_worker")
+
+WORKER_ID = os.environ.get('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+WORKER_CONCURRENCY = int(os.environ.get('SYNTH_WORKER_CONCURRENCY', 3))  # Same as API queue_manager
+POLL_SECONDS = float(os.environ.get('SYNTH_WORKER_POLL_SECONDS', 1.0))
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get('DRAIN_TIMEOUT_SECONDS', 25))  # Same as the API
+
+class SynthWorker:
+    """Leases queued jobs up to WORKER_CONCURRENCY at a time and synthesizes them"""
+
+    def __init__(self, worker_id: str = WORKER_ID, concurrency: int = WORKER_CONCURRENCY):
+        self.worker_id = worker_id
+        self.queue_manager = QueueManager(max_concurrent_jobs=concurrency)
+        self.running: Dict[str, SynthesisJob] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.cancel_requested_at: Dict[str, datetime] = {}
+        self.stopping = asyncio.Event()
+        # Voice-affinity counters: leases for a voice already in memory vs cold loads
+        self.stats = {"warm_leases": 0, "cold_leases": 0}
+        self.last_report = 0.0
+
+    async def run(self):
+        await job_queue.ensure_indexes()
+        logger.info(f"Worker {self.worker_id} started (concurrency {self.queue_manager.max_concurrent_jobs})")
+
+        last_expiry_check = 0.0
+        while not self.stopping.is_set():
+            if time.time() - last_expiry_check > job_queue.LEASE_SECONDS:
+                await job_queue.expire_stale_jobs()
+                last_expiry_check = time.time()
+
+            if time.time() - self.last_report > job_queue.HEARTBEAT_SECONDS:
+                await self.report()
+
+            if len(self.running) < self.queue_manager.max_concurrent_jobs:
+                job_doc = await job_queue.lease_with_affinity(self.worker_id, self.resident_voices())
+                if job_doc:
+                    self.stats[f"{job_doc['affinity']}_leases"] += 1
+                    self.start(job_doc)
+                    await self.report()
+                    continue
+
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+        await self.shutdown()
+
+    def resident_voices(self) -> List[str]:
+        return sorted(engine.loaded_voices.keys())
+
+    async def report(self):
+        """Publish capacity and resident voices so other workers can route around us"""
+        await job_queue.report_worker(
+            self.worker_id,
+            self.queue_manager.max_concurrent_jobs,
+            len(self.running),
+            self.resident_voices(),
+            self.stats
+        )
+        self.last_report = time.time()
+
+    def start(self, job_doc: dict):
+        job = SynthesisJob(job_doc["_id"], job_doc["user_id"])
+        if job_doc.get("deadline"):
+            job.deadline = job_doc["deadline"].replace(tzinfo=timezone.utc).timestamp()
+        self.running[job.job_id] = job
+        task = asyncio.get_event_loop().create_task(self.process(job, job_doc))
+        self.tasks[job.job_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job.job_id, None))
+
+    async def process(self, job: SynthesisJob, job_doc: dict):
+        """Run one leased job to completion, failure or cancellation"""
+        job_id = job.job_id
+        queue_job = QueueJob(
+            job_id=job_id,
+            user_id=job.user_id,
+            is_pro=job_doc["is_pro"],
+            segments_count=job_doc["segments_count"],
+            deadline=job.deadline or 0.0
+        )
+        await self.queue_manager.start_job(queue_job)
+        heartbeat_task = asyncio.get_event_loop().create_task(self.heartbeat(job))
+        logger.info(
+            f"Leased job {job_id} (attempt {job_doc['attempts']}, {job_doc['segments_count']} segments, "
+            f"{job_doc['affinity']} voice {job_doc['voice']})"
+        )
+
+        try:
+            audio_id = str(uuid.uuid4())
+            audio_dir = get_audio_dir()
+            job.temp_dir = audio_dir / f"temp_{audio_id}"
+            job.temp_dir.mkdir(exist_ok=True)
+            job.status = "running"
+            generation_start_time = time.time()
+
+            segments = split_text_into_segments(job_doc["text"])
+            batch_size = self.queue_manager.get_batch_size_for_user(job_doc["is_pro"])
+
+            async for event in run_synthesis(
+                job, segments, job_doc["voice"], job_doc["rate"], batch_size,
+                audio_dir, audio_id, job_doc["estimated_audio_minutes"]
+            ):
+                if event['type'] == 'result':
+                    final_file = Path(event['audio_path'])
+                    audio_duration = event['duration']
+                elif not await job_queue.push_event(job_id, self.worker_id, event):
+                    job.cancel("Lease lost")
+
+            job.check_cancelled()
+            total_generation_time = time.time() - generation_start_time
+            final_speed = (audio_duration / 60) / total_generation_time if total_generation_time > 0 else 0
+
+            usage = metered_usage(job, audio_duration)
+            audio_doc = {
+                "id": audio_id,
+                "user_id": job.user_id,
+                "text": job_doc["text"],
+                "word_count": len(job_doc["text"].split()),
+                "voice": job_doc["voice"],
+                "rate": job_doc["rate"],
+                "language": job_doc["language"],
+                "audio_path": str(final_file),
+                "duration": audio_duration,
+                "generation_time": total_generation_time,
+                "generation_speed": final_speed,
+                **usage,
+                "segment_failures": job.segment_failures,
+                "job_id": job_id,
+                "worker_id": self.worker_id,
+                "created_at": datetime.now(timezone.utc).isoformat()
+            }
+            # A job re-leased after its lease expired can be finished twice; the first record wins
+            stored = await job_queue.db.audio_generations.find_one_and_update(
+                {"job_id": job_id},
+                {"$setOnInsert": audio_doc},
+                upsert=True,
+                projection={"_id": 0, "id": 1, "audio_path": 1, "duration": 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if stored["id"] != audio_id:
+                logger.warning(f"Job {job_id} is already recorded as audio {stored['id']}, dropping {audio_id}")
+                await pools.file_io.run(final_file.unlink, True)
+                audio_id, final_file, audio_duration = stored["id"], Path(stored["audio_path"]), stored["duration"]
+            await usage_ledger.record_usage(job.user_id, job_id, usage["cpu_seconds"], audio_duration, len(segments))
+
+            job.status = "completed"
+            await job_queue.complete_job(
+                job_id,
+                self.worker_id,
+                {"audio_id": audio_id, "audio_path": str(final_file), "duration": audio_duration, "cpu_seconds": usage["cpu_seconds"]},
+                completion_event(audio_id, audio_duration, total_generation_time, usage, job.segment_failures),
+                deadline=job_doc.get("deadline")
+            )
+            logger.info(f"Job {job_id} completed: {audio_duration:.1f}s audio in {total_generation_time:.1f}s")
+
+        except JobCancelled as e:
+            await job.wait_idle(CANCEL_DRAIN_TIMEOUT)
+            if self.stopping.is_set() and job.cancel_reason == "Worker shutting down":
+                await job_queue.release_lease(job_id, self.worker_id)
+                logger.info(f"Job {job_id} handed back to the queue")
+            else:
+                await job_queue.mark_cancelled(job_id, self.worker_id, self.cancel_latency(job))
+                logger.info(f"Job {job_id} cancelled: {str(e)}")
+
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}", exc_info=True)
+            job.status = "failed"
+            status = await job_queue.fail_job(job_id, self.worker_id, str(e))
+            logger.info(f"Job {job_id} is now {status}")
+
+        finally:
+            heartbeat_task.cancel()
+            await job.wait_idle(CANCEL_DRAIN_TIMEOUT)
+            if job.voice_key:
+                release_voice(job.voice_key)
+            if job.temp_dir is not None:
+                await pools.file_io.run(shutil.rmtree, job.temp_dir, True)
+            await self.queue_manager.finish_job(job_id)
+            self.running.pop(job_id, None)
+            self.cancel_requested_at.pop(job_id, None)
+            if not self.stopping.is_set():
+                await self.report()
+
+    async def heartbeat(self, job: SynthesisJob):
+        """Keep the lease alive and pick up cancel requests from the API"""
+        while True:
+            await asyncio.sleep(job_queue.HEARTBEAT_SECONDS)
+            job_doc = await job_queue.heartbeat(job.job_id, self.worker_id)
+            if job_doc is None:
+                job.cancel("Lease lost")
+                return
+            if job_doc.get("cancel_requested"):
+                self.cancel_requested_at[job.job_id] = job_doc.get("cancel_requested_at")
+                job.cancel("Cancelled by user")
+                return
+
+    def cancel_latency(self, job: SynthesisJob) -> Optional[float]:
+        """Seconds from the API-side cancel request until this worker's CPU was free"""
+        requested_at = self.cancel_requested_at.get(job.job_id)
+        if requested_at is None:
+            return job.time_to_free_cpu
+        if requested_at.tzinfo is None:
+            requested_at = requested_at.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - requested_at).total_seconds()
+
+    async def shutdown(self):
+        """Let running jobs finish until DRAIN_TIMEOUT_SECONDS, hand the rest back to the queue"""
+        if self.tasks:
+            logger.info(f"Draining {len(self.tasks)} jobs for up to {DRAIN_TIMEOUT_SECONDS:.0f}s")
+            await asyncio.wait(list(self.tasks.values()), timeout=DRAIN_TIMEOUT_SECONDS)
+        for job in list(self.running.values()):
+            job.cancel("Worker shutting down")
+        if self.tasks:
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        await job_queue.remove_worker(self.worker_id)
+        logger.info(f"Worker {self.worker_id} stopped")
+
+async def main():
+    worker = SynthWorker()
+    loop_monitor.start()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stopping.set)
+    await worker.run()
+
+if __name__ == "__main__":
+    asyncio.run(main())
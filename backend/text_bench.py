@@ -0,0 +1,176 @@
+"""Benchmark of the text generation path: wall time and length accuracy
+
+Runs textgen.generate_script in-process for a set of cases and reports, per
+case, the wall time, the time to the first streamed delta and how far the
+script's length is from its word target. With llm_fixtures the LLM is a file,
+so runs are offline and repeatable and only our side of the path is measured:
+
+    python text_bench.py --record fixtures/llm.jsonl                   # against LLM_BASE_URL, saves responses
+    python text_bench.py --replay fixtures/llm.jsonl                   # recorded latencies
+    python text_bench.py --replay fixtures/llm.jsonl --time-scale 0    # no LLM latency at all
+    python text_bench.py --replay fixtures/llm.jsonl --json after.json --baseline before.json
+
+A case set is JSON lines, one case per line (mode as TEXT_GENERATION_MODE):
+    {"prompt": "История Байкала", "language": "ru-RU", "duration_minutes": 10, "mode": "outline"}
+
+Replay matches requests by their prompts, so record and replay with the same
+cases and settings that shape prompts (word targets, CHUNK_WORDS, outline
+format). With --baseline the exit status is 1 when a case got slower than
+--max-slowdown times its baseline wall time or its length error grew by more
+than --max-error-increase percentage points.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import List
+
+DEFAULT_CASES = [
+    {"prompt": prompt, "language": language, "duration_minutes": minutes, "mode": mode}
+    for prompt, language in (
+        ("История озера Байкал и его обитатели", "ru-RU"),
+        ("How lighthouses guided ships before radio", "en-US")
+    )
+    for minutes in (1, 5, 10, 20)
+    for mode in ("outline", "sequential")
+    # Up to CHUNK_WORDS it is one call in both modes
+    if minutes > 5 or mode == "outline"
+]
+
+def load_cases(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def case_name(case: dict) -> str:
+    return f"{case['language']} {case['duration_minutes']}m {case.get('mode') or 'default'}"
+
+async def run_case(case: dict) -> dict:
+    import textgen
+
+    target = textgen.calculate_word_count(case["duration_minutes"], case["language"])
+    started = time.perf_counter()
+    first_delta = None
+    text = ""
+    error = None
+    try:
+        async for event in textgen.generate_script(
+            case["prompt"], target, case["language"], mode=case.get("mode"), stream=True
+        ):
+            if event["type"] == "delta" and first_delta is None:
+                first_delta = time.perf_counter() - started
+            elif event["type"] == "result":
+                text = event["text"]
+    except Exception as e:
+        error = str(e)[:200]
+    words = len(text.split())
+    return {
+        "case": case_name(case),
+        "wall_seconds": round(time.perf_counter() - started, 3),
+        "first_delta_seconds": round(first_delta, 3) if first_delta is not None else None,
+        "target_words": target,
+        "words": words,
+        "length_error_pct": round(abs(words - target) / target * 100, 1),
+        "error": error
+    }
+
+async def run(cases: List[dict], repeat: int) -> List[dict]:
+    # One case at a time, so wall times do not include waiting for each other
+    results = []
+    for _ in range(repeat):
+        for case in cases:
+            results.append(await run_case(case))
+    return results
+
+def summarize(results: List[dict]) -> dict:
+    ok = [r for r in results if r["error"] is None]
+    return {
+        "cases": len(results),
+        "failed": len(results) - len(ok),
+        "wall_seconds": round(sum(r["wall_seconds"] for r in ok), 3),
+        "mean_length_error_pct": round(sum(r["length_error_pct"] for r in ok) / len(ok), 1) if ok else None
+    }
+
+def regressions(results: List[dict], baseline: List[dict], max_slowdown: float, max_error_increase: float) -> List[str]:
+    """Cases worse than their baseline (matched by name and order of repetition)"""
+    before = {}
+    for r in baseline:
+        before.setdefault(r["case"], []).append(r)
+    found = []
+    seen = {}
+    for r in results:
+        idx = seen.get(r["case"], 0)
+        seen[r["case"]] = idx + 1
+        earlier = before.get(r["case"], [])
+        if idx >= len(earlier):
+            continue
+        old = earlier[idx]
+        if r["error"] is not None and old["error"] is None:
+            found.append(f"{r['case']}: failed ({r['error']})")
+            continue
+        if r["wall_seconds"] > old["wall_seconds"] * max_slowdown:
+            found.append(f"{r['case']}: {r['wall_seconds']}s, was {old['wall_seconds']}s")
+        if r["length_error_pct"] > old["length_error_pct"] + max_error_increase:
+            found.append(f"{r['case']}: length error {r['length_error_pct']}%, was {old['length_error_pct']}%")
+    return found
+
+def print_table(results: List[dict]):
+    columns = ["case", "wall s", "first delta s", "target", "words", "error %", "failure"]
+    rows = [[
+        r["case"],
+        str(r["wall_seconds"]),
+        str(r["first_delta_seconds"]),
+        str(r["target_words"]),
+        str(r["words"]),
+        str(r["length_error_pct"]),
+        r["error"] or ""
+    ] for r in results]
+    widths = [max(len(col), *(len(row[i]) for row in rows)) for i, col in enumerate(columns)]
+    print("  ".join(col.rjust(w) for col, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(cell.rjust(w) for cell, w in zip(row, widths)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure text generation wall time and length accuracy")
+    fixtures = parser.add_mutually_exclusive_group()
+    fixtures.add_argument("--record", metavar="PATH", help="call LLM_BASE_URL and append its responses to PATH")
+    fixtures.add_argument("--replay", metavar="PATH", help="answer LLM requests from PATH, without the network")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="replay: multiplier of the recorded latencies")
+    parser.add_argument("--cases", help="JSON lines case set (default: built-in)")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run (--json) to compare with")
+    parser.add_argument("--max-slowdown", type=float, default=1.2, help="baseline: allowed wall time ratio")
+    parser.add_argument("--max-error-increase", type=float, default=2.0, help="baseline: allowed length error growth, points")
+    args = parser.parse_args()
+
+    if args.record and not os.environ.get("LLM_BASE_URL"):
+        parser.error("--record needs LLM_BASE_URL (an OpenAI-compatible endpoint)")
+    # llm_fixtures and llm_client read these at import, so they are set before textgen is imported
+    if args.record or args.replay:
+        os.environ["LLM_FIXTURES_MODE"] = "record" if args.record else "replay"
+        os.environ["LLM_FIXTURES_PATH"] = args.record or args.replay
+        os.environ["LLM_FIXTURES_TIME_SCALE"] = str(args.time_scale)
+
+    cases = load_cases(args.cases) if args.cases else DEFAULT_CASES
+    results = asyncio.run(run(cases, args.repeat))
+
+    print_table(results)
+    summary = summarize(results)
+    print(f"{summary['cases']} cases, {summary['failed']} failed, {summary['wall_seconds']}s in total, "
+          f"mean length error {summary['mean_length_error_pct']}%")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"summary": summary, "results": results}, f, indent=2, ensure_ascii=False)
+        print(f"Results written to {args.json}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f)["results"], args.max_slowdown, args.max_error_increase)
+        for line in found:
+            print(f"REGRESSION {line}")
+        return 1 if found else 0
+    return 1 if summary["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
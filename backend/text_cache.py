@@ -0,0 +1,128 @@
+"""Cache of generated scripts for repeated prompts
+
+Users often ask for the same script again: after a failed synthesis, or from
+the history page. Every generated script is stored under a key made of the
+normalized prompt (case, Unicode form, punctuation and spacing do not matter),
+the language and a duration bucket (exact minutes up to TEXT_CACHE_EXACT_MINUTES,
+then rounded to TEXT_CACHE_BUCKET_MINUTES). With the opt-in reuse_cached flag
+the text endpoints answer from the cache instead of the LLM: instantly, and
+without a request to the provider or a slot in the concurrency limiter.
+
+Entries live in Mongo (text_cache collection, removed by a TTL index after
+TEXT_CACHE_TTL_HOURS) behind an in-memory LRU of TEXT_CACHE_MEMORY_ENTRIES.
+Lookups count text_cache_lookups{result=hit|miss} for the hit rate.
+"""
+import hashlib
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+db = client[os.environ['DB_NAME']]
+
+TEXT_CACHE_TTL_HOURS = float(os.environ.get('TEXT_CACHE_TTL_HOURS', 168))
+TEXT_CACHE_MEMORY_ENTRIES = int(os.environ.get('TEXT_CACHE_MEMORY_ENTRIES', 256))
+TEXT_CACHE_EXACT_MINUTES = int(os.environ.get('TEXT_CACHE_EXACT_MINUTES', 10))
+TEXT_CACHE_BUCKET_MINUTES = int(os.environ.get('TEXT_CACHE_BUCKET_MINUTES', 5))
+
+# key -> (expires_at, entry), least recently used first
+memory: "OrderedDict[str, tuple]" = OrderedDict()
+
+async def ensure_indexes():
+    await db.text_cache.create_index("created_at", expireAfterSeconds=int(TEXT_CACHE_TTL_HOURS * 3600))
+
+def normalize_prompt(prompt: str) -> str:
+    """Prompt without differences in case, Unicode form, punctuation and spacing"""
+    text = unicodedata.normalize("NFKC", prompt).casefold()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+def duration_bucket(duration_minutes: int) -> int:
+    if duration_minutes <= TEXT_CACHE_EXACT_MINUTES:
+        return duration_minutes
+    return TEXT_CACHE_BUCKET_MINUTES * round(duration_minutes / TEXT_CACHE_BUCKET_MINUTES)
+
+def cache_key(prompt: str, language: str, duration_minutes: int) -> str:
+    parts = f"{normalize_prompt(prompt)}\n{language.lower()}\n{duration_bucket(duration_minutes)}"
+    return hashlib.sha256(parts.encode("utf-8")).hexdigest()
+
+def remember(key: str, entry: dict, created_at: float):
+    memory[key] = (created_at + TEXT_CACHE_TTL_HOURS * 3600, entry)
+    memory.move_to_end(key)
+    while len(memory) > TEXT_CACHE_MEMORY_ENTRIES:
+        memory.popitem(last=False)
+
+async def lookup(prompt: str, language: str, duration_minutes: int) -> Optional[dict]:
+    """Cached entry {text, word_count, generation_id} for the request, or None"""
+    key = cache_key(prompt, language, duration_minutes)
+    cached = memory.get(key)
+    if cached is not None:
+        expires_at, entry = cached
+        if expires_at > time.time():
+            memory.move_to_end(key)
+            metrics.incr("text_cache_lookups", result="hit")
+            metrics.incr("text_cache_hits", layer="memory")
+            return entry
+        del memory[key]
+
+    entry = None
+    try:
+        doc = await db.text_cache.find_one({"_id": key})
+        if doc is not None:
+            entry = {"text": doc["text"], "word_count": doc["word_count"], "generation_id": doc["generation_id"]}
+            created_at = doc["created_at"].replace(tzinfo=timezone.utc)
+            remember(key, entry, created_at.timestamp())
+    except Exception as e:
+        logger.error(f"Error reading text cache: {str(e)}")
+
+    if entry is None:
+        metrics.incr("text_cache_lookups", result="miss")
+        return None
+    metrics.incr("text_cache_lookups", result="hit")
+    metrics.incr("text_cache_hits", layer="mongo")
+    return entry
+
+async def store(prompt: str, language: str, duration_minutes: int, text: str, generation_id: str):
+    """Cache a freshly generated script (the latest one wins)"""
+    key = cache_key(prompt, language, duration_minutes)
+    entry = {"text": text, "word_count": len(text.split()), "generation_id": generation_id}
+    created_at = datetime.now(timezone.utc)
+    remember(key, entry, created_at.timestamp())
+    try:
+        await db.text_cache.replace_one(
+            {"_id": key},
+            {**entry, "language": language, "duration_minutes": duration_minutes, "created_at": created_at},
+            upsert=True
+        )
+    except Exception as e:
+        logger.error(f"Error writing text cache: {str(e)}")
+
+async def replay(entry: dict, stream: bool = False) -> AsyncIterator[dict]:
+    """Events of textgen.generate_script for a cached script"""
+    yield {'type': 'progress', 'progress': 100, 'message': 'Использован сохранённый текст', 'cached': True}
+    if stream:
+        yield {'type': 'delta', 'section': 0, 'text': entry['text']}
+        yield {'type': 'section_done', 'section': 0}
+    yield {'type': 'result', 'text': entry['text']}
+
+def snapshot() -> dict:
+    return {
+        "hit_rate": metrics.hit_rate("text_cache_lookups"),
+        "memory_entries": len(memory)
+    }
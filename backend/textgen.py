@@ -0,0 +1,508 @@
+"""Narration script generation with the LLM
+
+Two ways to produce a long script:
+
+    sequential - CHUNK_WORDS at a time, each chunk continuing from the end of
+                 the previous one (one LLM round trip after another)
+    outline    - one call for a compact outline with a word budget per section,
+                 then every section at once (TEXT_PARALLEL_SECTIONS in flight),
+                 each given the whole outline and its neighbours' summaries,
+                 stitched in order. Wall time is about one outline call plus
+                 one section call instead of N chunk calls.
+
+TEXT_GENERATION_MODE picks the default (sequential); a request can ask for
+either mode. Texts up to CHUNK_WORDS are a single call in both modes. generate_script()
+yields progress events for the SSE endpoint and a final 'result' event; with
+stream=True it also yields the text as it is written, as 'delta' events
+coalesced every TEXT_STREAM_COALESCE_MS per section (concurrent outline
+sections interleave, so each delta names its section), and a 'section_done'
+event once a section's text is complete.
+
+For saving partial work, a 'plan' event gives the mode (and outline) once it is
+decided and a 'chunk' event the text of every finished chunk or section.
+Passing those back as resume continues an interrupted generation: finished
+chunks are replayed (as deltas too) and only the missing ones are written.
+
+Target word counts come from the measured speaking rate of the language (and
+voice, when known; see speech_rate). A script that still runs more than
+TEXT_TRIM_TOLERANCE over its target is cut at the sentence end nearest to it
+rather than sent back to the LLM; the 'result' text is then shorter than the
+joined deltas.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import re
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+import llm_client
+import llm_limiter
+import metrics
+import speech_rate
+
+logger = logging.getLogger(__name__)
+
+# Each chunk (or outline section) targets ~1200 words (LLM can handle this comfortably)
+CHUNK_WORDS = 1200
+TEXT_GENERATION_MODE = os.environ.get('TEXT_GENERATION_MODE', 'sequential')  # sequential | outline
+TEXT_PARALLEL_SECTIONS = int(os.environ.get('TEXT_PARALLEL_SECTIONS', 8))
+TEXT_STREAM_COALESCE_SECONDS = float(os.environ.get('TEXT_STREAM_COALESCE_MS', 100)) / 1000
+TEXT_TRIM_TOLERANCE = float(os.environ.get('TEXT_TRIM_TOLERANCE', 0.1))
+
+SENTENCE_END = re.compile(r'[.!?…。！？]+["\'»”’)\]]*(?=\s|$)')
+
+NARRATOR_SYSTEM_MESSAGE = "You are a professional narrator and content writer. Create engaging, natural-flowing narration scripts suitable for audio. Write in a continuous narrative style without section headers or labels. IMPORTANT: Write EXACTLY the requested word count - no more, no less. Be precise with length."
+OUTLINE_SYSTEM_MESSAGE = "You plan narration scripts. Reply with JSON only, no commentary and no code fences."
+
+# Helper function to calculate target word count
+def calculate_word_count(duration_minutes: int, language: Optional[str] = None,
+                         voice: Optional[str] = None, rate: float = 1.0) -> int:
+    """Calculate target word count for desired duration at the measured speaking rate"""
+    return round(duration_minutes * speech_rate.words_per_minute(language, voice, rate))
+
+def trim_to_length(text: str, target_words: int) -> str:
+    """text cut at the sentence end nearest to target_words, if it runs over by more than TEXT_TRIM_TOLERANCE"""
+    if len(text.split()) <= target_words * (1 + TEXT_TRIM_TOLERANCE):
+        return text
+    best_end, best_gap = None, None
+    words, last = 0, 0
+    for match in SENTENCE_END.finditer(text):
+        words += len(text[last:match.end()].split())
+        last = match.end()
+        if best_gap is None or abs(words - target_words) < best_gap:
+            best_end, best_gap = match.end(), abs(words - target_words)
+        if words >= target_words:
+            break
+    if best_end is None:
+        return text
+    return text[:best_end]
+
+def adjusted_word_target(target_words: int) -> int:
+    # For short texts (≤5 minutes = ≤750 words): use EXACT target, no compensation
+    # For long texts (>5 minutes): slight compensation (1.1x) because LLM tends to underproduce
+    if target_words <= 750:
+        return target_words  # No compensation for short texts - be precise!
+    return int(target_words * 1.1)  # Only 10% extra for long texts
+
+class DeltaBuffer:
+    """Text deltas per section since the last take(), for coalesced 'delta' events
+    Joining every section's deltas in section order gives the final text."""
+
+    def __init__(self):
+        self.pending: Dict[int, str] = {}
+        # Trailing whitespace held back until more text follows, as responses are stripped
+        self.held: Dict[int, str] = {}
+        self.started = set()
+
+    def add(self, section: int, text: str, separator: str = ""):
+        if section not in self.started:
+            text = text.lstrip()
+            if not text:
+                return
+            self.started.add(section)
+            # Later sections start with the separator they are joined with
+            if section > 0:
+                text = separator + text
+        text = self.held.pop(section, "") + text
+        stripped = text.rstrip()
+        if len(stripped) < len(text):
+            self.held[section] = text[len(stripped):]
+        if stripped:
+            self.pending[section] = self.pending.get(section, "") + stripped
+
+    def restore(self, section: int, text: str, separator: str):
+        """A section finished before the generation was resumed, as one delta"""
+        self.add(section, text, separator)
+
+    def sink(self, section: int, separator: str) -> Callable[[str], None]:
+        return lambda text: self.add(section, text, separator)
+
+    def take(self) -> List[dict]:
+        events = [{'type': 'delta', 'section': section, 'text': text} for section, text in sorted(self.pending.items())]
+        self.pending.clear()
+        return events
+
+async def complete(user_prompt: str, system_message: str = NARRATOR_SYSTEM_MESSAGE, purpose: str = "chunk",
+                   on_delta: Optional[Callable[[str], None]] = None) -> str:
+    """One LLM call; returns the stripped response text, passing pieces to on_delta as they arrive
+    Without on_delta nothing was passed on yet, so a response that breaks off is requested again."""
+    started = time.perf_counter()
+    if on_delta is None:
+        text = await llm_client.chat(system_message, user_prompt)
+    else:
+        parts = []
+        async for delta in llm_client.stream_chat(system_message, user_prompt):
+            if not parts:
+                metrics.incr("llm_first_token_seconds", time.perf_counter() - started, purpose=purpose)
+            parts.append(delta)
+            on_delta(delta)
+        text = "".join(parts)
+    metrics.incr("llm_calls", purpose=purpose)
+    metrics.incr("llm_seconds", time.perf_counter() - started, purpose=purpose)
+    return text.strip()
+
+# Helper function to generate text chunks
+async def generate_text_chunk(
+    prompt: str,
+    target_words: int,
+    language: str,
+    is_complete: bool = True,
+    is_first: bool = True,
+    is_last: bool = False,
+    previous_content: Optional[str] = None,
+    on_delta: Optional[Callable[[str], None]] = None
+) -> str:
+    """Generate a chunk of text using LLM"""
+    adjusted_words = adjusted_word_target(target_words)
+
+    # Build prompt based on chunk position
+    if is_complete:
+        # Single complete text
+        user_prompt = f"""Create a narration script about: {prompt}
+
+CRITICAL REQUIREMENT: Write EXACTLY {adjusted_words} words in {language}. Not more, not less. This is very important for timing.
+Style: Natural, conversational narration suitable for audio storytelling.
+Write as a continuous narrative without any section labels, headers, or markers like "Introduction", "Conclusion", etc.
+Just tell the story or explain the topic in an engaging, flowing way.
+Be concise and precise - hit exactly {adjusted_words} words."""
+
+    elif is_first:
+        # First chunk of multi-part text
+        user_prompt = f"""Begin a narration script about: {prompt}
+
+This is the opening of a longer narration. Write EXACTLY {adjusted_words} words in {language}.
+Style: Natural, conversational narration suitable for audio.
+Start the story/topic naturally without labels like "Introduction".
+Write in a continuous narrative flow that will continue in the next part.
+End at a natural pause point, but don't conclude the topic.
+Be precise - exactly {adjusted_words} words."""
+
+    elif is_last:
+        # Last chunk
+        context_preview = previous_content[-500:] if previous_content and len(previous_content) > 500 else previous_content
+        user_prompt = f"""Continue and conclude the narration about: {prompt}
+
+Previous content ended with: "...{context_preview}"
+
+Write EXACTLY {adjusted_words} words in {language} to conclude this narration.
+Continue naturally from where the previous part ended.
+Wrap up the topic naturally without using labels like "Conclusion" or "In conclusion".
+Just bring the narrative to a natural, satisfying end.
+Be precise - exactly {adjusted_words} words."""
+
+    else:
+        # Middle chunk
+        context_preview = previous_content[-500:] if previous_content and len(previous_content) > 500 else previous_content
+        user_prompt = f"""Continue the narration about: {prompt}
+
+Previous content ended with: "...{context_preview}"
+
+Write EXACTLY {adjusted_words} words in {language} to continue this narration.
+Continue naturally from where the previous part ended.
+Maintain the same tone and style.
+End at a natural pause point, but don't conclude - there's more to come.
+Be precise - exactly {adjusted_words} words."""
+
+    return await complete(user_prompt, on_delta=on_delta)
+
+async def generate_sequential(prompt: str, target_words: int, language: str,
+                              deltas: Optional[DeltaBuffer] = None,
+                              saved: Optional[Dict[int, str]] = None) -> AsyncIterator[dict]:
+    """Chunk after chunk, each continuing from the previous one; saved chunks are not written again"""
+    num_chunks = (target_words + CHUNK_WORDS - 1) // CHUNK_WORDS
+    chunks: List[str] = []
+    saved = saved or {}
+
+    if not saved:
+        yield {'type': 'plan', 'mode': 'sequential'}
+    yield {'type': 'info', 'message': f'Генерация {num_chunks} частей', 'progress': 0}
+
+    for i in range(num_chunks):
+        if i in saved:
+            chunk_text = saved[i]
+            if deltas:
+                deltas.restore(i, chunk_text, " ")
+        else:
+            remaining_words = target_words - sum(len(chunk.split()) for chunk in chunks)
+            chunk_words = min(CHUNK_WORDS, remaining_words)
+
+            if chunk_words <= 0:
+                break
+
+            chunk_text = await generate_text_chunk(
+                prompt,
+                chunk_words,
+                language,
+                is_complete=False,
+                is_first=(i == 0),
+                is_last=(i == num_chunks - 1),
+                previous_content=" ".join(chunks) if chunks else None,
+                on_delta=deltas.sink(i, " ") if deltas else None
+            )
+            yield {'type': 'chunk', 'section': i, 'text': chunk_text}
+            logger.info(f"Generated chunk {i+1}/{num_chunks}: {len(chunk_text.split())} words")
+
+        chunks.append(chunk_text)
+        if deltas:
+            yield {'type': 'section_done', 'section': i}
+        progress = int(((i + 1) / num_chunks) * 100)
+        yield {'type': 'progress', 'progress': progress, 'message': f'Часть {i+1}/{num_chunks}'}
+
+    yield {'type': 'result', 'text': " ".join(chunks)}
+
+def parse_outline(response: str, sections: int, target_words: int) -> Optional[List[dict]]:
+    """Sections from the outline JSON with budgets rescaled to target_words; None if unusable"""
+    match = re.search(r'\[.*\]', response, re.DOTALL)
+    if not match:
+        return None
+    try:
+        items = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+    outline = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get("summary"):
+            continue
+        try:
+            words = max(1, int(item.get("words") or 0))
+        except (TypeError, ValueError):
+            words = 1
+        outline.append({"title": str(item.get("title") or ""), "summary": str(item["summary"]), "words": words})
+    # A model that ignored the requested count is still fine within reason
+    if not sections // 2 <= len(outline) <= sections * 2:
+        return None
+    total = sum(section["words"] for section in outline)
+    for section in outline:
+        section["words"] = max(50, round(target_words * section["words"] / total))
+    return outline
+
+async def generate_outline(prompt: str, target_words: int, language: str) -> Optional[List[dict]]:
+    sections = (target_words + CHUNK_WORDS - 1) // CHUNK_WORDS
+    user_prompt = f"""Plan a narration script about: {prompt}
+
+The script will be about {target_words} words long, written in {language}, and read aloud as one continuous narration.
+Split it into {sections} consecutive sections that together tell the whole story or cover the topic from opening to conclusion.
+Reply with a JSON array of {sections} objects: {{"title": "...", "summary": "...", "words": N}}
+- summary: 2-3 sentences in {language} on what the section covers and how it connects to the next one
+- words: the section's share of the {target_words} words"""
+
+    response = await complete(user_prompt, OUTLINE_SYSTEM_MESSAGE, purpose="outline")
+    return parse_outline(response, sections, target_words)
+
+def format_outline(outline: List[dict]) -> str:
+    return "\n".join(
+        f"{idx + 1}. {section['title']}: {section['summary']}" for idx, section in enumerate(outline)
+    )
+
+async def generate_section(prompt: str, outline: List[dict], idx: int, language: str,
+                           on_delta: Optional[Callable[[str], None]] = None) -> str:
+    """One outline section, written to join its neighbours without seeing their text"""
+    section = outline[idx]
+    words = adjusted_word_target(section["words"])
+    if idx == 0:
+        position = "This is the opening section: start the narration naturally, without labels like \"Introduction\"."
+    elif idx == len(outline) - 1:
+        position = "This is the final section: bring the narration to a natural, satisfying end without labels like \"Conclusion\"."
+    else:
+        position = "This is a middle section: do not re-introduce the topic and do not conclude it."
+    neighbours = ""
+    if idx > 0:
+        neighbours += f"\nThe previous section covered: {outline[idx - 1]['summary']}\nPick up where it leaves off."
+    if idx < len(outline) - 1:
+        neighbours += f"\nThe next section will cover: {outline[idx + 1]['summary']}\nEnd at a natural pause that leads into it."
+
+    user_prompt = f"""You are writing section {idx + 1} of {len(outline)} of a narration script about: {prompt}
+
+Full outline:
+{format_outline(outline)}
+
+Write section {idx + 1} ("{section['title']}"): {section['summary']}
+{position}{neighbours}
+
+Write EXACTLY {words} words in {language}.
+Style: Natural, conversational narration suitable for audio, in the same voice as the rest of the script.
+No headers, section titles or labels - only the narration text.
+Be precise - exactly {words} words."""
+
+    return await complete(user_prompt, purpose="section", on_delta=on_delta)
+
+async def generate_outlined(prompt: str, target_words: int, language: str,
+                            deltas: Optional[DeltaBuffer] = None, outline: Optional[List[dict]] = None,
+                            saved: Optional[Dict[int, str]] = None) -> AsyncIterator[dict]:
+    """Outline first, then all sections concurrently; falls back to sequential if the outline is unusable
+    With a saved outline, only the sections missing from saved are written."""
+    saved = saved or {}
+    if outline is None:
+        yield {'type': 'info', 'message': 'Составление плана текста', 'progress': 0}
+        outline = await generate_outline(prompt, target_words, language)
+        if outline is None:
+            logger.warning("Outline could not be parsed, generating sequentially")
+            metrics.incr("text_outline_fallbacks")
+            async for event in generate_sequential(prompt, target_words, language, deltas):
+                yield event
+            return
+        yield {'type': 'plan', 'mode': 'outline', 'outline': outline}
+
+    total = len(outline)
+    yield {'type': 'info', 'message': f'План готов: {total} разделов, генерация параллельно', 'progress': 10, 'sections': total}
+
+    semaphore = asyncio.Semaphore(TEXT_PARALLEL_SECTIONS)
+    failures: List[Exception] = []
+
+    async def section_task(idx: int) -> tuple:
+        async with semaphore:
+            if failures:
+                # Another section failed: start no more, the generation is resumed later
+                return idx, None
+            return idx, await generate_section(
+                prompt, outline, idx, language, deltas.sink(idx, "\n\n") if deltas else None
+            )
+
+    texts: List[Optional[str]] = [saved.get(idx) for idx in range(total)]
+    for idx, text in enumerate(texts):
+        if text is not None and deltas:
+            deltas.restore(idx, text, "\n\n")
+            yield {'type': 'section_done', 'section': idx}
+    tasks = [asyncio.ensure_future(section_task(idx)) for idx in range(total) if texts[idx] is None]
+    done_count = total - len(tasks)
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                idx, text = await next_done
+            except Exception as e:
+                # Sections already being written still finish and are saved for the resume
+                failures.append(e)
+                continue
+            if text is None:
+                continue
+            done_count += 1
+            texts[idx] = text
+            yield {'type': 'chunk', 'section': idx, 'text': text}
+            logger.info(f"Generated section {idx + 1}/{total}: {len(text.split())} words")
+            if deltas:
+                yield {'type': 'section_done', 'section': idx}
+            yield {'type': 'progress', 'progress': 10 + int(done_count / total * 90), 'message': f'Раздел {done_count}/{total}'}
+    finally:
+        # The client went away: stop paying for the others
+        for task in tasks:
+            task.cancel()
+    if failures:
+        raise failures[0]
+
+    yield {'type': 'result', 'text': "\n\n".join(texts)}
+
+async def generate_script(prompt: str, target_words: int, language: str, mode: Optional[str] = None,
+                          stream: bool = False, is_pro: bool = False,
+                          resume: Optional[dict] = None, trim: bool = True) -> AsyncIterator[dict]:
+    """Progress events for a script of about target_words, ending with {'type': 'result', 'text': ...}
+    With stream, 'delta' events carry the text while it is being written and
+    'section_done' follows the last delta of each section. While its LLM requests
+    wait for the concurrency limiter (Pro first), 'queue' events carry the position.
+    resume is {'plan': <plan event>, 'chunks': {section: text}} of an interrupted generation.
+    Without trim the result is never cut (for text that is already being spoken)."""
+    # Generation runs as a task; this loop forwards its events and, every
+    # TEXT_STREAM_COALESCE_SECONDS in between, the delta buffer and queue position
+    deltas = DeltaBuffer() if stream else None
+    events: asyncio.Queue = asyncio.Queue()
+    started = time.perf_counter()
+    first_delta = True
+    owner = llm_limiter.Requester(is_pro)
+    last_position = None
+
+    async def produce():
+        try:
+            async for event in script_events(prompt, target_words, language, mode, deltas, resume, trim):
+                await events.put(event)
+        except Exception as e:
+            await events.put(e)
+
+    # The requester is seen by every LLM call of this generation, including section tasks
+    context = contextvars.copy_context()
+    context.run(llm_limiter.requester.set, owner)
+    producer = asyncio.get_running_loop().create_task(produce(), context=context)
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(events.get(), TEXT_STREAM_COALESCE_SECONDS)
+            except asyncio.TimeoutError:
+                event = None
+            if owner.position != last_position:
+                last_position = owner.position
+                if last_position is not None:
+                    yield {'type': 'queue', 'queue_position': last_position, 'message': f'Ожидание генератора текста (позиция {last_position})'}
+            for delta in deltas.take() if deltas else []:
+                if first_delta:
+                    first_delta = False
+                    metrics.incr("text_first_delta_seconds", time.perf_counter() - started)
+                    logger.info(f"First text delta after {time.perf_counter() - started:.2f}s")
+                yield delta
+            if event is None:
+                continue
+            if isinstance(event, Exception):
+                raise event
+            yield event
+            if event['type'] == 'result':
+                return
+    finally:
+        producer.cancel()
+
+async def script_events(prompt: str, target_words: int, language: str, mode: Optional[str],
+                        deltas: Optional[DeltaBuffer], resume: Optional[dict] = None,
+                        trim: bool = True) -> AsyncIterator[dict]:
+    plan = resume.get('plan') if resume else None
+    saved = (resume.get('chunks') or {}) if resume else {}
+    if plan:
+        mode = plan['mode']
+    elif target_words <= CHUNK_WORDS:
+        mode = "single"
+    else:
+        mode = mode or TEXT_GENERATION_MODE
+    started = time.perf_counter()
+    if saved:
+        yield {'type': 'info', 'message': f'Продолжение генерации: готово частей - {len(saved)}', 'progress': 0}
+
+    if mode == "single":
+        # Short text - generate in one go
+        if not plan:
+            yield {'type': 'plan', 'mode': mode}
+        yield {'type': 'progress', 'progress': 50, 'message': 'Генерация текста...'}
+        if 0 in saved:
+            text = saved[0]
+            if deltas:
+                deltas.restore(0, text, "")
+        else:
+            text = await generate_text_chunk(
+                prompt, target_words, language, is_complete=True,
+                on_delta=deltas.sink(0, "") if deltas else None
+            )
+            yield {'type': 'chunk', 'section': 0, 'text': text}
+        if deltas:
+            yield {'type': 'section_done', 'section': 0}
+        yield {'type': 'progress', 'progress': 100, 'message': 'Текст готов'}
+    else:
+        if mode == "outline":
+            generate = generate_outlined(prompt, target_words, language, deltas, plan.get('outline') if plan else None, saved)
+        else:
+            generate = generate_sequential(prompt, target_words, language, deltas, saved)
+        async for event in generate:
+            if event['type'] == 'result':
+                text = event['text']
+            else:
+                yield event
+
+    if trim:
+        trimmed = trim_to_length(text, target_words)
+        if len(trimmed) < len(text):
+            cut = len(text.split()) - len(trimmed.split())
+            metrics.incr("text_trimmed_words", cut)
+            logger.info(f"Trimmed {cut} words over the {target_words}-word target")
+            text = trimmed
+
+    elapsed = time.perf_counter() - started
+    metrics.incr("text_generations", mode=mode)
+    metrics.incr("text_generation_seconds", elapsed, mode=mode)
+    logger.info(f"Generated {len(text.split())}/{target_words} words in {elapsed:.1f}s ({mode})")
+    yield {'type': 'result', 'text': text}
@@ -0,0 +1,253 @@
+"""Bidirectional WebSocket TTS: text increments in, audio per sentence out
+
+Protocol of /api/audio/stream (JSON text frames; audio as binary frames):
+
+    client -> {"type": "start", "voice": "ru_RU-irina-medium", "rate": 1.0, "window": 4}
+    server <- {"type": "ready", "sample_rate": 22050, "sample_width": 2, "channels": 1, "window": 4}
+    client -> {"type": "text", "text": "Привет. Как де"}     # any number of increments
+    server <- {"type": "audio", "seq": 0, "text": "Привет.", "bytes": 52800, ...}
+              followed by one binary frame with that sentence's PCM
+    client -> {"type": "ack", "seq": 0}                       # played or buffered
+    client -> {"type": "flush"}                                # synthesize the unfinished tail now
+    client -> {"type": "end"}                                  # flush, send the rest, then "done"
+    server <- {"type": "done", "sentences": 2, "first_audio_ms": {...}}
+
+Flow control works both ways:
+    - at most `window` sentences are sent without an ack (window 0 turns acks off);
+      synthesis waits while the client is behind
+    - when STREAM_MAX_QUEUED_SENTENCES sentences wait for synthesis the server sends
+      {"type": "pause"}, and {"type": "resume"} once half of them are done; text past
+      STREAM_MAX_BUFFERED_CHARS while paused closes the session
+
+Latency is measured per sentence from the moment its end arrives to its audio
+being sent, minus time spent waiting for the client's acks.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from collections import deque
+from typing import Callable, List, Optional
+
+from fastapi import WebSocket
+
+import metrics
+from engine import synthesize_pcm
+
+logger = logging.getLogger(__name__)
+
+STREAM_MAX_SENTENCE_CHARS = int(os.environ.get('STREAM_MAX_SENTENCE_CHARS', 300))
+STREAM_MAX_QUEUED_SENTENCES = int(os.environ.get('STREAM_MAX_QUEUED_SENTENCES', 8))
+STREAM_MAX_BUFFERED_CHARS = int(os.environ.get('STREAM_MAX_BUFFERED_CHARS', 20000))
+STREAM_DEFAULT_WINDOW = int(os.environ.get('STREAM_DEFAULT_WINDOW', 4))
+STREAM_IDLE_TIMEOUT_SECONDS = float(os.environ.get('STREAM_IDLE_TIMEOUT_SECONDS', 120))
+
+# Sentence end followed by whitespace (so "3.14" or an unfinished "т.е" wait for more text), or a line break
+SENTENCE_END = re.compile(r'[.!?…]+["»”)\]]*\s+|\n+')
+
+# Recent sentence-to-first-audio latencies (seconds), newest last
+first_audio_latencies: deque = deque(maxlen=500)
+active_sessions = 0
+
+class SentenceSplitter:
+    """Incremental sentence segmentation over text that arrives in pieces"""
+
+    def __init__(self, max_chars: int = STREAM_MAX_SENTENCE_CHARS):
+        self.max_chars = max_chars
+        self.buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        """Complete sentences found after adding text; the unfinished tail stays buffered"""
+        self.buffer += text
+        sentences = []
+        while True:
+            match = SENTENCE_END.search(self.buffer)
+            if match:
+                cut = match.end()
+            elif len(self.buffer) > self.max_chars:
+                # No boundary yet: cut at the last clause or word break
+                cut = max(self.buffer.rfind(sep, 0, self.max_chars) for sep in (", ", "; ", ": ", " ")) + 1
+                if cut <= 1:
+                    cut = self.max_chars
+            else:
+                break
+            sentence, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if sentence:
+                sentences.append(sentence)
+        return sentences
+
+    def flush(self) -> List[str]:
+        sentence, self.buffer = self.buffer.strip(), ""
+        return [sentence] if sentence else []
+
+class StreamClosed(Exception):
+    """The client broke the protocol; the message goes back in an error frame"""
+
+class StreamSession:
+    """One /api/audio/stream connection after the voice is loaded"""
+
+    def __init__(self, websocket: WebSocket, voice, rate: float, window: int, is_draining: Callable[[], bool]):
+        self.websocket = websocket
+        self.voice = voice
+        self.rate = rate
+        self.window = window
+        self.is_draining = is_draining
+        self.session_id = str(uuid.uuid4())
+        self.splitter = SentenceSplitter()
+        # (seq, text, time its end arrived); None ends the session
+        self.sentences: asyncio.Queue = asyncio.Queue()
+        self.next_seq = 0
+        self.sent_seq = -1
+        self.acked_seq = -1
+        self.acked = asyncio.Event()
+        self.paused = False
+        self.ended = False
+        self.latencies: List[float] = []
+        self.audio_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.send_lock = asyncio.Lock()
+
+    async def run(self):
+        """Serve the session until the client ends it; raises WebSocketDisconnect if it goes away"""
+        global active_sessions
+        active_sessions += 1
+        metrics.set_gauge("stream_sessions", active_sessions)
+        receiver = asyncio.get_running_loop().create_task(self.receive())
+        sender = asyncio.get_running_loop().create_task(self.synthesize())
+        try:
+            # The receiver keeps reading acks until the sender is done; it only stops early with an error
+            done, _ = await asyncio.wait({receiver, sender}, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            active_sessions -= 1
+            metrics.set_gauge("stream_sessions", active_sessions)
+            receiver.cancel()
+            sender.cancel()
+            await asyncio.gather(receiver, sender, return_exceptions=True)
+
+    async def send(self, message: dict, audio: Optional[bytes] = None):
+        # Keeps an audio header and its binary frame together
+        async with self.send_lock:
+            await self.websocket.send_text(json.dumps(message))
+            if audio is not None:
+                await self.websocket.send_bytes(audio)
+
+    async def receive(self):
+        while True:
+            try:
+                message = json.loads(await asyncio.wait_for(self.websocket.receive_text(), STREAM_IDLE_TIMEOUT_SECONDS))
+            except asyncio.TimeoutError:
+                raise StreamClosed("Нет данных от клиента, соединение закрыто")
+            except json.JSONDecodeError:
+                raise StreamClosed("Ожидается JSON")
+            message_type = message.get("type")
+
+            if message_type == "ack":
+                self.acked_seq = max(self.acked_seq, int(message.get("seq", -1)))
+                self.acked.set()
+            elif self.ended:
+                # After "end" (or a drain) only acks are expected
+                continue
+            elif message_type == "text":
+                if self.is_draining():
+                    # Finish what was already sent, take nothing new
+                    await self.send({'type': 'error', 'message': 'Сервер перезапускается. Переподключитесь через несколько секунд.'})
+                    await self.end()
+                    continue
+                if self.paused and self.sentences.qsize() * STREAM_MAX_SENTENCE_CHARS + len(self.splitter.buffer) > STREAM_MAX_BUFFERED_CHARS:
+                    raise StreamClosed("Клиент не соблюдает pause: слишком много текста в очереди")
+                await self.queue(self.splitter.feed(str(message.get("text", ""))))
+            elif message_type == "flush":
+                await self.queue(self.splitter.flush())
+            elif message_type == "end":
+                await self.end()
+            else:
+                raise StreamClosed(f"Неизвестный тип сообщения: {message_type}")
+
+    async def end(self):
+        await self.queue(self.splitter.flush())
+        await self.sentences.put(None)
+        self.ended = True
+
+    async def queue(self, sentences: List[str]):
+        now = time.perf_counter()
+        for sentence in sentences:
+            await self.sentences.put((self.next_seq, sentence, now))
+            self.next_seq += 1
+        if not self.paused and self.sentences.qsize() >= STREAM_MAX_QUEUED_SENTENCES:
+            self.paused = True
+            metrics.incr("stream_pauses")
+            await self.send({'type': 'pause', 'queued_sentences': self.sentences.qsize()})
+
+    async def wait_for_window(self) -> float:
+        """Wait until fewer than `window` sentences are unacked; returns the seconds waited"""
+        started = time.perf_counter()
+        while self.window and self.sent_seq - self.acked_seq >= self.window:
+            self.acked.clear()
+            await self.acked.wait()
+        return time.perf_counter() - started
+
+    async def synthesize(self):
+        while True:
+            item = await self.sentences.get()
+            if item is None:
+                break
+            seq, text, ready_at = item
+            window_wait = await self.wait_for_window()
+
+            # Interactive: earliest possible deadline, ahead of batch jobs in the dispatcher
+            synthesis_started = time.perf_counter()
+            pcm, cpu_seconds = await synthesize_pcm(text, self.voice, self.rate, self.session_id, time.time())
+            synthesis_seconds = time.perf_counter() - synthesis_started
+            latency = time.perf_counter() - ready_at - window_wait
+            duration = len(pcm) / 2 / self.voice.config.sample_rate
+
+            await self.send({
+                'type': 'audio',
+                'seq': seq,
+                'text': text,
+                'bytes': len(pcm),
+                'duration': round(duration, 3),
+                'first_audio_ms': round(latency * 1000, 1),
+                'synthesis_ms': round(synthesis_seconds * 1000, 1)
+            }, pcm)
+            self.sent_seq = seq
+            self.record(latency, duration, cpu_seconds)
+
+            if self.paused and self.sentences.qsize() <= STREAM_MAX_QUEUED_SENTENCES // 2:
+                self.paused = False
+                await self.send({'type': 'resume'})
+
+        await self.send({
+            'type': 'done',
+            'sentences': len(self.latencies),
+            'audio_seconds': round(self.audio_seconds, 2),
+            'first_audio_ms': latency_summary(self.latencies)
+        })
+
+    def record(self, latency: float, duration: float, cpu_seconds: float):
+        self.latencies.append(latency)
+        self.audio_seconds += duration
+        self.cpu_seconds += cpu_seconds
+        first_audio_latencies.append(latency)
+        metrics.incr("stream_sentences")
+        metrics.incr("stream_audio_seconds", duration)
+
+def latency_summary(latencies: list) -> Optional[dict]:
+    """p50 / p95 / max in milliseconds"""
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    def at(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+    return {"p50": at(0.5), "p95": at(0.95), "max": round(ordered[-1] * 1000, 1)}
+
+def snapshot() -> dict:
+    return {
+        "sessions": active_sessions,
+        "first_audio_ms": latency_summary(list(first_audio_latencies))
+    }
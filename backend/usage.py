@@ -0,0 +1,69 @@
+import os
+import logging
+from datetime import datetime, timezone, timedelta
+from motor.motor_asyncio import AsyncIOMotorClient
+from dotenv import load_dotenv
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+# MongoDB connection
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(mongo_url)
+db = client[os.environ['DB_NAME']]
+
+# Compute usage ledger: one entry per finished synthesis job with its metered
+# CPU time and audio length. Free-tier quotas can be counted in generations
+# (the original rule), CPU-seconds or audio minutes.
+QUOTA_MODE = os.environ.get('QUOTA_MODE', 'count')  # count | cpu_seconds | audio_minutes
+FREE_TIER_DAILY_CPU_SECONDS = float(os.environ.get('FREE_TIER_DAILY_CPU_SECONDS', 300))
+FREE_TIER_DAILY_AUDIO_MINUTES = float(os.environ.get('FREE_TIER_DAILY_AUDIO_MINUTES', 30))
+
+async def ensure_indexes():
+    await db.usage_ledger.create_index([("user_id", 1), ("created_at", -1)])
+
+async def record_usage(user_id: str, job_id: str, cpu_seconds: float, audio_seconds: float, segments: int):
+    """Add a finished job to the user's ledger (idempotent per job)"""
+    try:
+        await db.usage_ledger.update_one(
+            {"_id": job_id},
+            {"$setOnInsert": {
+                "user_id": user_id,
+                "job_id": job_id,
+                "cpu_seconds": cpu_seconds,
+                "audio_seconds": audio_seconds,
+                "segments": segments,
+                "created_at": datetime.now(timezone.utc)
+            }},
+            upsert=True
+        )
+    except Exception as e:
+        logger.error(f"Error recording usage for job {job_id}: {str(e)}")
+
+async def get_usage(user_id: str, hours: int = 24) -> dict:
+    """Generations, CPU-seconds and audio minutes metered for a user in the last N hours"""
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=hours)
+    totals = {"generations": 0, "cpu_seconds": 0.0, "audio_minutes": 0.0}
+    try:
+        cursor = db.usage_ledger.aggregate([
+            {"$match": {"user_id": user_id, "created_at": {"$gte": cutoff}}},
+            {"$group": {
+                "_id": None,
+                "generations": {"$sum": 1},
+                "cpu_seconds": {"$sum": "$cpu_seconds"},
+                "audio_seconds": {"$sum": "$audio_seconds"}
+            }}
+        ])
+        async for row in cursor:
+            totals = {
+                "generations": row["generations"],
+                "cpu_seconds": round(row["cpu_seconds"], 1),
+                "audio_minutes": round(row["audio_seconds"] / 60, 1)
+            }
+    except Exception as e:
+        logger.error(f"Error getting usage for {user_id}: {str(e)}")
+    return totals
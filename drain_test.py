@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Test graceful drain: SIGTERM during a long inline synthesis job, then restore on the next start
+
+    python drain_test.py
+
+Runs the backend in-process against a local mongod (MONGO_URL, throwaway database)
+and synthesizes with TEST_VOICE, so the voice model must be downloadable.
+"""
+import asyncio
+import os
+import signal
+import sys
+import time
+import uuid
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = f"drain_test_{uuid.uuid4().hex[:8]}"
+os.environ["SYNTHESIS_MODE"] = "inline"
+os.environ.setdefault("DRAIN_TIMEOUT_SECONDS", "1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import engine  # noqa: E402
+import server  # noqa: E402
+from jobs import SynthesisJob, JobCancelled  # noqa: E402
+
+VOICE = os.environ.get("TEST_VOICE", "ru_RU-irina-medium")
+TEXT = "Это длинный текст для проверки плавной остановки сервера во время синтеза. " * 400
+
+results = []
+
+def check(name, condition, details=""):
+    results.append((name, condition))
+    print(f"{'✅' if condition else '❌'} {name}" + (f" - {details}" if details else ""))
+
+synthesized_segments = []
+original_segment = engine.synthesize_audio_segment_fast
+
+async def counting_segment(*args, **kwargs):
+    path = await original_segment(*args, **kwargs)
+    synthesized_segments.append(path.name)
+    return path
+
+async def run_job(job: SynthesisJob, events: list):
+    try:
+        async for event in server.inline_synthesis_events(job):
+            events.append(event)
+    except JobCancelled:
+        if job.cancel_reason == server.DRAIN_REASON:
+            events.append(server.handoff_event(job.job_id))
+    finally:
+        await server.release_synthesis_job(job)
+
+async def test_drain():
+    print("\n[ТЕСТ] SIGTERM во время длинной задачи")
+    print("-" * 60)
+    engine.synthesize_audio_segment_fast = counting_segment
+    loop = asyncio.get_running_loop()
+    exit_requested = asyncio.Event()
+
+    # Same handler the server installs on startup; SIGINT would normally stop uvicorn
+    await server.install_drain_handler()
+    loop.add_signal_handler(signal.SIGINT, exit_requested.set)
+
+    job = server.register_job(SynthesisJob(str(uuid.uuid4()), "drain-test-user"))
+    job.params = {
+        "audio_id": str(uuid.uuid4()),
+        "text": TEXT,
+        "voice": VOICE,
+        "rate": 1.0,
+        "language": "ru-RU",
+        "is_pro": False
+    }
+    events = []
+    task = asyncio.create_task(run_job(job, events))
+
+    start = time.time()
+    while len(synthesized_segments) < 2 and not task.done() and time.time() - start < 300:
+        await asyncio.sleep(0.1)
+    check("Задача успела начаться", len(synthesized_segments) >= 2, f"{len(synthesized_segments)} сегментов")
+
+    os.kill(os.getpid(), signal.SIGTERM)
+    await asyncio.sleep(0.1)
+    ready = await server.readiness()
+    check("Readiness = false во время остановки", getattr(ready, "status_code", 200) == 503)
+    admission_status = None
+    try:
+        await server.check_admission("drain-test-user", 1)
+    except server.HTTPException as e:
+        admission_status = e.status_code
+    check("Новые задачи не принимаются", admission_status == 503, str(admission_status))
+
+    await asyncio.wait_for(exit_requested.wait(), timeout=server.DRAIN_TIMEOUT_SECONDS + 60)
+    await task
+    check("После остановки запрошен выход сервера", exit_requested.is_set(), f"{time.time() - start:.1f}с")
+    check("Клиент получил событие handoff", events and events[-1]["type"] == "handoff")
+
+    pending = await server.db.pending_synthesis.find_one({"_id": job.job_id})
+    check("Задача сохранена в pending_synthesis", pending is not None and pending["segments_done"] > 0,
+          f"готово сегментов: {pending and pending['segments_done']}")
+    check("Готовые сегменты сохранены на диске", job.temp_dir.exists() and any(job.temp_dir.glob("segment_*.wav")))
+    return job, pending
+
+async def test_restore(job: SynthesisJob, pending: dict):
+    print("\n[ТЕСТ] Восстановление задачи при следующем запуске")
+    print("-" * 60)
+    # A fresh process starts undrained
+    server.draining = False
+    server.drain_finished = False
+    total_segments = len(engine.split_text_into_segments(TEXT))
+    synthesized_segments.clear()
+
+    await server.restore_pending_jobs()
+    start = time.time()
+    while await server.db.pending_synthesis.find_one({"_id": job.job_id}) and time.time() - start < 600:
+        await asyncio.sleep(0.5)
+
+    audio_doc = await server.db.audio_generations.find_one({"id": pending["audio_id"]})
+    check("Восстановленная задача завершена", audio_doc is not None, f"{time.time() - start:.1f}с")
+    check("Синтезированы только недостающие сегменты",
+          len(synthesized_segments) <= total_segments - pending["segments_done"],
+          f"{len(synthesized_segments)} из {total_segments}")
+    if audio_doc:
+        check("Аудиофайл создан", os.path.exists(audio_doc["audio_path"]), audio_doc["audio_path"])
+
+async def main():
+    print("=" * 60)
+    print("ТЕСТ ПЛАВНОЙ ОСТАНОВКИ СЕРВЕРА")
+    print("=" * 60)
+    print(f"MongoDB: {os.environ['MONGO_URL']}, база: {os.environ['DB_NAME']}")
+
+    try:
+        job, pending = await test_drain()
+        if pending:
+            await test_restore(job, pending)
+    finally:
+        await server.client.drop_database(os.environ["DB_NAME"])
+
+    passed = sum(1 for _, ok in results if ok)
+    print("\n" + "=" * 60)
+    print(f"Итого: {passed}/{len(results)} проверок пройдено")
+    print("=" * 60)
+    return passed == len(results)
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)
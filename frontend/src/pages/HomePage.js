@@ -10,11 +10,15 @@ import { Input } from "@/components/ui/input";
 import { Label } from "@/components/ui/label";
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from "@/components/ui/select";
 import { Slider } from "@/components/ui/slider";
+import { Switch } from "@/components/ui/switch";
 import { Card, CardContent, CardDescription, CardHeader, CardTitle } from "@/components/ui/card";
 import { Progress } from "@/components/ui/progress";
 import { toast } from "sonner";
 import { Loader2, Sparkles, Mic, Download, Clock, Volume2, User, LogOut } from "lucide-react";
 
+// Times a broken text stream is resumed before giving up
+const TEXT_RESUME_ATTEMPTS = 3;
+
 const HomePage = () => {
   const { user, subscription, logout, isAdmin, refreshSubscription } = useAuth();
   const navigate = useNavigate();
@@ -23,6 +27,7 @@ const HomePage = () => {
   // AI Generation state
   const [prompt, setPrompt] = useState("");
   const [duration, setDuration] = useState(1);
+  const [reuseCached, setReuseCached] = useState(false);
   const [generatedText, setGeneratedText] = useState("");
   const [isGeneratingText, setIsGeneratingText] = useState(false);
   
@@ -116,76 +121,105 @@ const HomePage = () => {
     setTextProgressMessage("Начало генерации...");
     setGeneratedText("");
     
-    try {
-      // Use fetch with streaming for SSE (supports credentials)
-      const response = await fetch(
-        `${API}/text/generate-with-progress?` + new URLSearchParams({
-          prompt: prompt,
-          duration_minutes: duration,
-          language: language
-        }),
-        {
+    // Id of this generation; if the stream breaks off, it is resumed from the first missing chunk
+    let textId = null;
+    let finished = false;
+    
+    for (let attempt = 0; attempt <= TEXT_RESUME_ATTEMPTS && !finished; attempt++) {
+      if (attempt > 0) {
+        if (!textId) break;
+        setTextProgressMessage("Соединение прервано, продолжаем генерацию...");
+        await new Promise((resolve) => setTimeout(resolve, 1000 * attempt));
+      }
+      
+      try {
+        // Use fetch with streaming for SSE (supports credentials)
+        const url = textId
+          ? `${API}/text/generations/${textId}/resume`
+          : `${API}/text/generate-with-progress?` + new URLSearchParams({
+              prompt: prompt,
+              duration_minutes: duration,
+              language: language,
+              reuse_cached: reuseCached
+            });
+        const response = await fetch(url, {
           credentials: 'include', // Send cookies
           headers: {
             'Accept': 'text/event-stream'
           }
+        });
+
+        if (!response.ok) {
+          throw new Error(`HTTP error! status: ${response.status}`);
         }
-      );
 
-      if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
-      }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        // Text written so far, per section (sections of an outline are written in parallel);
+        // a resumed stream starts again with the finished ones
+        const sections = [];
 
-      const reader = response.body.getReader();
-      const decoder = new TextDecoder();
-      let buffer = '';
-
-      while (true) {
-        const { done, value } = await reader.read();
-        
-        if (done) break;
-        
-        buffer += decoder.decode(value, { stream: true });
-        const lines = buffer.split('\n');
-        buffer = lines.pop() || ''; // Keep incomplete line in buffer
+        while (true) {
+          const { done, value } = await reader.read();
+          
+          if (done) break;
+          
+          buffer += decoder.decode(value, { stream: true });
+          const lines = buffer.split('\n');
+          buffer = lines.pop() || ''; // Keep incomplete line in buffer
 
-        for (const line of lines) {
-          if (line.startsWith('data: ')) {
-            try {
-              const data = JSON.parse(line.slice(6));
-              
-              if (data.type === 'info') {
-                setTextProgressMessage(data.message);
-                if (data.progress !== undefined) {
-                  setTextProgress(data.progress);
+          for (const line of lines) {
+            if (line.startsWith('data: ')) {
+              try {
+                const data = JSON.parse(line.slice(6));
+                if (data.text_id) {
+                  textId = data.text_id;
                 }
-              } else if (data.type === 'progress') {
-                setTextProgress(data.progress);
-                if (data.message) {
+                
+                if (data.type === 'delta') {
+                  sections[data.section] = (sections[data.section] || '') + data.text;
+                  setGeneratedText(sections.filter(Boolean).join(''));
+                } else if (data.type === 'queue') {
+                  setTextProgressMessage(data.message);
+                } else if (data.type === 'info') {
                   setTextProgressMessage(data.message);
+                  if (data.progress !== undefined) {
+                    setTextProgress(data.progress);
+                  }
+                } else if (data.type === 'progress') {
+                  setTextProgress(data.progress);
+                  if (data.message) {
+                    setTextProgressMessage(data.message);
+                  }
+                } else if (data.type === 'complete') {
+                  finished = true;
+                  setTextProgress(100);
+                  setTextProgressMessage("Готово!");
+                  setGeneratedText(data.text);
+                  toast.success(`Сгенерировано ${data.word_count} слов!`);
+                  setIsGeneratingText(false);
+                  // Refresh subscription to update usage count
+                  await refreshSubscription();
+                } else if (data.type === 'error' && !(data.resumable && attempt < TEXT_RESUME_ATTEMPTS)) {
+                  finished = true;
+                  toast.error(data.message || "Ошибка генерации текста");
+                  setIsGeneratingText(false);
+                  await refreshSubscription();
                 }
-              } else if (data.type === 'complete') {
-                setTextProgress(100);
-                setTextProgressMessage("Готово!");
-                setGeneratedText(data.text);
-                toast.success(`Сгенерировано ${data.word_count} слов!`);
-                setIsGeneratingText(false);
-                // Refresh subscription to update usage count
-                await refreshSubscription();
-              } else if (data.type === 'error') {
-                toast.error(data.message || "Ошибка генерации текста");
-                setIsGeneratingText(false);
-                await refreshSubscription();
+              } catch (error) {
+                console.error("Error parsing SSE data:", error);
               }
-            } catch (error) {
-              console.error("Error parsing SSE data:", error);
             }
           }
         }
+        
+      } catch (error) {
+        console.error("Error generating text:", error);
       }
-      
-    } catch (error) {
-      console.error("Error generating text:", error);
+    }
+    
+    if (!finished) {
       toast.error("Не удалось сгенерировать текст");
       setIsGeneratingText(false);
     }
@@ -241,6 +275,14 @@ const HomePage = () => {
         }
       );
 
+      if (response.status === 429 || response.status === 503) {
+        // Server is overloaded: show the predicted wait instead of a generic error
+        const data = await response.json().catch(() => ({}));
+        toast.error(data.detail?.message || "Сервер перегружен, попробуйте позже");
+        setIsSynthesizing(false);
+        return;
+      }
+
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
@@ -464,6 +506,16 @@ const HomePage = () => {
                           </Select>
                         </div>
                       </div>
+
+                      <div className="flex items-center gap-2">
+                        <Switch
+                          id="reuse-cached"
+                          data-testid="reuse-cached-switch"
+                          checked={reuseCached}
+                          onCheckedChange={setReuseCached}
+                        />
+                        <Label htmlFor="reuse-cached">Reuse cached script for the same prompt</Label>
+                      </div>
                       
                       <Button 
                         onClick={handleGenerateText}
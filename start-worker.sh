@@ -0,0 +1,34 @@
+#!/bin/bash
+
+# Скрипт для запуска воркера синтеза (SYNTHESIS_MODE=queue)
+
+echo "🚀 Запуск воркера синтеза..."
+echo ""
+
+# Перейти в папку backend
+cd "$(dirname "$0")/backend" || exit
+
+# Проверка виртуального окружения
+if [ ! -d "venv" ]; then
+    echo "❌ Виртуальное окружение не найдено!"
+    echo "Создайте его командой: python3 -m venv venv"
+    exit 1
+fi
+
+# Проверка .env файла
+if [ ! -f ".env" ]; then
+    echo "⚠️  Файл .env не найден! Воркеру нужны те же MONGO_URL и DB_NAME, что и backend."
+    exit 1
+fi
+
+# Активация виртуального окружения
+echo "📦 Активация виртуального окружения..."
+source venv/bin/activate
+
+echo "✅ Воркер берёт задачи из коллекции synthesis_jobs"
+echo "Можно запускать несколько воркеров на разных машинах (общие MongoDB и AUDIO_OUTPUT_DIR)"
+echo "Нажмите Ctrl+C для остановки (текущие задачи вернутся в очередь)"
+echo "═══════════════════════════════════════════════════════════"
+echo ""
+
+python synth_worker.py
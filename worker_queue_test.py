@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Test the durable synthesis job queue against a local mongod
+
+    python worker_queue_test.py          # lease / heartbeat / expiry / cancel protocol
+    python worker_queue_test.py --full   # plus a real job run by an in-process synth worker
+
+Uses MONGO_URL (default mongodb://localhost:27017) and a throwaway database.
+"""
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = f"synth_queue_test_{uuid.uuid4().hex[:8]}"
+os.environ.setdefault("JOB_LEASE_SECONDS", "2")
+os.environ.setdefault("JOB_HEARTBEAT_SECONDS", "0.5")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import job_queue  # noqa: E402
+
+FULL = "--full" in sys.argv
+VOICE = os.environ.get("TEST_VOICE", "ru_RU-irina-medium")
+
+results = []
+
+def check(name, condition, details=""):
+    results.append((name, condition))
+    print(f"{'✅' if condition else '❌'} {name}" + (f" - {details}" if details else ""))
+
+async def enqueue(is_pro=False, text="Тестовый текст для очереди."):
+    job_id = str(uuid.uuid4())
+    await job_queue.enqueue_job(job_id, "test-user", is_pro, text, VOICE, 1.0, "ru-RU", 1, 0.1)
+    return job_id
+
+async def test_protocol():
+    print("\n[ТЕСТ] Протокол аренды задач")
+    print("-" * 60)
+    await job_queue.ensure_indexes()
+
+    free_job = await enqueue(is_pro=False)
+    pro_job = await enqueue(is_pro=True)
+
+    # Two workers race; each job must be leased exactly once, Pro first
+    first, second, third = await asyncio.gather(
+        job_queue.lease_next_job("worker-a"),
+        job_queue.lease_next_job("worker-b"),
+        job_queue.lease_next_job("worker-c")
+    )
+    leased = [doc for doc in (first, second, third) if doc]
+    check("Каждая задача арендована одним воркером", sorted(d["_id"] for d in leased) == sorted([free_job, pro_job]))
+    pro_doc = next(d for d in leased if d["_id"] == pro_job)
+    free_doc = next(d for d in leased if d["_id"] == free_job)
+
+    # Only the owner can write progress or heartbeat
+    check("Владелец пишет прогресс", await job_queue.push_event(pro_job, pro_doc["lease_owner"], {"type": "progress", "progress": 10}))
+    check("Чужой воркер не может писать", not await job_queue.push_event(pro_job, "intruder", {"type": "progress"}))
+    check("Heartbeat продлевает аренду", await job_queue.heartbeat(pro_job, pro_doc["lease_owner"]) is not None)
+
+    # Lease expiry hands the job to another worker
+    await asyncio.sleep(job_queue.LEASE_SECONDS + 0.5)
+    stolen = await job_queue.lease_next_job("worker-d")
+    check("Просроченная аренда переходит другому воркеру", stolen is not None and stolen["attempts"] == 2,
+          f"attempts={stolen and stolen['attempts']}")
+    old_owner = pro_doc["lease_owner"] if stolen["_id"] == pro_job else free_doc["lease_owner"]
+    check("Старый владелец теряет аренду", await job_queue.heartbeat(stolen["_id"], old_owner) is None)
+
+    # Completion is visible to API nodes
+    check("Завершение задачи", await job_queue.complete_job(
+        stolen["_id"], "worker-d", {"audio_id": "x"}, {"type": "complete"}, deadline=stolen["deadline"]))
+    done = await job_queue.get_job(stolen["_id"])
+    check("Статус и события видны API", done["status"] == "completed" and done["events"][-1]["type"] == "complete")
+    sla = await job_queue.get_sla_report()
+    check("SLA учтён в отчёте", sla[stolen["tier"]]["completed"] == 1, str(sla[stolen["tier"]]["attainment"]))
+    # The other job of the pair still has an expired lease; flag it so later leases cannot pick it up
+    await job_queue.request_cancel(free_job if stolen["_id"] == pro_job else pro_job)
+
+    # Cancellation: queued jobs cancel immediately, leased ones are flagged
+    queued_job = await enqueue()
+    cancelled = await job_queue.request_cancel(queued_job)
+    check("Отмена задачи в очереди", cancelled and cancelled["status"] == "cancelled")
+
+    # Leased by id: an older job with an expired lease would otherwise be leased instead
+    running_job = await enqueue()
+    running_doc = await job_queue.lease_next_job("worker-e", {"_id": running_job})
+    check("Задача арендована воркером", running_doc is not None and running_doc["_id"] == running_job)
+    flagged = await job_queue.request_cancel(running_job)
+    check("Отмена выполняемой задачи помечает её для воркера",
+          flagged is not None and flagged["status"] == "leased" and flagged["cancel_requested"],
+          f"status={flagged and flagged['status']}")
+
+    # Failures are retried until attempts run out
+    retry_job = await enqueue()
+    await job_queue.lease_next_job("worker-f", {"_id": retry_job})
+    check("Ошибка возвращает задачу в очередь", await job_queue.fail_job(retry_job, "worker-f", "boom") == "queued")
+    await job_queue.lease_next_job("worker-f", {"_id": retry_job})
+
+    # Voice affinity: a cold worker leaves a voice to a warm worker with a free slot
+    await job_queue.report_worker("warm-worker", 1, 0, ["voice-a"], {})
+    affinity_job = str(uuid.uuid4())
+    await job_queue.enqueue_job(affinity_job, "test-user", False, "текст", "voice-a", 1.0, "ru-RU", 1, 0.1)
+    check("Холодный воркер не берёт чужой тёплый голос", await job_queue.lease_with_affinity("cold-worker", []) is None)
+    warm_doc = await job_queue.lease_with_affinity("warm-worker", ["voice-a"])
+    check("Тёплый воркер получает задачу своего голоса", warm_doc and warm_doc["affinity"] == "warm")
+
+async def test_full_flow():
+    print("\n[ТЕСТ] Полный цикл через synth_worker")
+    print("-" * 60)
+    from synth_worker import SynthWorker
+
+    text = "Это проверка воркера синтеза. " * 20
+    job_id = await enqueue(text=text)
+    worker = SynthWorker(worker_id="full-flow-worker", concurrency=1)
+    worker_task = asyncio.create_task(worker.run())
+
+    start = time.time()
+    job_doc = await job_queue.get_job(job_id)
+    while job_doc["status"] not in job_queue.TERMINAL_STATUSES and time.time() - start < 300:
+        await asyncio.sleep(0.5)
+        job_doc = await job_queue.get_job(job_id)
+
+    worker.stopping.set()
+    await worker_task
+
+    check("Задача выполнена воркером", job_doc["status"] == "completed", f"{time.time() - start:.1f}с")
+    check("События прогресса записаны", len(job_doc["events"]) > 3, f"{len(job_doc['events'])} событий")
+    if job_doc.get("result"):
+        check("Аудиофайл создан", os.path.exists(job_doc["result"]["audio_path"]), job_doc["result"]["audio_path"])
+
+async def main():
+    print("=" * 60)
+    print("ТЕСТ ОЧЕРЕДИ ЗАДАЧ СИНТЕЗА (MongoDB)")
+    print("=" * 60)
+    print(f"MongoDB: {os.environ['MONGO_URL']}, база: {os.environ['DB_NAME']}")
+
+    try:
+        await test_protocol()
+        if FULL:
+            await test_full_flow()
+    finally:
+        await job_queue.client.drop_database(os.environ["DB_NAME"])
+
+    passed = sum(1 for _, ok in results if ok)
+    print("\n" + "=" * 60)
+    print(f"Итого: {passed}/{len(results)} проверок пройдено")
+    print("=" * 60)
+    return passed == len(results)
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)